@@ -21,6 +21,9 @@
 from __future__ import absolute_import, division, print_function
 
 from timestream.manipulate import PCException
+from timestream.manipulate.pipecomponents import ResultingFeatureWriter
+from timestream.parse.imgio import set_image_backend
+from timestream.parse.prefetch import ImagePrefetcher
 
 import sys
 import os
@@ -29,7 +32,10 @@ import logging
 import timestream.manipulate.configuration as pipeconf
 import timestream.manipulate.pipeline as pipeline
 import datetime
+import math
 import matplotlib
+import multiprocessing
+import traceback
 from docopt import (docopt, DocoptExit)
 
 
@@ -84,6 +90,9 @@ def genConfig(opts):
     plConf.validate()
     plConf.lock()
 
+    if plConf.general.imageBackend is not None:
+        set_image_backend(plConf.general.imageBackend)
+
     return plConf
 
 
@@ -194,13 +203,17 @@ def genInputTimestream(plConf, existing_ts):
         end_hour=er,
         existing_ts=existing_ts,
         err_on_access=True)
+    if plConf.general.prefetchDepth > 0:
+        ts.prefetcher = ImagePrefetcher(
+            depth=plConf.general.prefetchDepth,
+            max_mb=plConf.general.prefetchMaxMB)
     # FIXME: asDict because it cannot be handled by json.
     ts.data["settings"] = plConf.asDict()
     return ts
 
 
 # Avoid repeating code in cli and gui
-def initPipeline(LOG, opts):
+def initContext(LOG, opts):
     # configuration
     plConf = genConfig(opts)
     createOutputs(plConf)
@@ -222,14 +235,65 @@ def initPipeline(LOG, opts):
     # initialise input timestream for processing
     ts = genInputTimestream(plConf, existing_ts)
     ctx.setVal("ints", ts)
+    ctx.setVal("recalculate", bool(opts["--recalculate"]))
     LOG.info(str(ts))
 
+    return (plConf, ctx, ts)
+
+
+def initPipeline(LOG, opts):
+    plConf, ctx, ts = initContext(LOG, opts)
+
     # initialise processing pipeline
     pl = pipeline.ImagePipeline(plConf.pipeline, ctx)
 
     return (plConf, ctx, pl, ts)
 
 
+def _runChunk(args):
+    """Run the pipeline over a contiguous chunk of timestamps in a worker
+    process, with a context and pipeline of its own.
+
+    Returns:
+      tuple: (part, imgData, error) with imgData the {tsname: image_data} of
+        the images written to each output timestream, for the parent to
+        merge and flush. error is the formatted traceback if the chunk
+        failed, None otherwise. Images written before a failure are still
+        in imgData.
+    """
+    opts, part, timestamps, existing_ts = args
+    LOG = logging.getLogger("timestreamlib")
+    ctx = None
+    error = None
+    try:
+        plConf = genConfig(opts)
+        ctx = genContext(plConf)
+        ctx.setVal("outputPart", part)
+        for tsname in ctx.outts.listSubSecNames():
+            # Only the parent writes the metadata of the output timestreams
+            ctx.outts.getVal(tsname).flush_interval = float("inf")
+        ts = genInputTimestream(plConf, existing_ts)
+        ctx.setVal("ints", ts)
+        ctx.setVal("recalculate", bool(opts["--recalculate"]))
+        pl = pipeline.ImagePipeline(plConf.pipeline, ctx)
+
+        pr = PipelineRunner()
+        pr.running = True
+        try:
+            pr._runPipeline(plConf, ctx, ts, pl, LOG, None, timestamps)
+        finally:
+            pl.close()
+    except Exception:
+        # Tracebacks pickle, unlike some exceptions
+        error = traceback.format_exc()
+
+    imgData = {}
+    if ctx is not None:
+        for tsname in ctx.outts.listSubSecNames():
+            imgData[tsname] = ctx.outts.getVal(tsname).pending_image_data()
+    return part, imgData, error
+
+
 # Enclose in a class to be able to stop it
 class PipelineRunner():
 
@@ -238,11 +302,79 @@ class PipelineRunner():
 
     def runPipeline(self, plConf, ctx, ts, pl, LOG, prsig=None, stsig=None):
         self.running = True
-        for i in range(len(ts.timestamps)):
+        try:
+            self._runPipeline(plConf, ctx, ts, pl, LOG, prsig)
+        finally:
+            pl.close()
+            # Output timestreams only flush their metadata every so often
+            for tsname in ctx.outts.listSubSecNames():
+                ctx.outts.getVal(tsname).flush()
+        LOG.info("Done")
+        if stsig is not None:
+            stsig.emit()
+
+    def runParallel(self, opts, plConf, ctx, ts, LOG, workers):
+        """Run the pipeline over the timestamps of ``ts`` with a pool of
+        ``workers`` processes.
+
+        Every worker gets a contiguous chunk of timestamps, so that all but
+        the first image of a chunk see the previous image's pots in ipmPrev.
+        The image data of every chunk is merged into the output timestreams
+        as soon as the chunk is done, failed or not. Once all chunks are
+        done, the feature csv and audit files of the workers are merged in
+        timestamp order, and the image data is written out.
+        """
+        self.running = True
+        existing_ts = []
+        if not opts["--recalculate"]:
+            existing_ts = genExistingTS(ctx)
+        timestamps = ts.timestamps
+        size = max(1, int(math.ceil(len(timestamps) / workers)))
+        chunks = [timestamps[i:i + size]
+                  for i in range(0, len(timestamps), size)]
+        parts = ["part{:03d}".format(i) for i in range(len(chunks))]
+        LOG.info("Processing {} time stamps in {} chunks".format(
+            len(timestamps), len(chunks)))
+
+        # The parent only merges the output of the workers' feature writers
+        writers = [ResultingFeatureWriter(ctx, **setElem)
+                   for i, setElem in plConf.pipeline.itersections()
+                   if setElem["name"] == ResultingFeatureWriter.actName]
+
+        failed = []
+        pool = multiprocessing.Pool(min(workers, max(1, len(chunks))))
+        try:
+            for part, imgData, error in pool.imap_unordered(
+                    _runChunk, [(opts, part, chunk, existing_ts)
+                                for part, chunk in zip(parts, chunks)]):
+                for tsname, data in imgData.iteritems():
+                    ctx.outts.getVal(tsname).merge_image_data(data)
+                if error is not None:
+                    LOG.error("Chunk {} failed:\n{}".format(part, error))
+                    failed.append(part)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            for writer in writers:
+                writer.mergeParts(parts)
+            for tsname in ctx.outts.listSubSecNames():
+                ctx.outts.getVal(tsname).flush()
+        if len(failed) > 0:
+            raise RuntimeError("Failed chunks: {}".format(
+                ", ".join(sorted(failed))))
+        LOG.info("Done")
+
+    def _runPipeline(self, plConf, ctx, ts, pl, LOG, prsig, timestamps=None):
+        if timestamps is None:
+            timestamps = ts.timestamps
+        for i in range(len(timestamps)):
             matplotlib.pyplot.close("all")
             if prsig is not None:
                 prsig.emit(i)
-            timestamp = ts.timestamps[i]
+            timestamp = timestamps[i]
             try:
                 img = ts.getImgByTimeStamp(timestamp, update_index=True)
                 # Detach img from timestream. We don't need it!
@@ -260,9 +392,6 @@ class PipelineRunner():
 
             if not self.running:
                 break
-        LOG.info("Done")
-        if stsig is not None:
-            stsig.emit()
 
 
 def maincli(opts):
@@ -271,10 +400,14 @@ def maincli(opts):
         initlogging(opts)
         LOG = logging.getLogger("timestreamlib")
 
-        plConf, ctx, pl, ts = initPipeline(LOG, opts)
-
         pr = PipelineRunner()
-        pr.runPipeline(plConf, ctx, ts, pl, LOG)
+        workers = int(opts.get("--workers") or 1)
+        if workers > 1:
+            plConf, ctx, ts = initContext(LOG, opts)
+            pr.runParallel(opts, plConf, ctx, ts, LOG, workers)
+        else:
+            plConf, ctx, pl, ts = initPipeline(LOG, opts)
+            pr.runPipeline(plConf, ctx, ts, pl, LOG)
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -500,7 +633,7 @@ USAGE:
     run-pipeline (-i IN | -p YML | -i IN -p YML)
                  [-o OUT] [-t YML]
                  [-v | -vv | -vvv | -s] [--logfile=FILE]
-                 [--recalculate] [--set=CONFIG]
+                 [--recalculate] [--set=CONFIG] [--workers=N]
     run-pipeline (-d | --doc) [--conf] [--comp]
     run-pipeline (-g | --gui)
     run-pipeline (-h | --help)
@@ -528,6 +661,9 @@ OPTIONS:
                      E.g: --set=a.b=value,c.d.e=val2
     --recalculate    By default we don't re-calculate images. Passing this
                      option forces recalculation
+    --workers=N      Number of processes to run the pipeline with. Each
+                     one processes a contiguous chunk of the time stamps.
+                     [default: 1]
     --conf           If set we output the documentation for the configuration
                      files.
     --comp           If set we output the documentation for all active
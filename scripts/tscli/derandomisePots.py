@@ -195,7 +195,7 @@ for imgL,imgR in itertools.izip(tsL.iter_by_timepoints(remove_gaps=False, start=
         img.datetime = imgL.datetime
         img.pixels = imgDerandon
         ts_out.write_image(img)
-        ts_out.write_metadata()
+        ts_out.flush()
         
 #        figL = plt.figure()
 #        plt.imshow(imgL.pixels)
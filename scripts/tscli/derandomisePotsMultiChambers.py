@@ -309,7 +309,7 @@ for img0L,img0R,img1L,img1R in itertools.izip(chambers['GC02']['leftChamberTS' ]
         img.datetime = img0L.datetime
         img.pixels = imgDerandon
         ts_out.write_image(img)
-        ts_out.write_metadata()
+        ts_out.flush()
         
         scale = img.pixels.shape[0]//1000 + 1
         imgResized = cv2.resize(img.pixels, (img.pixels.shape[1]//scale, img.pixels.shape[0]//scale))
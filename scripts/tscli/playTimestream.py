@@ -10,7 +10,8 @@ import cv2
 import logging
 import timestream
 import numpy as np
-from timestream.parse import ts_parse_date
+from timestream.parse import RIException, ts_parse_date
+from timestream.parse.imgio import image_shape
 import docopt
 import datetime
 import os
@@ -69,17 +70,28 @@ else:
     iterator = ts.iter_by_timepoints(start=start, end=end, interval = interval,
                                  start_hour = start_hour, end_hour = end_hour)
 for img in iterator:
-    if img is None or img.pixels is None:
+    if img is None:
         continue
 
     if outputRootPath:
+        if img.pixels is None:
+            continue
         if not os.path.exists(outputRootPath):
             os.makedirs(outputRootPath)
         cv2.imwrite(os.path.join(outputRootPath, os.path.basename(img.path)), img.pixels)
 
+    # JPEGs we don't write out are decoded straight at a reduced size
+    shape = image_shape(img.path)
+    if shape is None:
+        if img.pixels is None:
+            continue
+        shape = img.pixels.shape
     # estimate a downscale factor to make image fit into a normal HD screen
-    scale = img.pixels.shape[0]//1000 + 1
-    imgResized = cv2.resize(img.pixels, (img.pixels.shape[1]//scale, img.pixels.shape[0]//scale))
+    scale = shape[0]//1000 + 1
+    try:
+        imgResized = img.pixels_at(shape=(shape[0]//scale, shape[1]//scale))
+    except RIException:
+        continue
     timestamp = timestream.parse.ts_format_date(img.datetime)
     cv2.putText(imgResized, timestamp, (10,30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0,0,255), thickness = 1)
     cv2.imshow(windowName, imgResized[:,:,::-1])
@@ -11,7 +11,15 @@ from os import path
 import cv2
 import sys
 import traceback
-from timestream.parse import ts_iter_images
+from timestream.parse import (
+        RIException,
+        read_image,
+        ts_iter_images,
+        )
+from timestream.parse.imgio import (
+        dct_reduction,
+        image_shape,
+        )
 
 CLI = """
 USAGE:
@@ -50,7 +58,21 @@ def process_image((img, out_ts, size)):
     if not path.exists(dest):
         try:
             w_final, h_final = size
-            imgmat = cv2.imread(img)
+            shape = image_shape(img)
+            if shape is None:
+                imgmat = cv2.imread(img)
+            else:
+                # JPEG, decode it straight at a reduced size if we can
+                if h_final < 1:
+                    h_final = int(shape[0] * w_final / float(shape[1]))
+                reduce = dct_reduction(img, shape=(h_final, w_final))
+                try:
+                    imgmat = read_image(img, backend="opencv",
+                                        scale=1.0 / reduce)
+                except RIException:
+                    return
+                if imgmat.ndim == 3:
+                    imgmat = cv2.cvtColor(imgmat, cv2.COLOR_RGB2BGR)
             if imgmat is None:
                 return
             if h_final < 1:
@@ -6,12 +6,12 @@ Created on Wed Jun 25 13:31:54 2014
 """
 from __future__ import division, print_function
 
+import cv2
 import os
-from itertools import cycle, izip, imap
 import logging
 import timestream
 from timestream import manipulate
-import timestream.manipulate.pipeline as pipeline
+import timestream.manipulate.correct_detect as cd
 import yaml
 import multiprocessing as mp
 import docopt
@@ -27,6 +27,10 @@ OPTIONS:
     -e END      End date, in %Y_%m_%d_%H_%M_%S format.
     -I INTERVAL Interval, in seconds
     -t THREADS  Threads.
+
+The undistort section of IN/_data/corr.yml holds the cameraMatrix,
+distortCoefs, imageSize and rotationAngle, as for the undistort pipeline
+component.
 """
 
 # initialise input timestream for processing
@@ -60,20 +64,41 @@ class PipelineManager(object):
         for attr in timestream.parse.validate.TS_MANIFEST_KEYS:
             log.debug("ts.%s: %r", attr, getattr(self.ts, attr))
 
-def call_pipeline((self, img)):
-    pl = pipeline.ImagePipeline(self.ts.data["settings"])
+    def undistort_maps(self):
+        """Maps of the undistort settings, cached with the output timestream
+        so that every worker reads them instead of computing them."""
+        settings = self.settings["undistort"]
+        return cd.undistortMaps(settings["cameraMatrix"],
+                                settings["distortCoefs"],
+                                settings["imageSize"],
+                                settings["rotationAngle"],
+                                CacheDir=self.ts_out.data_dir)
+
+def init_worker(pmgr):
+    global _pmgr, _maps
+    _pmgr = pmgr
+    _maps = pmgr.undistort_maps()
+    # The parent writes out the image data of all workers
+    pmgr.ts_out.flush_interval = float("inf")
+
+def call_pipeline((dt, path)):
     log = logging.getLogger("CONSOLE")
-    if img is None:
+    if path is None:
         log.info('Missing Image')
-    else:
-        try:
-            log.info("Processing %s", img.path)
-            # set visualise to False to run in batch mode
-            context = {"rts":self.ts, "wts":self.ts_out, "img":img}
-            # result = process() removed as we don't use result yet
-            pl.process(context, [img], visualise=False)
-        except:
-            log.error("DOES NOT COMPUTE %s", img.path)
+        return {}
+    try:
+        log.info("Processing %s", path)
+        img = timestream.TimeStreamImage(dt)
+        pixels = timestream.parse.read_image(path)
+        img.pixels = cv2.remap(pixels, _maps[0], _maps[1], cv2.INTER_CUBIC)
+        _pmgr.ts_out.write_image(img)
+        key = timestream.parse.ts_format_date(dt)
+        if key not in _pmgr.ts_out.image_data:
+            return {}
+        return {key: _pmgr.ts_out.image_data[key]}
+    except Exception:
+        log.error("DOES NOT COMPUTE %s", path)
+        return {}
 
 if __name__ == "__main__":
     pmgr = PipelineManager()
@@ -92,10 +117,17 @@ if __name__ == "__main__":
         interval = pmgr.ts.interval * 60
     img_iter = pmgr.ts.iter_by_timepoints(remove_gaps=False, start=start_at,
                                           end=end_at, interval=interval)
-    pool = mp.Pool(12)
+    # Only paths are sent to the workers, which read the images themselves
+    img_iter = ((img.datetime, img.path) for img in img_iter)
+    # Computed, and cached, once before the workers read them
+    pmgr.undistort_maps()
+    threads = int(opts['-t']) if opts['-t'] else None
+    pool = mp.Pool(threads, init_worker, (pmgr,))
     count = 0
-    call_stack = izip(cycle([pmgr,]), img_iter)
-    for _ in pool.imap(call_pipeline, call_stack):
+    for image_data in pool.imap(call_pipeline, img_iter):
+        pmgr.ts_out.merge_image_data(image_data)
+        count += 1
         print("processed", count, end="\r")
     pool.close()
     pool.join()
+    pmgr.ts_out.write_metadata()
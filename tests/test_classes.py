@@ -18,6 +18,7 @@ from inspect import (
     isgenerator,
 )
 import numpy as np
+import os
 from os import path
 import shutil
 from unittest import TestCase
@@ -26,10 +27,18 @@ from tests import helpers
 from timestream import (
     TimeStream,
     TimeStreamImage,
+    TimeStreamTraverser,
+)
+from timestream.manipulate.pot import (
+    ImagePotMatrix,
 )
 from timestream.parse import (
+    save_image,
     ts_format_date,
 )
+from timestream.parse.prefetch import (
+    ImagePrefetcher,
+)
 from timestream.parse.validate import (
     TS_MANIFEST_KEYS,
 )
@@ -275,6 +284,43 @@ class TestTimeStreamImageClone(TestCase):
         self.assertEqual(cpy.path, img.path)
 
 
+class TestTimeStreamImagePixelsAt(TestCase):
+
+    """Test TimeStreamImage().pixels_at()"""
+
+    def setUp(self):
+        self.tmp_path = helpers.make_tmp_file() + ".jpg"
+        save_image(self.tmp_path, np.zeros((100, 160, 3), dtype=np.uint8),
+                   backend="opencv")
+
+    def test_pixels_at(self):
+        """Test TimeStreamImage.pixels_at() without loading pixels"""
+        img = TimeStreamImage()
+        img.path = self.tmp_path
+        pixels = img.pixels_at(scale=0.25)
+        self.assertEqual(pixels.shape, (25, 40, 3))
+        self.assertEqual(pixels.dtype, np.uint8)
+        self.assertEqual(img.pixels_at(shape=(30, 50)).shape, (30, 50, 3))
+        self.assertIs(img._pixels, None)
+        with self.assertRaises(ValueError):
+            img.pixels_at()
+
+    def test_pixels_at_loaded(self):
+        """Test TimeStreamImage.pixels_at() resizes loaded pixels"""
+        img = TimeStreamImage()
+        img.path = self.tmp_path
+        img.pixels = np.ones((100, 160, 3), dtype=np.uint8) * 100
+        pixels = img.pixels_at(scale=0.5)
+        self.assertEqual(pixels.shape, (50, 80, 3))
+        self.assertTrue((pixels == 100).all())
+        pixels = img.pixels_at(scale=1.0)
+        self.assertIsNot(pixels, img.pixels)
+        np.testing.assert_array_equal(pixels, img.pixels)
+
+    def tearDown(self):
+        os.remove(self.tmp_path)
+
+
 class TestTimeStreamIterByFiles(TestCase):
 
     """Test TimeStream().iter_by_files()"""
@@ -371,12 +417,88 @@ class TestTimeStreamIterByTimepoints(TestCase):
             # will fail above, or be a problem in our data files which should
             # change the date and make the previous statement fail.
 
+    def test_iter_by_timepoints_prefetch(self):
+        """Test TimeStream().iter_by_timepoints reading images ahead"""
+        ts = TimeStream()
+        ts.load(helpers.FILES["timestream"])
+        ts.prefetcher = ImagePrefetcher(depth=2)
+        for iii, image in enumerate(ts.iter_by_timepoints()):
+            self.assertEqual(image.datetime, helpers.TS_DATES_PARSED[iii])
+            # All but the first image were read ahead
+            self.assertEqual(image._pixels is None, iii == 0)
+            self.assertEqual(image.pixels.shape, helpers.TS_JPG_SHAPE)
+        self.assertEqual(iii, len(helpers.TS_DATES_PARSED) - 1)
+        ts.prefetcher.close()
+
     @classmethod
     def tearDownClass(cls):
         helpers.imgs_common_tsdir("teardown", helpers.FILES["timestream"])
         helpers.imgs_common_tsdir("teardown", helpers.FILES["timestream_gaps"])
 
 
+class TestTimeStreamTraverserInit(TestCase):
+
+    """Test TimeStreamTraverser() timestamp list construction"""
+
+    @classmethod
+    def setUpClass(cls):
+        helpers.imgs_common_tsdir("setup", helpers.FILES["timestream_gaps"],
+                                  skip=[("04", "30"), ("05", "30")])
+
+    def _both_modes(self, **kwargs):
+        kwargs["ts_path"] = helpers.FILES["timestream_gaps"]
+        rng = TimeStreamTraverser(from_listing=False, **kwargs)
+        lst = TimeStreamTraverser(from_listing=True, **kwargs)
+        self.assertListEqual(lst.timestamps, rng.timestamps)
+        self.assertEqual(lst.num_expected, rng.num_expected)
+        self.assertEqual(lst.num_found, rng.num_found)
+        return lst
+
+    def test_traverser_listing(self):
+        """Test TimeStreamTraverser(from_listing=True) matches the range"""
+        tst = self._both_modes()
+        self.assertListEqual(tst.timestamps, helpers.TS_GAPS_DATES_PARSED)
+        self.assertEqual(tst.num_expected, 8)
+        self.assertEqual(tst.num_found, 6)
+
+    def test_traverser_listing_hours(self):
+        """Test TimeStreamTraverser(from_listing=True) with an hour range"""
+        tst = self._both_modes(start_hour=dt.time(3, 30),
+                               end_hour=dt.time(6, 0))
+        self.assertListEqual(tst.timestamps, helpers.TS_GAPS_DATES_PARSED[1:5])
+        self.assertEqual(tst.num_expected, 6)
+        tst = self._both_modes(interval=60 * 60)
+        self.assertEqual(tst.num_expected, 4)
+        self.assertEqual(tst.num_found, 4)
+
+    def test_traverser_listing_skip(self):
+        """Test TimeStreamTraverser(from_listing=True) skipping timepoints"""
+        tst = self._both_modes(ignore_ts=["2013_10_30_03_00_00"],
+                               existing_ts=["2013_10_30_06_30_00"])
+        self.assertListEqual(tst.timestamps,
+                             helpers.TS_GAPS_DATES_PARSED[1:-1])
+
+    def test_traverser_prefetch(self):
+        """Test TimeStreamTraverser reads the following images ahead"""
+        tst = TimeStreamTraverser(ts_path=helpers.FILES["timestream_gaps"],
+                                  existing_ts=["2013_10_30_04_00_00"])
+        times = helpers.TS_GAPS_DATES_PARSED
+        # The existing timestamp is skipped
+        expected = [tst.getImgByTimeStamp(x).path for x in times[1:4:2]]
+        tst.prefetcher = ImagePrefetcher(depth=2)
+        img = tst.getImgByTimeStamp(times[0], update_index=True)
+        self.assertIsNone(img._pixels)
+        self.assertItemsEqual(tst.prefetcher._entries.keys(), expected)
+        img = tst.next()
+        self.assertEqual(img.datetime, times[1])
+        self.assertEqual(img.pixels.shape, helpers.TS_JPG_SHAPE)
+        tst.prefetcher.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        helpers.imgs_common_tsdir("teardown", helpers.FILES["timestream_gaps"])
+
+
 class TestTimeStreamCreate(TestCase):
 
     """Test TimeStream().create()"""
@@ -441,3 +563,132 @@ class TestTimeStreamWrite(TestCase):
             shutil.rmtree(self.tmp_path)
         except (OSError,):
             pass
+
+
+class TestTimeStreamPotData(TestCase):
+
+    def setUp(self):
+        self.tmp_path = helpers.make_tmp_file()
+
+    def test_timestream_pot_data(self):
+        """Test pots written with images come back lazily"""
+        ts = TimeStream()
+        ts.version = 1
+        ts.create(self.tmp_path, ext="jpg", start=helpers.ZEROS_DATETIME,
+                  end=helpers.ZEROS_DATETIME)
+        img = TimeStreamImage()
+        img.pixels = helpers.ZEROS_PIXELS
+        img.datetime = helpers.ZEROS_DATETIME
+        img.ipm = ImagePotMatrix(img, pots=[[10, 10, 40, 40]])
+        pot = img.ipm.getPot(-1)
+        pot.setMetaId("plant", "Col-0")
+        pot.calcFeatures(["area"])
+        ts.write_image(img)
+        self.assertTrue(path.isfile(ts.pot_data.path))
+
+        ts = TimeStream()
+        ts.load(self.tmp_path)
+        imgs = list(ts.iter_by_timepoints())
+        self.assertEqual(len(imgs), 1)
+        img = imgs[0]
+        # Nothing is rehydrated until we ask for the ipm
+        self.assertIsNone(img._ipm)
+        img.pixels = helpers.ZEROS_PIXELS
+        self.assertIsInstance(img.ipm, ImagePotMatrix)
+        self.assertListEqual(img.ipm.potIds, [-1])
+        pot = img.ipm.getPot(-1)
+        self.assertListEqual(list(pot.rect.asList()), [10, 10, 40, 40])
+        self.assertEqual(pot.getMetaId("plant"), "Col-0")
+        self.assertEqual(pot.getFeature("area").value, 0)
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.tmp_path)
+        except (OSError,):
+            pass
+
+
+class TestTimeStreamJournal(TestCase):
+
+    def setUp(self):
+        self.tmp_path = helpers.make_tmp_file()
+        self.ts = TimeStream()
+        self.ts.version = 1
+        self.ts.create(self.tmp_path, ext="jpg", start=helpers.ZEROS_DATETIME,
+                       end=helpers.ZEROS_DATETIME)
+        self.ts.flush_interval = 2
+
+    def _write(self, num):
+        for iii in range(num):
+            img = TimeStreamImage()
+            img.pixels = helpers.ZEROS_PIXELS
+            img.datetime = helpers.ZEROS_DATETIME + dt.timedelta(minutes=iii)
+            img.data["num"] = iii
+            self.ts.write_image(img)
+
+    def _load(self):
+        ts = TimeStream()
+        ts.load(self.tmp_path)
+        return ts
+
+    def test_timestream_journal(self):
+        """Test image_data goes to the journal in batches"""
+        self._write(3)
+        self.assertFalse(path.exists(self.ts.image_db_path))
+        self.assertEqual(len(self._load().image_data), 2)
+        self.ts.flush()
+        image_data = self._load().image_data
+        self.assertEqual(len(image_data), 3)
+        self.assertDictEqual(image_data["2013_11_12_20_55_09"], {"num": 2})
+        with open(self.ts.image_journal_path) as jnl_fh:
+            self.assertEqual(len(jnl_fh.readlines()), 3)
+
+    def test_timestream_journal_compact(self):
+        """Test the journal is compacted into image_data.json"""
+        self.ts.compact_interval = 3
+        self._write(4)
+        self.assertFalse(path.exists(self.ts.image_journal_path))
+        self.assertTrue(path.exists(self.ts.image_db_path))
+        self.assertEqual(len(self._load().image_data), 4)
+        self._write(1)
+        self.ts.flush()
+        self.assertTrue(path.exists(self.ts.image_journal_path))
+        self.assertEqual(len(self._load().image_data), 4)
+
+    def test_timestream_journal_truncated(self):
+        """Test a partly written journal entry is ignored"""
+        self._write(2)
+        with open(self.ts.image_journal_path, "a") as jnl_fh:
+            jnl_fh.write('["2013_11_12_20_55_09", {"nu')
+        self.assertEqual(len(self._load().image_data), 2)
+        # Entries flushed after the load are not lost to the bad one
+        self.ts = self._load()
+        self.ts.flush_interval = 1
+        self._write(3)
+        image_data = self._load().image_data
+        self.assertEqual(len(image_data), 3)
+        self.assertDictEqual(image_data["2013_11_12_20_55_09"], {"num": 2})
+
+    def test_timestream_journal_merge(self):
+        """Test image_data from another instance is journaled with ours"""
+        self.ts.flush_interval = 100
+        self._write(1)
+        other = self._load()
+        other.flush_interval = 100
+        img = TimeStreamImage()
+        img.pixels = helpers.ZEROS_PIXELS
+        img.datetime = helpers.ZEROS_DATETIME + dt.timedelta(minutes=5)
+        img.data["num"] = 5
+        other.write_image(img)
+        pending = other.pending_image_data()
+        self.assertDictEqual(pending, {"2013_11_12_20_58_09": {"num": 5}})
+        self.ts.merge_image_data(pending)
+        self.assertEqual(self.ts.end_datetime, img.datetime)
+        self.ts.flush()
+        self.assertEqual(len(self._load().image_data), 2)
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.tmp_path)
+        except (OSError,):
+            pass
@@ -0,0 +1,244 @@
+import cv2
+import numpy as np
+import os
+import shutil
+from unittest import TestCase
+
+from tests import helpers
+import timestream.manipulate.correct_detect as cd
+
+
+class TestMatchTemplatePyramidBatch(TestCase):
+    """Tests for timestream.manipulate.correct_detect batched matching"""
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        rand = np.random.RandomState(42)
+        image = rand.randint(0, 255, (600, 800, 3)).astype(np.uint8)
+        self.image = cv2.GaussianBlur(image, (5, 5), 2)
+        self.imagePyramid = cd.createImagePyramid(self.image)
+        self.templatePyramid = cd.createImagePyramid(
+            self.image[200:280, 300:380])
+        # A 4x5 grid, plus windows clipped by the image border
+        self.locs = [[280 + 60 * k, 180 + 60 * l]
+                     for k in range(4) for l in range(5)]
+        self.locs += [[3, 3], [797, 597]]
+
+    def _test_batch(self, searchRange):
+        scores, locs = cd.matchTemplatePyramidBatch(
+            self.imagePyramid, self.templatePyramid, self.locs,
+            SearchRange=searchRange, NoLevels=3)
+        for estLoc, bScore, bLoc in zip(self.locs, scores, locs):
+            score, loc, _ = cd.matchTemplatePyramid(
+                self.imagePyramid, self.templatePyramid, RotationAngle=0,
+                EstimatedLocation=estLoc, SearchRange=searchRange, NoLevels=3)
+            self.assertEqual(loc, bLoc)
+            self.assertAlmostEqual(score, bScore, places=4)
+
+    def test_batch_separate(self):
+        """Test batched matching equals one by one, with apart windows"""
+        self._test_batch([20, 20])
+
+    def test_batch_overlapping(self):
+        """Test batched matching equals one by one, with one map"""
+        self._test_batch([160, 160])
+        self.assertIn((340, 240), cd.matchTemplatePyramidBatch(
+            self.imagePyramid, self.templatePyramid, self.locs,
+            SearchRange=[160, 160], NoLevels=3)[1])
+
+
+class TestOrientationCache(TestCase):
+    """Tests for timestream.manipulate.correct_detect.OrientationCache"""
+
+    def setUp(self):
+        rand = np.random.RandomState(42)
+        image = rand.randint(0, 255, (600, 800, 3)).astype(np.uint8)
+        self.image = cv2.GaussianBlur(image, (5, 5), 2)
+        # The template as seen by an upside down camera
+        self.templatePyramid = cd.createImagePyramid(
+            np.rot90(self.image, 2)[200:280, 300:380].copy())
+        self.calls = 0
+        self.matchTemplateLocation = cd.matchTemplateLocation
+
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return self.matchTemplateLocation(*args, **kwargs)
+        cd.matchTemplateLocation = counted
+
+    def _match(self, image, orientations=None):
+        self.calls = 0
+        return cd.matchTemplatePyramid(
+            cd.createImagePyramid(image), self.templatePyramid,
+            EstimatedLocation=[340, 240], SearchRange=[200, 200],
+            NoLevels=3, Orientations=orientations)
+
+    def test_orientation_cache(self):
+        expected = self._match(self.image)
+        self.assertEqual(expected[2], 180)
+        # Both orientations at the coarsest level, then one per level
+        self.assertEqual(self.calls, 3)
+        orientations = cd.OrientationCache()
+        self.assertEqual(self._match(self.image, orientations), expected)
+        self.assertEqual(orientations.angle(self.templatePyramid), 180)
+        self.assertEqual(self._match(self.image, orientations), expected)
+        self.assertEqual(self.calls, 2)
+
+    def test_orientation_cache_degraded(self):
+        """Test both orientations are matched again once scores drop"""
+        orientations = cd.OrientationCache()
+        self._match(self.image, orientations)
+        upright = np.rot90(self.image, 2).copy()
+        score, loc, angle = self._match(upright, orientations)
+        self.assertEqual(angle, 0)
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(orientations.angle(self.templatePyramid), 0)
+
+    def tearDown(self):
+        cd.matchTemplateLocation = self.matchTemplateLocation
+
+
+class TestEstimateColorParameters(TestCase):
+    """Tests for timestream.manipulate.correct_detect.estimateColorParameters
+    """
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.trueColors = np.array(cd.CameraTrax_24ColorCard)
+        matrix = np.array([[0.9, 0.05, 0.0],
+                           [0.02, 0.85, 0.03],
+                           [0.0, 0.1, 0.8]])
+        self.colors = 255 * np.power(
+            np.clip(np.dot(matrix, self.trueColors) / 255 + 0.02, 0, 1), 1.1)
+
+    def _error(self, params):
+        arg = np.concatenate([np.ravel(x) for x in params])
+        return np.sum(np.square(cd.getColorMatchingErrorVectorised(
+            arg, self.trueColors, self.colors)))
+
+    def test_estimate_warm_start(self):
+        """Test starting from the solution of a similar card"""
+        cold = cd.estimateColorParameters(self.trueColors, self.colors)
+        self.colors += np.random.RandomState(42).uniform(
+            -1, 1, self.colors.shape)
+        warm = cd.estimateColorParameters(self.trueColors, self.colors, cold)
+        self.assertEqual([x.shape for x in warm], [(3, 3), (3, 1), (3,)])
+        self.assertLess(self._error(warm), self._error(cold))
+        self.assertLess(self._error(warm), 1.05 * self._error(
+            cd.estimateColorParameters(self.trueColors, self.colors)))
+
+
+class TestCorrectColorTiled(TestCase):
+    """Tests for timestream.manipulate.correct_detect.correctColorTiled"""
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        rand = np.random.RandomState(42)
+        self.image = rand.randint(0, 256, (300, 200, 3)).astype(np.uint8)
+        self.matrix = np.array([[1.1, 0.05, -0.1],
+                                [0.02, 0.9, 0.03],
+                                [-0.05, 0.1, 1.2]])
+        self.constant = np.array([[-20.0], [5.0], [3.0]])
+        self.gamma = np.array([1.1, 0.9, 1.3])
+
+    def _expected(self):
+        with np.errstate(invalid="ignore"):
+            corrected = cd.correctColorVectorised(
+                self.image.astype(np.float), self.matrix, self.constant,
+                self.gamma)
+        # Negative values, which become NaN, are corrected to 0
+        corrected[np.isnan(corrected)] = 0
+        return np.clip(np.round(corrected), 0, 255).astype(np.uint8)
+
+    def test_correct_color_tiled(self):
+        """Test tiles, on threads or not, correct like the whole image"""
+        expected = self._expected()
+        for threads in [1, 3]:
+            corrected = cd.correctColorTiled(
+                self.image, self.matrix, self.constant, self.gamma,
+                TileRows=64, Threads=threads)
+            self.assertEqual(corrected.dtype, np.uint8)
+            np.testing.assert_array_equal(corrected, expected)
+
+    def test_color_thread_pool(self):
+        """Test the thread pool is kept until the number of threads changes"""
+        pool = cd._colorThreadPool(None)
+        self.assertIs(cd._colorThreadPool(None), pool)
+        self.assertIsNot(cd._colorThreadPool(2), pool)
+        # The threads of the previous pool are done
+        self.assertFalse(any(x.is_alive() for x in pool._pool))
+        self.assertIs(cd._colorThreadPool(2), cd._colorThreadPool(2))
+
+    def test_correct_color_tiled_in_place(self):
+        expected = self._expected()
+        out = cd.correctColorTiled(self.image, self.matrix, self.constant,
+                                   self.gamma, Out=self.image, TileRows=64)
+        self.assertIs(out, self.image)
+        np.testing.assert_array_equal(self.image, expected)
+
+    def test_correct_color_lut(self):
+        """Test the LUT of a diagonal matrix corrects like the matrix"""
+        self.assertIsNone(cd.correctColorLUT(self.matrix, self.constant,
+                                             self.gamma))
+        self.matrix = np.diag([1.2, 0.8, 1.05])
+        self.matrix[0, 1] = 1e-6
+        lut = cd.correctColorLUT(self.matrix, self.constant, self.gamma)
+        np.testing.assert_array_equal(cv2.LUT(self.image, lut),
+                                      self._expected())
+
+
+class TestUndistortMaps(TestCase):
+    """Tests for timestream.manipulate.correct_detect.undistortMaps"""
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.cameraMatrix = [[130.0, 0.0, 79.5],
+                             [0.0, 130.0, 59.5],
+                             [0.0, 0.0, 1.0]]
+        self.distortCoefs = [-0.166191, 0.142034, 0.0, 0.0, 0.0]
+        rand = np.random.RandomState(42)
+        self.image = rand.randint(0, 255, (120, 160, 3)).astype(np.uint8)
+        self.cacheDir = helpers.make_tmp_file()
+        os.mkdir(self.cacheDir)
+
+    def _remap(self, angle, cacheDir=None):
+        maps = cd.undistortMaps(self.cameraMatrix, self.distortCoefs,
+                                [160, 120], angle, CacheDir=cacheDir)
+        self.assertEqual(maps[0].dtype, np.int16)
+        return cv2.remap(self.image, maps[0], maps[1], cv2.INTER_CUBIC)
+
+    def test_undistort_rotated(self):
+        """Test the maps undistort and rotate like two separate passes"""
+        mapX, mapY = cv2.initUndistortRectifyMap(
+            np.array(self.cameraMatrix), np.array(self.distortCoefs), None,
+            np.array(self.cameraMatrix), (160, 120), cv2.CV_32FC1)
+        undistorted = cv2.remap(self.image, mapX, mapY, cv2.INTER_CUBIC)
+        for angle in [0, 90, 180]:
+            np.testing.assert_array_equal(
+                self._remap(angle), cd.rotateImage(undistorted, angle))
+
+    def test_undistort_rotated_border(self):
+        """Test pixels rotated in from outside the image, even partly, are
+        black"""
+        maps = cd.undistortMaps(self.cameraMatrix, self.distortCoefs,
+                                [160, 120], 30)
+        white = np.full((120, 160), 255, dtype=np.uint8)
+        outside = cd.rotateImage(white, 30) < 255
+        self.assertTrue(outside.any())
+        for interpolation in [cv2.INTER_NEAREST, cv2.INTER_CUBIC]:
+            rotated = cv2.remap(white, maps[0], maps[1], interpolation)
+            self.assertFalse(rotated[outside].any())
+            self.assertTrue(rotated[~outside].any())
+
+    def test_undistort_cached(self):
+        expected = self._remap(180)
+        np.testing.assert_array_equal(self._remap(180, self.cacheDir),
+                                      expected)
+        self.assertEqual(len(os.listdir(self.cacheDir)), 1)
+        np.testing.assert_array_equal(self._remap(180, self.cacheDir),
+                                      expected)
+        # Other calibrations have their own maps
+        self._remap(90, self.cacheDir)
+        self.assertEqual(len(os.listdir(self.cacheDir)), 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir)
@@ -0,0 +1,219 @@
+import cv2
+import numpy as np
+from unittest import TestCase
+
+from timestream import TimeStreamImage
+import timestream.manipulate.configuration as pipeconf
+import timestream.manipulate.correct_detect as cd
+import timestream.manipulate.pipecomponents as pc
+
+
+class PipeComponentTestcase(TestCase):
+    """Base for tests of components that read setting images, which are
+    served from ``self.settings`` instead of files."""
+
+    def setUp(self):
+        self.settings = {}
+        self._read_image = pc.read_image
+        pc.read_image = lambda path: self.settings[path].copy()
+        self.ctx = pipeconf.PCFGSection("--")
+        self.ctx.setVal("ints.path", "ts")
+        self.ctx.setVal("metas", pipeconf.PCFGSection("metas"))
+
+    def tearDown(self):
+        pc.read_image = self._read_image
+
+    def _texture(self, shape, seed):
+        rand = np.random.RandomState(seed)
+        image = rand.randint(0, 255, shape).astype(np.uint8)
+        return cv2.GaussianBlur(image, (5, 5), 2)
+
+    def _tsi(self, pixels):
+        tsi = TimeStreamImage()
+        tsi.pixels = pixels
+        return tsi
+
+
+class TestImageColorCorrector(PipeComponentTestcase):
+    """Tests for timestream.manipulate.pipecomponents.ImageColorCorrector"""
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        super(TestImageColorCorrector, self).setUp()
+        self.fov = [60, 45]
+        self.cc = pc.ImageColorCorrector(self.ctx, mess="",
+                                         fieldOfView=self.fov)
+
+    def _assertAdjusted(self, adjusted, image):
+        """Check ``adjusted`` is ``image`` adjusted for the field of view"""
+        rows, cols = image.shape[0:2]
+        W = 2.0 * np.tan(np.radians(self.fov[0]) / 2)
+        H = 2.0 * np.tan(np.radians(self.fov[1]) / 2)
+        angleX = np.arctan(W / cols * (np.arange(cols) - cols / 2))
+        angleY = np.arctan(H / rows * (np.arange(rows) - rows / 2))
+        angles = np.sqrt(angleX[np.newaxis, :] ** 2 +
+                         angleY[:, np.newaxis] ** 2)
+        expected = np.clip(
+            np.round(image / np.cos(angles)[:, :, np.newaxis]), 0, 255)
+        self.assertEqual(adjusted.dtype, np.uint8)
+        # The gain is float32, halves may be rounded the other way
+        np.testing.assert_allclose(adjusted, expected, rtol=0, atol=1)
+
+    def test_field_of_view(self):
+        """Test ImageColorCorrector adjusts for the field of view"""
+        noCorrection = (None, None, None)
+        # Rows not a multiple of the tiles, a corner saturating
+        image = self._texture((300, 200, 3), 42)
+        image[0:50, 0:50] = 250
+        tsi, = self.cc(self.ctx, self._tsi(image), noCorrection)
+        self._assertAdjusted(tsi.pixels, image)
+        self.assertListEqual(self.cc._fovGains.keys(), [(300, 200)])
+
+        # The gain is computed once per shape
+        gain = self.cc._fovGains[(300, 200)]
+        image = self._texture((300, 200, 3), 1)
+        tsi, = self.cc(self.ctx, self._tsi(image), noCorrection)
+        self._assertAdjusted(tsi.pixels, image)
+        self.assertIs(self.cc._fovGains[(300, 200)], gain)
+
+        image = self._texture((150, 260, 3), 2)
+        tsi, = self.cc(self.ctx, self._tsi(image), noCorrection)
+        self._assertAdjusted(tsi.pixels, image)
+        self.assertItemsEqual(self.cc._fovGains.keys(),
+                              [(300, 200), (150, 260)])
+
+
+class TestTrayDetector(PipeComponentTestcase):
+    """Tests for timestream.manipulate.pipecomponents.TrayDetector"""
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        super(TestTrayDetector, self).setUp()
+        self.image = self._texture((600, 800, 3), 42)
+        # Trays centered at (400, 300) and (200, 400)
+        self.settings["ts/set/Tray_00.png"] = self.image[240:360, 320:480]
+        self.settings["ts/set/Tray_01.png"] = self.image[340:460, 120:280]
+        self.det = pc.TrayDetector(
+            self.ctx, mess="", trayFiles="Tray_%02d.png", trayNumber=2,
+            trayPositions=[[396, 304], [204, 396]], settingPath="set",
+            tracking=True)
+
+    def _shifted(self, dx, dy, noise=0):
+        image = np.roll(np.roll(self.image, dy, axis=0), dx, axis=1)
+        if noise > 0:
+            rand = np.random.RandomState(0)
+            image = np.clip(image + rand.normal(0, noise, image.shape), 0,
+                            255).astype(np.uint8)
+        return image
+
+    def test_tracking_follows_shift(self):
+        """Test TrayDetector tracking follows trays shifted a little"""
+        _, _, locs = self.det(self.ctx, self._tsi(self.image))
+        self.assertListEqual(locs, [(400, 300), (200, 400)])
+        # A full search would not find the trays from these
+        self.det.trayPositions = [[100, 100], [700, 500]]
+        _, _, locs = self.det(self.ctx, self._tsi(self._shifted(4, 6)))
+        self.assertListEqual(locs, [(404, 306), (204, 406)])
+
+    def test_tracking_score_drop(self):
+        """Test TrayDetector searches fully when the tracked score drops"""
+        self.det(self.ctx, self._tsi(self.image))
+        scores = dict(self.det._trackScores)
+        image = self._shifted(4, 6, noise=20)
+
+        # Dropped less than trackingScoreDrop, the trays are tracked
+        _, _, locs = self.det(self.ctx, self._tsi(image))
+        self.assertListEqual(locs, [(404, 306), (204, 406)])
+        self.assertDictEqual(self.det._trackScores, scores)
+
+        # Dropped more, trays are searched around trayPositions
+        self.det.trackingScoreDrop = 0.0001
+        self.det._prevTrayLocs[0] = (450, 300)
+        _, _, locs = self.det(self.ctx, self._tsi(image))
+        self.assertListEqual(locs, [(404, 306), (204, 406)])
+        imagePyramid = cd.createImagePyramid(self.det.imagePyramid[0])
+        for i, trayPyramid in enumerate(self.det.trayPyramids):
+            score, loc, _ = cd.matchTemplatePyramid(
+                imagePyramid, trayPyramid, RotationAngle=0,
+                EstimatedLocation=self.det.trayPositions[i],
+                SearchRange=[26, 20])
+            self.assertEqual(loc, locs[i])
+            self.assertAlmostEqual(self.det._trackScores[i], score)
+            self.assertLess(self.det._trackScores[i], scores[i])
+
+
+class TestPotDetector(PipeComponentTestcase):
+    """Tests for timestream.manipulate.pipecomponents.PotDetector"""
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        super(TestPotDetector, self).setUp()
+        # A 4x5 grid of pots in a tray centered at (400, 300)
+        pot = self._texture((40, 40, 3), 1)
+        pot[:, :, 1] = 0
+        self.image = self._texture((600, 800, 3), 42) // 4
+        self.image[:, :, 1] = 0
+        # Matched locations are even, the last pyramid level being 1
+        self.potLocs = [(326 + 50 * k, 400 - 50 * l)
+                        for k in range(4) for l in range(5)]
+        for x, y in self.potLocs:
+            self.image[y - 20:y + 20, x - 20:x + 20] = pot
+        self.settings["ts/set/Pot.png"] = pot
+        self.settings["ts/set/PotTemplate.png"] = pot
+        self.det = pc.PotDetector(
+            self.ctx, mess="", potFile="Pot.png",
+            potTemplateFile="PotTemplate.png", potPositions=[],
+            potSize=[50, 50], traySize=[200, 250], settingPath="set",
+            tracking=True)
+
+    def _detect(self, image, trayLocs):
+        tsi = self._tsi(image)
+        self.det(self.ctx, tsi, cd.createImagePyramid(image), trayLocs)
+        return tsi
+
+    def test_tracking_follows_shift(self):
+        """Test PotDetector tracking follows pots shifted a little"""
+        self._detect(self.image, [(400, 300)])
+        self.assertListEqual(self.det._prevPotLocs[0], self.potLocs)
+        image = np.roll(np.roll(self.image, 6, axis=0), 4, axis=1)
+        # Far from where a full search starts
+        tsi = self._detect(image, [(300, 200)])
+        self.assertListEqual(self.det._prevPotLocs[0],
+                             [(x + 4, y + 6) for x, y in self.potLocs])
+        self.assertEqual(len(tsi.ipm.potIds), 20)
+
+    def test_tracking_score_drop(self):
+        """Test PotDetector searches fully for pots whose score drops"""
+        self._detect(self.image, [(400, 300)])
+        scores = list(self.det._trackScores[0])
+        # Pot 7 is lost, the others move a little
+        image = np.roll(self.image, 4, axis=1)
+        x, y = self.potLocs[7]
+        image[y - 16:y + 24, x - 16:x + 24] = self._texture((40, 40, 3), 2)
+        self._detect(image, [(400, 300)])
+
+        locs = self.det._prevPotLocs[0]
+        newScores = self.det._trackScores[0]
+        for j, (x, y) in enumerate(self.potLocs):
+            if j == 7:
+                continue
+            self.assertEqual(locs[j], (x + 4, y))
+            self.assertEqual(newScores[j], scores[j])
+        # Pot 7 is searched from its location estimated from the tray's
+        (score, ), (loc, ) = cd.matchTemplatePyramidBatch(
+            cd.createImagePyramid(image), self.det.potPyramid,
+            [[375, 300]], NoLevels=3, SearchRange=[10, 10])
+        self.assertEqual(locs[7], loc)
+        self.assertAlmostEqual(newScores[7], score)
+        self.assertLess(newScores[7], scores[7])
+
+    def test_missing_tray(self):
+        """Test PotDetector skips trays that were not found"""
+        for i in range(2):
+            tsi = self._detect(self.image, [None, (400, 300)])
+            self.assertIsNone(self.det.potLocs2[0])
+            self.assertNotIn(0, self.det._prevPotLocs)
+            self.assertNotIn(0, self.det._trackScores)
+            self.assertListEqual(self.det._prevPotLocs[1], self.potLocs)
+            # Pot ids of the missing tray are not reused
+            self.assertListEqual(sorted(tsi.ipm.potIds), range(21, 41))
@@ -0,0 +1,191 @@
+import cv2
+import numpy as np
+from scipy import ndimage
+from skimage.measure import label, regionprops
+from unittest import TestCase
+
+import timestream.manipulate.plantSegmenter as tm_ps
+
+
+class TestStatParamCalculator(TestCase):
+    """Tests for timestream.manipulate.plantSegmenter.StatParamCalculator"""
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.mask = np.zeros((40, 50), dtype=np.float64)
+        self.mask[10:30, 5:25] = 1
+        self.mask[15:20, 25:45] = 1
+
+    def test_region_features(self):
+        """Test the region features of a mask share one regionprops"""
+        calls = []
+        regionprops = tm_ps.regionprops
+
+        def counted(*args, **kwargs):
+            calls.append(args)
+            return regionprops(*args, **kwargs)
+        tm_ps.regionprops = counted
+        try:
+            fc = tm_ps.StatParamCalculator()
+            feats = dict((name, getattr(fc, name)(self.mask).value)
+                         for name in ["area", "perimeter", "roundness",
+                                      "compactness", "eccentricity", "rms",
+                                      "height"])
+        finally:
+            tm_ps.regionprops = regionprops
+        self.assertEqual(len(calls), 1)
+        region = regionprops(self.mask.astype("int8"))[0]
+        self.assertEqual(feats["area"], 500)
+        self.assertEqual(feats["perimeter"], region["Perimeter"])
+        self.assertAlmostEqual(feats["roundness"],
+                               4 * np.pi * 500 / region["Perimeter"] ** 2)
+        self.assertEqual(feats["compactness"], region["Solidity"])
+        self.assertEqual(feats["eccentricity"], region["Eccentricity"])
+        self.assertAlmostEqual(feats["rms"], 1 - region["Eccentricity"] ** 2)
+        self.assertEqual(feats["height"], 20)
+
+    def test_empty_mask(self):
+        fc = tm_ps.StatParamCalculator()
+        mask = np.zeros((10, 10))
+        self.assertEqual(fc.area(mask).value, 0.0)
+        self.assertEqual(fc.height(mask).value, 0.0)
+        self.assertEqual(fc.compactness(mask).value, fc.errStr)
+
+    def test_row_features(self):
+        """Test the 5%, 50% and 95% rows of the green pixels"""
+        fc = tm_ps.StatParamCalculator()
+        # 500 green pixels, 20 in each row from 10 to 29 and 20 more in
+        # rows 15 to 19
+        self.assertEqual(fc.height2(self.mask).value, 28 - 11)
+        self.assertEqual(fc.wilting(self.mask).value, 29.0 - 18)
+        self.assertEqual(fc.wilting2(self.mask).value, 0.0)
+        mask = np.zeros((10, 10))
+        self.assertEqual(fc.height2(mask).value, 0.0)
+        self.assertEqual(fc.wilting(mask).value, 0.0)
+        self.assertEqual(fc.wilting2(mask).name, "wilting")
+
+    def test_leafcount1(self):
+        """Test leaf centres are those of the per-component pruning"""
+        fc = tm_ps.StatParamCalculator()
+        mask = np.zeros((40, 60))
+        mask[5:16, 5:16] = 1
+        mask[20:35, 30:45] = 1
+        leaves = fc.leafcount1(mask)
+        self.assertEqual(leaves.value, 2)
+        self.assertEqual(sorted(leaves.centers), [(10.0, 10.0), (37.0, 27.0)])
+        rand = np.random.RandomState(3)
+        for i in range(10):
+            mask = ndimage.binary_opening(rand.rand(80, 90) < 0.6)
+            leaves = fc.leafcount1(mask.astype(np.float64))
+            self.assertEqual(leaves.centers, self._leafCenters(mask))
+
+    def _leafCenters(self, mask):
+        """Leaf centres as found by pruning each component in turn"""
+        dt = cv2.distanceTransform(mask.astype("uint8"), cv2.DIST_C, 5)
+        sel = np.ones([3, 3]).astype("uint8")
+        sel[1, 1] = 0
+        maximas = dt - cv2.dilate(dt.astype("uint8"), sel)
+        maximas = ((maximas >= 0) & (mask != 0)).astype(np.float64)
+        cc, ccNum = label(maximas, return_num=True)
+        sel = np.ones([3, 3]).astype("uint8")
+        for i in range(1, ccNum):
+            ccmsk = (cc == i).astype("float32")
+            ccCoords = np.where(ccmsk == 1)
+            perim = cv2.dilate(ccmsk, sel) - ccmsk
+            if np.min(dt[ccCoords]) <= np.max(dt[np.where(perim == 1)]):
+                cc[ccCoords] = 0
+        return [(rp["centroid"][1], rp["centroid"][0])
+                for rp in regionprops(cc)]
+
+
+class FailingSegmenter(tm_ps.PotSegmenter_Method1):
+    """Fails to segment pots with dark corners"""
+
+    def segment(self, img, hints):
+        if img[0, 0, 0] < 128:
+            raise ValueError("dark corner")
+        return super(FailingSegmenter, self).segment(img, hints)
+
+
+class TestSegmentingPool(TestCase):
+    """Tests for timestream.manipulate.plantSegmenter.SegmentingPool"""
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        rand = np.random.RandomState(7)
+        self.pixels = rand.randint(0, 255, (120, 160, 3)).astype(np.uint8)
+        self.rects = [(i, [x, y, x + 40, y + 40])
+                      for i, (x, y) in enumerate([(0, 0), (40, 0), (80, 40),
+                                                  (120, 80)])]
+
+    def test_segment(self):
+        """Test masks are those of the segmenter, with its dtype"""
+        segmenter = tm_ps.PotSegmenter_Method1(blobMinSize=10)
+        pool = tm_ps.SegmentingPool(segmenter, 2)
+        try:
+            for pixels in [self.pixels, self.pixels[::-1].copy()]:
+                res = pool.segment(pixels, self.rects)
+                self.assertEqual(sorted(r[0] for r in res), [0, 1, 2, 3])
+                for key, msk, err in res:
+                    x, y, x2, y2 = self.rects[key][1]
+                    expected, _ = segmenter.segment(pixels[y:y2, x:x2], {})
+                    self.assertIsNone(err)
+                    self.assertEqual(msk.dtype, expected.dtype)
+                    np.testing.assert_array_equal(msk, expected)
+        finally:
+            pool.close()
+
+    def test_segment_failures(self):
+        """Test pots that fail are reported with their error"""
+        pool = tm_ps.SegmentingPool(FailingSegmenter(blobMinSize=10), 2)
+        try:
+            res = dict((r[0], r[1:]) for r in pool.segment(self.pixels,
+                                                           self.rects))
+        finally:
+            pool.close()
+        for key, rect in self.rects:
+            msk, err = res[key]
+            if self.pixels[rect[1], rect[0], 0] < 128:
+                self.assertIsNone(msk)
+                self.assertEqual(err, "ValueError: dark corner")
+            else:
+                self.assertIsNone(err)
+                self.assertEqual(msk.shape, (40, 40))
+
+
+class TestPotSegmenterKmeansFrame(TestCase):
+    """Tests for timestream.manipulate.plantSegmenter.PotSegmenter_KmeansFrame
+    """
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        rand = np.random.RandomState(5)
+        self.img = np.empty((200, 300, 3), dtype=np.float64)
+        self.img[:] = (40, 70, 110)
+        self.img += rand.normal(0, 8, self.img.shape)
+        self.img = np.clip(self.img, 0, 255).astype(np.uint8)
+        self.rects = []
+        self.radius = {}
+        for key, (x, y) in enumerate([(0, 0), (100, 0), (200, 100)]):
+            self.radius[key] = 15 + 5 * key
+            cv2.circle(self.img, (x + 50, y + 50), self.radius[key],
+                       (40, 160, 50), -1)
+            # Pots overlap
+            self.rects.append((key, [x, y, min(x + 110, 300), y + 100]))
+
+    def test_segment_frame(self):
+        """Test every pot mask is sliced from a k-means of the frame"""
+        seg = tm_ps.PotSegmenter_KmeansFrame()
+        masks = seg.segmentFrame(self.img, self.rects)
+        self.assertEqual(sorted(masks.keys()), [0, 1, 2])
+        for key, rect in self.rects:
+            msk = masks[key]
+            self.assertEqual(msk.shape, (rect[3] - rect[1], rect[2] - rect[0]))
+            self.assertEqual(msk[50, 50], 1)
+            self.assertAlmostEqual(msk.sum() / (np.pi * self.radius[key] ** 2),
+                                   1, delta=0.05)
+        # The next frame starts from the centers of this one
+        again = seg.segmentFrame(self.img, self.rects)
+        for key, rect in self.rects:
+            np.testing.assert_array_equal(again[key], masks[key])
+        self.assertEqual(seg.segmentFrame(self.img, []), {})
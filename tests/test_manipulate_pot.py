@@ -0,0 +1,65 @@
+import numpy as np
+from unittest import TestCase
+
+from timestream import TimeStreamImage
+import timestream.manipulate.plantSegmenter as tm_ps
+import timestream.manipulate.pot as tm_pot
+
+
+class TestImagePotMatrixRender(TestCase):
+    """Tests for rendering the pots of timestream.manipulate.pot"""
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        rand = np.random.RandomState(42)
+        self.img = TimeStreamImage()
+        self.img.pixels = rand.randint(1, 255, (120, 160, 3)).astype(np.uint8)
+        self.orig = self.img.pixels.copy()
+        self.ipm = tm_pot.ImagePotMatrix(self.img, pots=[])
+        for potID, rect in enumerate([[10, 10, 60, 50], [40, 30, 100, 90]]):
+            iph = tm_pot.ImagePotHandler(
+                potID, tm_pot.ImagePotRectangle(rect, self.orig.shape),
+                self.ipm)
+            iph._mask = (rand.rand(rect[3] - rect[1], rect[2] - rect[0]) >
+                         0.5).astype(np.float64)
+            self.ipm.addPot(iph)
+        self.img.ipm = self.ipm
+
+    def test_get_image_masked(self):
+        pot = self.ipm.getPot(0)
+        masked = pot.getImage(masked=True)
+        expected = self.orig[10:50, 10:60] * (pot.mask > 0)[:, :, None]
+        np.testing.assert_array_equal(masked, expected)
+        out = np.empty_like(self.orig)
+        self.assertIs(pot.getImage(masked=True, inSuper=True, out=out), out)
+        self.assertTrue((out[10:50, 10:60] == expected).all())
+        self.assertTrue((out[60:, 60:] == self.orig[60:, 60:]).all())
+        np.testing.assert_array_equal(self.img.pixels, self.orig)
+
+    def test_render_masked(self):
+        """Test all pots are masked in one image, in order"""
+        expected = self.orig.copy()
+        for potID in [0, 1]:
+            pot = self.ipm.getPot(potID)
+            r = pot.rect
+            expected[r[1]:r[3], r[0]:r[2]] *= (pot.mask > 0)[:, :, None]
+        np.testing.assert_array_equal(self.ipm.render_masked(), expected)
+        out = np.empty_like(self.orig)
+        self.assertIs(self.ipm.render_masked(out), out)
+        np.testing.assert_array_equal(out, expected)
+        np.testing.assert_array_equal(self.img.pixels, self.orig)
+
+    def test_seg_error(self):
+        """Test pots that failed segmentation have no mask nor features"""
+        pot = self.ipm.getPot(1)
+        pot.segError = "ValueError: dark corner"
+        self.assertEqual(pot.mask.sum(), 0)
+        pot.calcFeatures(["area", "height"])
+        for feat in pot.getCalcedFeatures().values():
+            self.assertEqual(feat.value, tm_ps.StatParamCalculator.errStr)
+        msk = np.ones((60, 60))
+        pot.mask = msk
+        self.assertIs(pot.mask, msk)
+        self.assertIsNone(pot.segError)
+        self.assertEqual(pot.getCalcedFeatures(), {})
+        self.assertRaises(ValueError, setattr, pot, "mask", np.ones((5, 5)))
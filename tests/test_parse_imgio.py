@@ -0,0 +1,108 @@
+import numpy as np
+import os
+from unittest import TestCase
+
+from tests import helpers
+from timestream.parse import (
+    RIException,
+    read_image,
+    save_image,
+)
+from timestream.parse.imgio import (
+    _readers,
+    _writers,
+    dct_reduction,
+    get_image_backend,
+    image_backends,
+    image_shape,
+    set_image_backend,
+)
+
+
+class TestImageBackends(TestCase):
+    """Tests for timestream.parse.imgio"""
+
+    def setUp(self):
+        self.readers = dict(_readers)
+        self.writers = dict(_writers)
+        self.tmp_path = helpers.make_tmp_file() + ".png"
+        # Distinct colour channels, so any swap of them shows
+        self.pixels = np.zeros((10, 20, 3), dtype=np.uint8)
+        self.pixels[:, :, 0] = 200
+        self.pixels[:, 0:10, 1] = 100
+
+    def test_rgb_order(self):
+        """Test every backend reads and writes RGB"""
+        backends = image_backends()
+        self.assertIn("opencv", backends)
+        for writer in backends:
+            save_image(self.tmp_path, self.pixels, backend=writer)
+            for reader in backends:
+                np.testing.assert_array_equal(
+                    read_image(self.tmp_path, backend=reader), self.pixels)
+
+    def test_set_image_backend(self):
+        set_image_backend("opencv", ext="PNG", write=False)
+        self.assertEqual(get_image_backend(self.tmp_path).name, "opencv")
+        self.assertEqual(get_image_backend("a.jpg").name, self.readers[None])
+        self.assertEqual(get_image_backend(self.tmp_path, write=True).name,
+                         self.writers[None])
+        set_image_backend("pil")
+        self.assertEqual(get_image_backend(self.tmp_path).name, "pil")
+        self.assertEqual(get_image_backend("a.jpg", write=True).name, "pil")
+        with self.assertRaises(ValueError):
+            set_image_backend("nonexistent")
+
+    def test_read_missing(self):
+        for backend in image_backends():
+            with self.assertRaises(RIException):
+                read_image("nonexistant_image.png", backend=backend)
+
+    def test_image_shape(self):
+        jpg_path = helpers.make_tmp_file() + ".jpg"
+        try:
+            save_image(jpg_path, np.zeros((100, 161, 3), dtype=np.uint8),
+                       backend="opencv")
+            self.assertEqual(image_shape(jpg_path), (100, 161))
+            self.assertEqual(dct_reduction(jpg_path), 1)
+            self.assertEqual(dct_reduction(jpg_path, scale=0.25), 4)
+            self.assertEqual(dct_reduction(jpg_path, scale=0.3), 2)
+            self.assertEqual(dct_reduction(jpg_path, shape=(13, 21)), 8)
+            self.assertEqual(dct_reduction(jpg_path, shape=(13, 22)), 4)
+            save_image(self.tmp_path, self.pixels)
+            self.assertIs(image_shape(self.tmp_path), None)
+            self.assertEqual(dct_reduction(self.tmp_path, scale=0.1), 1)
+        finally:
+            os.remove(jpg_path)
+
+    def test_reduced_read(self):
+        """Test JPEGs are decoded at a reduced size, other images not"""
+        jpg_path = helpers.make_tmp_file() + ".jpg"
+        pixels = np.zeros((100, 161, 3), dtype=np.uint8)
+        pixels[:, :, 0] = 200
+        try:
+            save_image(jpg_path, pixels, backend="opencv")
+            # The default reader can't, it falls back to one that can
+            backends = [None] + [
+                x for x in image_backends()
+                if get_image_backend(jpg_path, name=x).reduces]
+            for backend in backends:
+                red = read_image(jpg_path, backend=backend, scale=0.25)
+                self.assertEqual(red.shape, (25, 41, 3))
+                self.assertGreater(red[:, :, 0].mean(), 190)
+                self.assertLess(red[:, :, 2].mean(), 10)
+                red = read_image(jpg_path, backend=backend, scale=0.3)
+                self.assertEqual(red.shape, (50, 81, 3))
+            save_image(self.tmp_path, self.pixels)
+            red = read_image(self.tmp_path, backend="opencv", scale=0.25)
+            self.assertEqual(red.shape, self.pixels.shape)
+        finally:
+            os.remove(jpg_path)
+
+    def tearDown(self):
+        _readers.clear()
+        _readers.update(self.readers)
+        _writers.clear()
+        _writers.update(self.writers)
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
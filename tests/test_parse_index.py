@@ -0,0 +1,132 @@
+import datetime as dt
+import os
+from os import path
+import shutil
+import skimage.io
+from unittest import TestCase
+
+from tests import helpers
+from timestream.parse import (
+    ts_guess_manifest_v1,
+)
+from timestream.parse.index import (
+    TimestampIndex,
+    ts_index_files,
+    ts_index_path,
+    ts_read_index,
+    ts_update_index,
+)
+
+
+class TestUpdateIndex(TestCase):
+    """Tests for timestream.parse.index.ts_update_index"""
+    _multiprocess_can_split_ = True
+    maxDiff = None
+
+    def setUp(self):
+        self.ts_path = path.join(helpers.TMPDIR, "indexts")
+        helpers.imgs_common_tsdir("setup", self.ts_path, skip=[("04", "30")])
+        self.relpaths = [path.relpath(x, helpers.FILES["timestream"])
+                         for x in helpers.TS_FILES_JPG]
+        self.relpaths = [x.replace("good-timestream", "indexts")
+                         for x in self.relpaths]
+        self.relpaths.remove(self.relpaths[3])
+
+    def test_build(self):
+        self.assertIsNone(ts_read_index(self.ts_path))
+        index = ts_update_index(self.ts_path)
+        self.assertListEqual(ts_index_files(index), self.relpaths)
+        self.assertTrue(path.isfile(ts_index_path(self.ts_path)))
+        self.assertDictEqual(ts_read_index(self.ts_path), index)
+
+    def test_incremental(self):
+        index = ts_update_index(self.ts_path)
+        mtime = os.stat(ts_index_path(self.ts_path)).st_mtime
+        # Nothing changed, the index on disk is left alone
+        self.assertDictEqual(ts_update_index(self.ts_path), index)
+        self.assertEqual(os.stat(ts_index_path(self.ts_path)).st_mtime,
+                         mtime)
+        # A new image lands
+        newimg = path.join(self.ts_path, "2013", "2013_10", "2013_10_30",
+                           "2013_10_30_04",
+                           "indexts_2013_10_30_04_30_00_00.JPG")
+        skimage.io.imsave(newimg, helpers.ZEROS_PIXELS)
+        index = ts_update_index(self.ts_path)
+        self.assertIn(path.relpath(newimg, self.ts_path),
+                      ts_index_files(index))
+        self.assertEqual(len(ts_index_files(index)), 8)
+        # And an image is removed
+        os.remove(newimg)
+        index = ts_update_index(self.ts_path)
+        self.assertListEqual(ts_index_files(index), self.relpaths)
+
+    def test_manifest_from_index(self):
+        index = ts_update_index(self.ts_path)
+        got = ts_guess_manifest_v1(self.ts_path, index=index)
+        self.assertEqual(got["name"], "indexts")
+        self.assertEqual(got["extension"], "JPG")
+        self.assertEqual(got["start_datetime"], "2013_10_30_03_00_00")
+        self.assertEqual(got["end_datetime"], "2013_10_30_06_30_00")
+        self.assertEqual(got["interval"], 30 * 60)
+
+    def test_bad_index(self):
+        ts_update_index(self.ts_path)
+        with open(ts_index_path(self.ts_path), "w") as ofh:
+            ofh.write("{not json")
+        self.assertIsNone(ts_read_index(self.ts_path))
+        index = ts_update_index(self.ts_path)
+        self.assertListEqual(ts_index_files(index), self.relpaths)
+
+    def tearDown(self):
+        shutil.rmtree(self.ts_path)
+
+
+class TestTimestampIndex(TestCase):
+    """Tests for timestream.parse.index.TimestampIndex"""
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.times = helpers.TS_GAPS_DATES_PARSED
+        self.tsi = TimestampIndex(reversed(self.times))
+
+    def test_index(self):
+        self.assertEqual(len(self.tsi), len(self.times))
+        self.assertListEqual(list(self.tsi), self.times)
+        for iii, time in enumerate(self.times):
+            self.assertIn(time, self.tsi)
+            self.assertEqual(self.tsi.index(time), iii)
+            self.assertEqual(self.tsi[iii], time)
+        self.assertNotIn(dt.datetime(2013, 10, 30, 4, 30), self.tsi)
+        self.assertNotIn("2013_10_30_03_00_00", self.tsi)
+        with self.assertRaises(ValueError):
+            self.tsi.index(dt.datetime(2013, 10, 30, 4, 30))
+
+    def test_floor_ceil(self):
+        time = dt.datetime(2013, 10, 30, 4, 40)
+        self.assertEqual(self.tsi.floor(time), dt.datetime(2013, 10, 30, 4))
+        self.assertEqual(self.tsi.ceil(time), dt.datetime(2013, 10, 30, 5))
+        self.assertEqual(self.tsi.floor(self.times[2]), self.times[2])
+        self.assertEqual(self.tsi.ceil(self.times[2]), self.times[2])
+        self.assertIsNone(self.tsi.floor(dt.datetime(2013, 10, 30, 2)))
+        self.assertIsNone(self.tsi.ceil(dt.datetime(2013, 10, 30, 7)))
+
+    def test_nearest(self):
+        for hour, minute, expt in [(4, 40, 5), (4, 20, 4), (4, 30, 4),
+                                   (1, 0, 3), (9, 0, 6)]:
+            got = self.tsi.nearest(dt.datetime(2013, 10, 30, hour, minute))
+            self.assertEqual(got.hour, expt)
+        self.assertIsNone(TimestampIndex().nearest(self.times[0]))
+
+    def test_range(self):
+        got = self.tsi.range(dt.datetime(2013, 10, 30, 3, 30),
+                             dt.datetime(2013, 10, 30, 5, 0))
+        self.assertListEqual(got, self.times[1:4])
+        got = self.tsi.range(dt.datetime(2013, 10, 30, 4, 10),
+                             dt.datetime(2013, 10, 30, 4, 50))
+        self.assertListEqual(got, [])
+
+    def test_bad_params(self):
+        with self.assertRaises(TypeError):
+            self.tsi.nearest("2013_10_30_03_00_00")
+        with self.assertRaises(TypeError):
+            self.tsi.range(None, self.times[0])
@@ -0,0 +1,78 @@
+import datetime as dt
+import numpy as np
+import os
+from unittest import TestCase
+
+from tests import helpers
+from timestream.parse.potdata import (
+    PotDataStore,
+)
+
+
+class TestPotDataStore(TestCase):
+    """Tests for timestream.parse.potdata.PotDataStore"""
+    _multiprocess_can_split_ = True
+    maxDiff = None
+
+    def setUp(self):
+        self.db_path = helpers.make_tmp_file() + ".sqlite"
+        if os.path.exists(self.db_path):
+            os.remove(self.db_path)
+        self.store = PotDataStore(self.db_path)
+        self.times = [dt.datetime(2013, 10, 30, h, 0) for h in range(3, 7)]
+        self.pots = [
+            {"id": 1, "rect": [0, 0, 10, 10], "metaids": {"plant": "Col-0"},
+             "features": {"area": ("area", 12.0, 0.0, float("Inf")),
+                          "gcc": ("ColorGCC", "NaN", 0.0, 1.0)}},
+            {"id": 2, "rect": [10, 0, 20, 10], "metaids": {"chamber": 3},
+             "features": {"area": ("area", 34.0, 0.0, float("Inf"))}},
+        ]
+        for time in self.times:
+            self.store.write(time, (10, 20), self.pots)
+
+    def test_read(self):
+        got = self.store.read(self.times[0])
+        self.assertEqual(got[0], (10, 20))
+        self.assertListEqual(got[1], self.pots)
+        self.assertIsNone(self.store.read(dt.datetime(2013, 10, 30, 2, 0)))
+
+    def test_read_range(self):
+        got = self.store.read_range(self.times[1], self.times[2])
+        self.assertListEqual(sorted(got.keys()), helpers.TS_DATES[2:5:2])
+        self.assertEqual(len(self.store.read_range()), 4)
+        self.assertListEqual(self.store.timestamps(end=self.times[1]),
+                             helpers.TS_DATES[0:3:2])
+
+    def test_read_feature(self):
+        tstrs, potIds, values = self.store.read_feature("area")
+        self.assertEqual(len(tstrs), 8)
+        self.assertListEqual(list(potIds), [1, 2] * 4)
+        self.assertListEqual(list(values), [12.0, 34.0] * 4)
+        tstrs, potIds, values = self.store.read_feature(
+            "gcc", start=self.times[3])
+        self.assertListEqual(list(tstrs), [helpers.TS_DATES[6]])
+        self.assertTrue(np.isnan(values[0]))
+
+    def test_read_nan(self):
+        pots = [{"id": 1, "rect": [0, 0, 10, 10], "metaids": {},
+                 "features": {"gcc": ("ColorGCC", float("nan"), 0.0, 1.0)}}]
+        self.store.write(self.times[0], (10, 20), pots)
+        name, val, rMin, rMax = \
+            self.store.read(self.times[0])[1][0]["features"]["gcc"]
+        self.assertEqual((name, rMin, rMax), ("ColorGCC", 0.0, 1.0))
+        self.assertIsInstance(val, float)
+        self.assertTrue(np.isnan(val))
+
+    def test_rewrite(self):
+        self.store.write(self.times[0], (10, 20), self.pots[0:1])
+        self.assertListEqual(self.store.read(self.times[0])[1],
+                             self.pots[0:1])
+        # A new instance sees the same data
+        self.store.close()
+        store = PotDataStore(self.db_path)
+        self.assertListEqual(store.read(self.times[1])[1], self.pots)
+        store.close()
+
+    def tearDown(self):
+        self.store.close()
+        os.remove(self.db_path)
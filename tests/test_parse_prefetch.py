@@ -0,0 +1,66 @@
+import numpy as np
+from os import path
+from unittest import TestCase
+
+from tests import helpers
+from timestream.parse import (
+    read_image,
+)
+from timestream.parse.prefetch import (
+    ImagePrefetcher,
+)
+
+
+class TestImagePrefetcher(TestCase):
+    """Tests for timestream.parse.prefetch.ImagePrefetcher"""
+    _multiprocess_can_split_ = True
+
+    @classmethod
+    def setUpClass(cls):
+        helpers.imgs_common_tsdir("setup", helpers.FILES["timestream"])
+        cls.paths = [path.join(helpers.TESTS_DIR, "data", x)
+                     for x in helpers.TS_FILES_JPG]
+
+    def setUp(self):
+        self.pf = ImagePrefetcher(depth=3)
+
+    def test_take(self):
+        self.pf.schedule(self.paths[0:3])
+        for fpath in self.paths[0:3]:
+            pixels = self.pf.take(fpath)
+            np.testing.assert_array_equal(pixels, read_image(fpath))
+        # Taken images are forgotten
+        self.assertIsNone(self.pf.take(self.paths[0]))
+        self.assertIsNone(self.pf.take(self.paths[4]))
+
+    def test_depth(self):
+        self.pf.schedule(self.paths)
+        self.assertListEqual(self.pf._entries.keys(), self.paths[0:3])
+        # Dropped when no longer upcoming
+        self.pf.schedule(self.paths[2:4] + [None])
+        self.assertListEqual(self.pf._entries.keys(), self.paths[2:4])
+        self.assertIsNone(self.pf.take(self.paths[0]))
+
+    def test_max_mb(self):
+        self.pf = ImagePrefetcher(depth=3, max_mb=0.011)
+        # One image at a time until we know their size
+        self.pf.schedule(self.paths)
+        self.assertEqual(len(self.pf._entries), 1)
+        self.assertIsNotNone(self.pf.take(self.paths[0]))
+        # 35x52x3 bytes each, so two fit in 0.011 MB
+        self.pf.schedule(self.paths[1:])
+        self.assertListEqual(self.pf._entries.keys(), self.paths[1:3])
+
+    def test_bad_image(self):
+        self.pf.schedule([path.join(helpers.TMPDIR, "nonexistent.jpg")])
+        self.pf.close()
+        self.assertIsNone(self.pf.take(self.paths[0]))
+        with self.assertRaises(ValueError):
+            ImagePrefetcher(depth=0)
+
+    def tearDown(self):
+        self.pf.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        helpers.imgs_common_tsdir("teardown", helpers.FILES["timestream"])
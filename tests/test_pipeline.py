@@ -18,15 +18,12 @@ import sys
 import os
 import os.path
 import warnings
-import pickle
-import numpy
 
 from unittest import TestCase
 from tests import helpers
 sys.path.insert(0, "./scripts")
 from run_pipeline import maincli
-from timestream import TimeStreamImage
-from timestream.manipulate.pot import ImagePotMatrix
+from timestream.parse.potdata import POT_DATA_FILE, PotDataStore
 
 
 class TestSimplePipelineRun(TestCase):
@@ -48,7 +45,7 @@ class TestSimplePipelineRun(TestCase):
                             '--recalculate': False, '--set': None,
                             '-i': helpers.FILES["timestream_good_images"],
                             '-o': None, '-p': None, '-s': True, '-t': None,
-                            '-v': 0}
+                            '-v': 0, '--workers': '1'}
         self.outdirs = []
         for suf in ["cor", "seg"]:
             self.outdirs.append(os.path.join(
@@ -56,8 +53,7 @@ class TestSimplePipelineRun(TestCase):
                 "timestream-good-" + suf))
 
         self.outimgs = []
-        self.segpickles = []
-        self.corpickles = []
+        self.timestamps = []
         for suf in ["cor", "seg"]:
             for _day, _min in [("28", "30"), ("29", "00")]:
                 d1 = os.path.join(helpers.TESTS_DIR, "data", "timestreams",
@@ -67,16 +63,11 @@ class TestSimplePipelineRun(TestCase):
                 i = "timestream-good-" + suf + "_2014_06_" + _day + "_12_" \
                     + _min + "_00_00"
                 iName = i + ".jpg"
-                pName = i + ".p"
 
                 self.outimgs.append(os.path.join(d1, d2, iName))
-
                 if suf == "cor":
-                    self.corpickles.append(os.path.join(d1, "_data",
-                                                        d2, pName))
-                elif suf == "seg":
-                    self.segpickles.append(os.path.join(d1, "_data",
-                                                        d2, pName))
+                    self.timestamps.append(
+                        "2014_06_" + _day + "_12_" + _min + "_00")
 
         self.csv = os.path.join(helpers.TESTS_DIR, "data", "timestreams",
                                 "timestream-good-csv")
@@ -106,25 +97,46 @@ class TestSimplePipelineRun(TestCase):
             self.assertTrue(os.path.isfile(
                 os.path.join(self.csv, "timestream-good-" + f + ".csv")))
 
-        # We produce the pickle files for each image. and they are usable
-        for p in self.corpickles + self.segpickles:
-            self.assertTrue(os.path.isfile(p))
-            f = file(p, "r")
-            obj = pickle.load(f)
-            f.close()
-            self.assertTrue(isinstance(obj, TimeStreamImage))
-            self.assertTrue(isinstance(obj.ipm, ImagePotMatrix))
-            for pid in range(1, 161):
-                self.assertTrue(pid, obj.ipm.potIds[pid - 1])
-
-        # We actually segment the images.
-        for seg in self.segpickles:
-            f = file(p, "r")
-            obj = pickle.load(f)
-            f.close()
-            for pid in range(1, 161):
-                P = obj.ipm.getPot(1)
-                self.assertTrue(isinstance(P.mask, numpy.ndarray))
+        # We store the pots of each image. and they are usable
+        for d in self.outdirs:
+            store = PotDataStore(os.path.join(d, "_data", POT_DATA_FILE))
+            self.assertTrue(os.path.isfile(store.path))
+            records = store.read_range()
+            self.assertListEqual(sorted(records.keys()), self.timestamps)
+            for imgSize, pots in records.values():
+                self.assertListEqual([x["id"] for x in pots],
+                                     range(1, 161))
+                # We actually segment the images.
+                if d.endswith("seg"):
+                    for pot in pots:
+                        self.assertIn("area", pot["features"])
+            store.close()
+
+    def test_parallel_run(self):
+        opts = dict(self.simple_opts)
+        opts["--workers"] = "2"
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            maincli(opts)
+
+        for i in self.outimgs:
+            self.assertTrue(os.path.isfile(i))
+
+        # Parts are merged into the usual files, rows in timestamp order
+        self.assertListEqual(
+            sorted(os.listdir(self.csv)),
+            sorted(["timestream-good-" + f + ".csv" for f in self.features]))
+        for f in self.features:
+            fPath = os.path.join(self.csv, "timestream-good-" + f + ".csv")
+            with open(fPath) as fd:
+                lines = fd.readlines()
+            if f == "audit":
+                lines = [l for l in lines if l[0:4] == "2014"]
+            else:
+                self.assertTrue(lines[0].startswith("timestamp,"))
+                lines = lines[1:]
+            self.assertListEqual([l.split(",")[0] for l in lines],
+                                 [x + "_00" for x in self.timestamps])
 
     def tearDown(self):
         for top in self.outdirs + [self.csv]:
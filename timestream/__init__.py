@@ -24,14 +24,16 @@
 .. moduleauthor:: Kevin Murray, Joel Granados, Chuong Nguyen
 """
 
+from collections import deque
 from copy import deepcopy
+import cv2
 import datetime as dt
+from functools import partial
 import json
 import logging
 import numpy as np
 import os
 from os import path
-import skimage.io
 from sys import stderr
 from timestream.manipulate.pot import ImagePotMatrix
 import cPickle
@@ -45,11 +47,25 @@ from timestream.parse import (
     all_files_with_ext,
     iter_date_range,
     read_image,
+    save_image,
     ts_format_date,
     ts_guess_manifest_v1,
     ts_parse_date,
     ts_parse_date_path,
 )
+from timestream.parse.imgio import (
+    dct_reduction,
+    image_shape,
+)
+from timestream.parse.index import (
+    TimestampIndex,
+    ts_index_files,
+    ts_update_index,
+)
+from timestream.parse.potdata import (
+    POT_DATA_FILE,
+    PotDataStore,
+)
 from timestream.parse.validate import (
     IMAGE_EXT_TO_TYPE,
     TS_MANIFEST_KEYS,
@@ -200,6 +216,35 @@ def add_log_handler(stream=stderr, verbosity=None, level=None,
 LOG = logging.getLogger("timestreamlib")
 
 
+def _count_date_range(start, end, interval, start_hour=None, end_hour=None):
+    """Count the times iter_date_range yields that are within the hour range,
+    without visiting them."""
+    def _upto(time):
+        # Number of timepoints <= time
+        if time < start:
+            return 0
+        return int((time - start).total_seconds()) // interval + 1
+
+    if start_hour is None and end_hour is None:
+        return _upto(end)
+    count = 0
+    day = start.date()
+    while day <= end.date():
+        # time(0) is False, so no `start_hour or time.min` here
+        lo = dt.datetime.combine(day, dt.time.min)
+        if start_hour is not None:
+            lo = dt.datetime.combine(day, start_hour)
+        hi = dt.datetime.combine(day, dt.time.max)
+        if end_hour is not None:
+            hi = dt.datetime.combine(day, end_hour)
+        lo = max(lo, start)
+        hi = min(hi, end)
+        if lo <= hi:
+            count += _upto(hi) - _upto(lo - dt.timedelta(microseconds=1))
+        day += dt.timedelta(days=1)
+    return count
+
+
 class TimeStream(object):
 
     def __init__(self, version=None):
@@ -218,8 +263,23 @@ class TimeStream(object):
         self.image_data = {}
         self.data = {}
         self.image_db_path = None
+        self.image_journal_path = None
         self.db_path = None
         self.data_dir = None
+        # image_data keys written since the last flush()
+        self._journal = []
+        self._journal_len = 0
+        #: Number of written images after which write_image flushes
+        self.flush_interval = 100
+        #: Number of journal entries after which flush compacts the journal
+        self.compact_interval = 10000
+        # Relative paths of all files in the timestream index. None until the
+        # metadata is read, in which case we fall back to the filesystem.
+        self._index_files = None
+        self._pot_data = None
+        self._pot_data_exists = False
+        #: ImagePrefetcher reading images ahead of iteration, if any
+        self.prefetcher = None
 
     def __str__(self):
         ret = "TimeStream "
@@ -282,7 +342,10 @@ class TimeStream(object):
             os.mkdir(self.data_dir)
 
         self.image_db_path = path.join(self.data_dir, "image_data.json")
+        self.image_journal_path = path.join(self.data_dir, "image_data.jsonl")
         self.db_path = path.join(self.data_dir, "timestream_data.json")
+        self._pot_data = PotDataStore(path.join(self.data_dir, POT_DATA_FILE))
+        self._pot_data_exists = False
 
     @path.deleter
     def path(self):
@@ -300,6 +363,7 @@ class TimeStream(object):
                 self.image_data = json.load(db_fh)
         except (IOError, ValueError):
             self.image_data = {}
+        self._read_journal()
         try:
             with open(self.db_path) as db_fh:
                 self.data = json.load(db_fh)
@@ -400,19 +464,61 @@ class TimeStream(object):
             if image.datetime < self.start_datetime:
                 self.start_datetime = image.datetime
             self.image_data[ts_format_date(image.datetime)] = image.data
-            self.write_metadata()
+            self._journal.append(ts_format_date(image.datetime))
+            if len(self._journal) >= self.flush_interval:
+                self.flush()
             # FIXME: pass the overwrite_mode
             image.write(fpath=fpath, overwrite=True)
-            self.write_pickled_image(image, overwrite=True)
+            if self._index_files is not None:
+                self._index_files.add(path.relpath(fpath, self.path))
+            self.write_pot_data(image)
 
         else:
             raise NotImplementedError("v2 timestreams not implemented yet")
 
-    def write_pickled_image(self, image, overwrite=False):
-        pPath = path.join(self.data_dir,
-                          _ts_date_to_path(self.name, "p", image.datetime, 0))
-
-        TimeStreamImage.pickledump(image, pPath, overwrite=overwrite)
+    @property
+    def pot_data(self):
+        """PotDataStore holding the pot data of all images in this stream"""
+        if self._pot_data is None:
+            msg = "pot_data must be accessed on instance with valid path"
+            LOG.error(msg)
+            raise RuntimeError(msg)
+        return self._pot_data
+
+    def write_pot_data(self, image):
+        """Store the pots of ``image``, if it has any."""
+        if image.ipm is None:
+            return
+        self.pot_data.write(image.datetime, image.pixels.shape[0:2],
+                            image.ipm.potRecords())
+        self._pot_data_exists = True
+
+    def _has_pot_data(self):
+        # Once the store exists it is never removed, so only stat until then
+        if not self._pot_data_exists:
+            self._pot_data_exists = path.isfile(self.pot_data.path)
+        return self._pot_data_exists
+
+    def _image_at(self, timestamp, records=None):
+        """New TimeStreamImage at ``timestamp`` that rehydrates its
+        ImagePotMatrix from the pot data store on first access.
+
+        ``records`` is the result of a bulk PotDataStore.read_range covering
+        ``timestamp``, if we have one.
+        """
+        if not self._has_pot_data():
+            # Streams written before the pot data store have pickles.
+            img = self.load_pickled_image(timestamp)
+            if img is None:
+                img = TimeStreamImage(dt=timestamp)
+            return img
+
+        img = TimeStreamImage(dt=timestamp)
+        if records is None:
+            img._ipm_loader = partial(self.pot_data.read, timestamp)
+        else:
+            img._ipm_loader = partial(records.get, ts_format_date(timestamp))
+        return img
 
     def load_pickled_image(self, datetime):
         pPath = path.join(self.data_dir,
@@ -426,18 +532,117 @@ class TimeStream(object):
         return retImg
 
     def write_metadata(self):
+        """Write out all metadata, compacting the image_data journal"""
         if not self.path:
             msg = "write_metadata() must be called on instance with valid path"
             LOG.error(msg)
             raise RuntimeError(msg)
         if self.version == 1:
-            with open(self.image_db_path, "w") as db_fh:
-                json.dump(self.image_data, db_fh)
-            with open(self.db_path, "w") as db_fh:
-                json.dump(self.data, db_fh)
+            self._dump_json(self.image_data, self.image_db_path)
+            self._dump_json(self.data, self.db_path)
+            # image_data.json now holds everything in the journal
+            if path.exists(self.image_journal_path):
+                os.remove(self.image_journal_path)
+            self._journal = []
+            self._journal_len = 0
         else:
             raise NotImplementedError("v2 metadata not implemented")
 
+    def flush(self):
+        """Append the image_data of images written since the last flush to
+        the journal, and write out the timestream data.
+
+        Only the new entries are written, not the whole of image_data. Once
+        the journal has more than ``compact_interval`` entries it is compacted
+        into image_data.json with ``write_metadata``.
+        """
+        if not self.path:
+            msg = "flush() must be called on instance with valid path"
+            LOG.error(msg)
+            raise RuntimeError(msg)
+        if self.version != 1:
+            raise NotImplementedError("v2 metadata not implemented")
+        if self._journal_len + len(self._journal) > self.compact_interval:
+            self.write_metadata()
+            return
+        with open(self.image_journal_path, "a") as jnl_fh:
+            for key in self._journal:
+                jnl_fh.write(json.dumps([key, self.image_data[key]]))
+                jnl_fh.write("\n")
+        self._dump_json(self.data, self.db_path)
+        self._journal_len += len(self._journal)
+        self._journal = []
+
+    @staticmethod
+    def _dump_json(obj, fpath):
+        """Write ``obj`` as JSON to ``fpath``. It is renamed into place, so
+        a crash never leaves a truncated file."""
+        with open(fpath + ".tmp", "w") as fh:
+            json.dump(obj, fh)
+        if os.name == "nt" and path.exists(fpath):
+            os.remove(fpath)
+        os.rename(fpath + ".tmp", fpath)
+
+    def pending_image_data(self):
+        """Returns the image_data of the images written since the last
+        flush, as a ``dict``."""
+        return dict((key, self.image_data[key]) for key in self._journal)
+
+    def merge_image_data(self, image_data):
+        """Add the image_data of images written to this stream by another
+        instance, e.g. one in a worker process, so that it is journaled with
+        the next flush.
+
+        Args:
+          image_data(dict): As returned by ``pending_image_data``.
+        """
+        for key in sorted(image_data.keys()):
+            self.image_data[key] = image_data[key]
+            self._journal.append(key)
+            time = ts_parse_date(key)
+            if self.end_datetime is None or time > self.end_datetime:
+                self.end_datetime = time
+            if self.start_datetime is None or time < self.start_datetime:
+                self.start_datetime = time
+
+    def _read_journal(self):
+        """Replay the image_data journal on top of image_data"""
+        self._journal = []
+        self._journal_len = 0
+        try:
+            jnl_fh = open(self.image_journal_path)
+        except IOError:
+            return
+        good = []
+        torn = False
+        with jnl_fh:
+            for line in jnl_fh:
+                # A crash mid-flush leaves a last line without its newline
+                torn = torn or not line.endswith("\n")
+                try:
+                    key, data = json.loads(line)
+                except ValueError:
+                    LOG.warn("Ignoring bad entry in {}".format(
+                        self.image_journal_path))
+                    torn = True
+                    continue
+                self.image_data[key] = data
+                self._journal_len += 1
+                good.append(line.rstrip("\n") + "\n")
+        if not torn:
+            return
+        # Drop the bad entries, so the next flush appends after a newline
+        # instead of to the partly written line
+        try:
+            with open(self.image_journal_path + ".tmp", "w") as jnl_fh:
+                jnl_fh.writelines(good)
+            if os.name == "nt":
+                os.remove(self.image_journal_path)
+            os.rename(self.image_journal_path + ".tmp",
+                      self.image_journal_path)
+        except (IOError, OSError):
+            LOG.warn("Cannot repair {}".format(self.image_journal_path))
+
     def read_metadata(self):
         """Guesses the metadata fields of a timestream, v1 or v2."""
         if not self.path:
@@ -455,7 +660,9 @@ class TimeStream(object):
                 LOG.error(msg)
                 raise ValueError(msg)
         if self.version == 1:
-            manifest = ts_guess_manifest_v1(self.path)
+            index = ts_update_index(self.path)
+            self._index_files = set(ts_index_files(index))
+            manifest = ts_guess_manifest_v1(self.path, index=index)
             self._set_metadata(**manifest)
             for key in TS_MANIFEST_KEYS:
                 self.data[key] = manifest[key]
@@ -467,6 +674,12 @@ class TimeStream(object):
             LOG.error(msg)
             raise ValueError(msg)
 
+    def _image_exists(self, relpath):
+        """Checks if ``relpath`` exists, using the index where possible."""
+        if self._index_files is None:
+            return path.exists(path.join(self.path, relpath))
+        return relpath in self._index_files
+
     def _set_metadata(self, **metadata):
         """Sets class members from ``metadata`` dict, first validating it."""
         metadata = validate_timestream_manifest(metadata)
@@ -499,7 +712,44 @@ class TimeStream(object):
         Iterate over a TimeStream in chronological order, yielding a
         TimeStreamImage instance for each timepoint. If ``remove_gaps`` is
         False, yield None for missing images.
+
+        If the TimeStream has a ``prefetcher``, the pixels of the next images
+        are read in the background while the current one is used.
         """
+        imgs = self._iter_by_timepoints(remove_gaps, start, end, interval,
+                                        start_hour, end_hour,
+                                        ignored_timestamps)
+        if self.prefetcher is None:
+            return imgs
+        return self._prefetched(imgs)
+
+    def _prefetched(self, imgs):
+        """Yields ``imgs``, with the pixels of the ones after the current
+        image read ahead by ``prefetcher``."""
+        depth = self.prefetcher.depth
+        imgs = iter(imgs)
+        ahead = deque()
+        try:
+            while True:
+                for img in imgs:
+                    ahead.append(img)
+                    if len(ahead) > depth:
+                        break
+                if len(ahead) == 0:
+                    break
+                img = ahead.popleft()
+                if img._pixels is None and img.path is not None:
+                    pixels = self.prefetcher.take(img.path)
+                    if pixels is not None:
+                        img.pixels = pixels
+                self.prefetcher.schedule([x.path for x in ahead
+                                          if x._pixels is None])
+                yield img
+        finally:
+            self.prefetcher.clear()
+
+    def _iter_by_timepoints(self, remove_gaps, start, end, interval,
+                            start_hour, end_hour, ignored_timestamps):
         if not start or start < self.start_datetime:
             start = self.start_datetime
         if not end or end > self.end_datetime:
@@ -513,6 +763,11 @@ class TimeStream(object):
         if end_hour is not None:
             end = dt.datetime.combine(end.date(), end_hour)
 
+        # Read all the pot data at once
+        records = None
+        if self._has_pot_data():
+            records = self.pot_data.read_range(start, end)
+
         # iterate thru times
         for time in iter_date_range(start, end, interval):
             # skip images in ignored_timestamps
@@ -535,7 +790,7 @@ class TimeStream(object):
             # Join to make "absolute" path, i.e. path including ts_path
             img_path = path.join(self.path, relpath)
             # not-so-silently fail if we can't find the image
-            if path.exists(img_path):
+            if self._image_exists(relpath):
                 LOG.debug("Image at {} in {} is {}.".format(time, self.path,
                                                             img_path))
             else:
@@ -549,9 +804,7 @@ class TimeStream(object):
                 img.pixels = np.array([])
                 yield img
             else:
-                img = self.load_pickled_image(time)
-                if img is None:
-                    img = TimeStreamImage(dt=time)
+                img = self._image_at(time, records=records)
                 img.parent_timestream = self
                 img.path = img_path
 
@@ -567,7 +820,8 @@ class TimeStreamTraverser(TimeStream):
 
     def __init__(self, ts_path=None, version=None, interval=None,
                  start=None, end=None, start_hour=None, end_hour=None,
-                 ignore_ts=[], existing_ts=[], err_on_access=False):
+                 ignore_ts=[], existing_ts=[], err_on_access=False,
+                 from_listing=False):
         """Class to got back and forth on a TimeStream
 
         Use This class when you need to traverse the timestream both forwards
@@ -584,11 +838,18 @@ class TimeStreamTraverser(TimeStream):
           existing_ts(list): existing timestamps that should not be recalculated.
           err_on_access: If false we make all error checks silently in __init__.
                          If true we raise errors when accessing imgs.
+          from_listing: If true we build _timestamps from the images listed in
+                        the timestream index instead of visiting every
+                        timepoint between start and end. Timepoints without
+                        an image are never included, even with err_on_access.
 
         Attributes:
           _timestamps(list): List of strings that index all existing image files
             in this timestream
           _offset(int): Current offset within _timestamps.
+          _timestamp_index(TimestampIndex): Sorted index of _timestamps.
+          num_expected(int): Number of timepoints in the requested range.
+          num_found(int): Number of those timepoints that have an image.
 
         """
         super(TimeStreamTraverser, self).__init__(version=version)
@@ -600,6 +861,8 @@ class TimeStreamTraverser(TimeStream):
 
         self._offset = 0
         self._timestamps = []
+        self.num_expected = 0
+        self.num_found = 0
         # FIXME: Following is practically equal to
         # TimeStream.iter_by_timepoints.
         if not start or start < self.start_datetime:
@@ -615,6 +878,19 @@ class TimeStreamTraverser(TimeStream):
         if end_hour is not None:
             end = dt.datetime.combine(end.date(), end_hour)
 
+        if from_listing:
+            self._timestamps_from_listing(start, end, interval, start_hour,
+                                          end_hour)
+        else:
+            self._timestamps_from_range(start, end, interval, start_hour,
+                                        end_hour)
+        self._timestamp_index = TimestampIndex(self._timestamps)
+        LOG.info("Found {} of {} expected timepoints in {}".format(
+            self.num_found, self.num_expected, self.path))
+
+    def _timestamps_from_range(self, start, end, interval, start_hour,
+                               end_hour):
+        """Visit every timepoint in the range, keeping those we want"""
         # iterate threw times
         for time in iter_date_range(start, end, interval):
             # apply hour range if given
@@ -626,6 +902,13 @@ class TimeStreamTraverser(TimeStream):
                 hrend = dt.datetime.combine(time.date(), end_hour)
                 if time > hrend:
                     continue
+            self.num_expected += 1
+
+            # Do not add if path dosn't exist
+            relpath = _ts_date_to_path(self.name, self.extension, time, 0)
+            exists = self._image_exists(relpath)
+            if exists:
+                self.num_found += 1
 
             # skip images in ignore_ts
             if ts_format_date(time) in self._ignore_ts:
@@ -637,15 +920,56 @@ class TimeStreamTraverser(TimeStream):
                 if not self._err_on_access:
                     continue
 
-            # Do not add if path dosn't exist
-            relpath = _ts_date_to_path(self.name, self.extension, time, 0)
-            img_path = path.join(self.path, relpath)
-            if not path.exists(img_path):
+            if not exists:
                 if not self._err_on_access:
                     continue
 
             self._timestamps.append(time)
 
+    def _timestamps_from_listing(self, start, end, interval, start_hour,
+                                 end_hour):
+        """Intersect the listed images with the timepoints we want"""
+        self.num_expected = _count_date_range(start, end, interval,
+                                              start_hour, end_hour)
+        if self._index_files is None:
+            # Only happens if we were never loaded
+            self._index_files = set(ts_index_files(ts_update_index(self.path)))
+
+        # Images of timepoints, as named by _ts_date_to_path
+        prefix = self.name + "_"
+        suffix = "_00." + self.extension
+        listed = set()
+        for relpath in self._index_files:
+            fname = path.basename(relpath)
+            if not (fname.startswith(prefix) and fname.endswith(suffix)):
+                continue
+            try:
+                time = ts_parse_date(fname[len(prefix):-len(suffix)])
+            except ValueError:
+                continue
+            if relpath == _ts_date_to_path(self.name, self.extension, time,
+                                           0):
+                listed.add(time)
+
+        # Keep the ones within the range, on the interval and the hour range
+        found = set()
+        for time in listed:
+            if time < start or time > end:
+                continue
+            if int((time - start).total_seconds()) % interval != 0:
+                continue
+            if start_hour is not None and time.time() < start_hour:
+                continue
+            if end_hour is not None and time.time() > end_hour:
+                continue
+            found.add(time)
+        self.num_found = len(found)
+
+        if not self._err_on_access:
+            skip = set(self._ignore_ts) | set(self._existing_ts)
+            found = set(x for x in found if ts_format_date(x) not in skip)
+        self._timestamps = sorted(found)
+
     def next(self):
         if self._offset == len(self._timestamps) - 1:
             self._offset = 0
@@ -667,29 +991,34 @@ class TimeStreamTraverser(TimeStream):
         return (self.getImgByTimeStamp(time))
 
     def getImgByTimeStamp(self, timestamp, update_index=False):
-        if timestamp not in self._timestamps:
+        if timestamp not in self._timestamp_index:
             raise RuntimeError("Timestamp not found")
 
         if update_index:
-            self._offset = self._timestamps.index(timestamp)
+            self._offset = self._timestamp_index.index(timestamp)
 
         relpath = _ts_date_to_path(self.name, self.extension, timestamp, 0)
         img_path = path.join(self.path, relpath)
 
+        pixels = None
+        if self.prefetcher is not None:
+            pixels = self.prefetcher.take(img_path)
+            self._prefetch_after(timestamp)
+
         if self._err_on_access:
             if ts_format_date(timestamp) in self._ignore_ts:
                 raise PCExSkippedImage(timestamp)
             if ts_format_date(timestamp) in self._existing_ts:
                 raise PCExExistingImage(timestamp)
-            if not path.exists(img_path):
+            if not self._image_exists(relpath):
                 raise PCExMissingImage(timestamp, img_path)
 
-        img = self.load_pickled_image(timestamp)
-        if img is None:
-            img = TimeStreamImage(dt=timestamp)
+        img = self._image_at(timestamp)
 
         img.parent_timestream = self
         img.path = img_path
+        if pixels is not None:
+            img.pixels = pixels
 
         try:
             img_date = ts_format_date(img.datetime)
@@ -699,10 +1028,30 @@ class TimeStreamTraverser(TimeStream):
 
         return img
 
+    def _prefetch_after(self, timestamp):
+        """Schedule the images of the timestamps following ``timestamp``"""
+        skip = set(self._ignore_ts) | set(self._existing_ts)
+        pos = self._timestamp_index.index(timestamp) + 1
+        paths = []
+        # Bounded, so long runs of skipped timestamps stay cheap
+        for time in self._timestamps[pos:pos + 4 * self.prefetcher.depth]:
+            if len(paths) == self.prefetcher.depth:
+                break
+            if ts_format_date(time) in skip:
+                continue
+            relpath = _ts_date_to_path(self.name, self.extension, time, 0)
+            if self._image_exists(relpath):
+                paths.append(path.join(self.path, relpath))
+        self.prefetcher.schedule(paths)
+
     @property
     def timestamps(self):
         return self._timestamps
 
+    @property
+    def timestamp_index(self):
+        return self._timestamp_index
+
 
 class TimeStreamImage(object):
     """Class to represent an image in a TimeSeries.
@@ -731,6 +1080,8 @@ class TimeStreamImage(object):
         self._path = None
         self._pixels = None
         self._ipm = None
+        # Callable returning the stored pot data of this image, if any.
+        self._ipm_loader = None
         self.data = {}
 
     def clone(self, copy_pixels=False, copy_path=False, copy_timestream=False):
@@ -790,7 +1141,7 @@ class TimeStreamImage(object):
         if not path.exists(path.dirname(fpath)):
             os.makedirs(path.dirname(fpath))
 
-        skimage.io.imsave(fpath, self._pixels)
+        save_image(fpath, self._pixels)
 
         # Once we have written its ok to set property
         self.path = fpath
@@ -847,6 +1198,12 @@ class TimeStreamImage(object):
 
     @property
     def ipm(self):
+        if self._ipm is None and self._ipm_loader is not None:
+            # Rehydrate from the pot data store on first access
+            loader, self._ipm_loader = self._ipm_loader, None
+            record = loader()
+            if record is not None:
+                self._ipm = ImagePotMatrix.fromPotRecords(self, *record)
         return self._ipm
 
     @ipm.setter
@@ -862,6 +1219,7 @@ class TimeStreamImage(object):
             LOG.error(msg)
             raise RuntimeError(msg)
 
+        self._ipm_loader = None
         self._ipm = ipm
 
     @property
@@ -941,6 +1299,41 @@ class TimeStreamImage(object):
     def pixels(self):
         del self._pixels
 
+    def pixels_at(self, scale=None, shape=None):
+        """Pixels resized by ``scale``, or to ``shape`` (rows, cols).
+
+        If the pixels are not loaded yet and the image is a JPEG, it is
+        decoded straight at 1/2, 1/4 or 1/8 of its size when that is still
+        large enough, and only the rest is resized. The result is a new
+        array, of the same dtype, and is not kept: ``pixels`` still loads the
+        full sized image.
+        """
+        if (scale is None) == (shape is None):
+            msg = "Give one of scale or shape to pixels_at"
+            LOG.error(msg)
+            raise ValueError(msg)
+        pixels, fshape = self._pixels, None
+        if pixels is None and self.path:
+            fshape = image_shape(self.path)
+        if fshape is None:
+            pixels = self.pixels
+            fshape = pixels.shape[0:2]
+        if shape is None:
+            shape = (int(round(fshape[0] * scale)),
+                     int(round(fshape[1] * scale)))
+        if pixels is None:
+            reduce = dct_reduction(self.path, shape=shape)
+            pixels = read_image(self.path, scale=1.0 / reduce)
+            if tuple(pixels.shape[0:2]) == tuple(shape):
+                return pixels
+
+        if tuple(pixels.shape[0:2]) == tuple(shape):
+            return pixels.copy()
+        interp = cv2.INTER_LINEAR
+        if shape[0] < pixels.shape[0]:
+            interp = cv2.INTER_AREA
+        return cv2.resize(pixels, (shape[1], shape[0]), interpolation=interp)
+
     def strip(self):
         """Used to strip before pickling"""
         self._pixels = None
@@ -990,6 +1383,9 @@ class TimeStreamImage(object):
         f = file(filepath, "r")
         tsi = cPickle.load(f)
         f.close()
+        # Pickles can predate members added to TimeStreamImage
+        if not hasattr(tsi, "_ipm_loader"):
+            tsi._ipm_loader = None
 
         if not isinstance(tsi, TimeStreamImage):
             msg = "Object must be instance of TimeStreamImage"
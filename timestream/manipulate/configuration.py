@@ -377,6 +377,25 @@ class PCFGConfig(PCFGSection):
             "step. This is discouraged for normal use as it stops "
             "the pipeline.",
          "ex": "visualise: True"},
+        {"arg": "general.prefetchDepth", "type": int,
+         "def": 2, "req": False,
+         "doc": "Number of input images that are read ahead in background "
+            "threads while the pipeline processes the current image. "
+            "0 turns reading ahead off.",
+         "ex": "prefetchDepth: 4"},
+        {"arg": "general.prefetchMaxMB", "type": int,
+         "def": 512, "req": False,
+         "doc": "Maximum memory, in megabytes, held by images that are read "
+            "ahead. Fewer than general.prefetchDepth images are read ahead "
+            "when they don't fit.",
+         "ex": "prefetchMaxMB: 1024"},
+        {"arg": "general.imageBackend", "type": str,
+         "def": None, "req": False,
+         "doc": "Library used to read and write images. One of freeimage, "
+            "skimage, opencv or pil. util/benchmark_image_io.py shows which "
+            "one is fastest. By default images are read with freeimage and "
+            "written with skimage.",
+         "ex": "imageBackend: opencv"},
         {"arg": "general.metas", "type": PCFGSection,
          "def": None, "req": False,
          "doc": "Each element detected in the image will have an id based "
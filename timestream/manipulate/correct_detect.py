@@ -26,11 +26,16 @@
 
 from __future__ import absolute_import, division
 import cv2
+import hashlib
 import logging
 import warnings
 import matplotlib.pylab as plt
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import numpy as np
+import os
 from scipy import optimize
+import zipfile
 
 __author__  = 'Chuong Nguyen'
 
@@ -507,15 +512,21 @@ def estimateColorParametersFromWhiteBackground(Image, Window, MaxIntensity=255):
     return colorMatrix, colorConstant, colorGamma
 
 
-def estimateColorParameters(TrueColors, ActualColors):
+def estimateColorParameters(TrueColors, ActualColors,
+                            InitialParameters=None):
+    """Estimates the (matrix, constant, gamma) that correct ``ActualColors``
+    into ``TrueColors``, starting the search from ``InitialParameters``, as
+    returned by a previous call, or from the identity if None."""
     # estimate color-correction parameters
     colorMatrix = np.eye(3)
     colorConstant = np.zeros([3, 1])
     colorGamma = np.ones([3, 1])
+    if InitialParameters is not None:
+        colorMatrix, colorConstant, colorGamma = InitialParameters
     Arg2 = np.zeros([9 + 3 + 3])
-    Arg2[:9] = colorMatrix.reshape([9])
-    Arg2[9:12] = colorConstant.reshape([3])
-    Arg2[12:15] = colorGamma.reshape([3])
+    Arg2[:9] = np.reshape(colorMatrix, [9])
+    Arg2[9:12] = np.reshape(colorConstant, [3])
+    Arg2[12:15] = np.reshape(colorGamma, [3])
     ArgRefined, _ = optimize.leastsq(getColorMatchingErrorVectorised,
                                      Arg2, args=(TrueColors, ActualColors),
                                      maxfev=10000)
@@ -552,6 +563,168 @@ def correctColorVectorised(Image, ColorMatrix, ColorConstant, ColorGamma):
     return ImageCorrected
 
 
+# (pid, Threads, pool) of the threads correctColorTiled runs its tiles on
+_colorPool = (None, None, None)
+
+
+def _colorThreadPool(Threads):
+    """Thread pool with ``Threads`` threads, created once per process as
+    the threads of a pool don't survive a fork. The pool of a different
+    number of threads is closed."""
+    global _colorPool
+    pid, threads, pool = _colorPool
+    if pid == os.getpid() and threads == Threads:
+        return pool
+    if pid == os.getpid():
+        pool.close()
+        pool.join()
+    pool = ThreadPool(Threads)
+    _colorPool = (os.getpid(), Threads, pool)
+    return pool
+
+
+def correctColorTiled(Image, ColorMatrix, ColorConstant, ColorGamma,
+                      Out=None, TileRows=128, Threads=None):
+    """Colour corrects ``Image`` like correctColorVectorised, rounding the
+    result into a uint8 image.
+
+    The image is corrected in tiles of ``TileRows`` rows, in float32 and in
+    place, so it takes a few tiles of memory instead of several float64
+    copies of the image. Tiles run on ``Threads`` threads, one per CPU if
+    None; numpy releases the GIL while it works on them. Negative values
+    are corrected to 0, which a fractional gamma would otherwise make NaN.
+
+    Args:
+      Image(ndarray): RGB(A) image, of any dtype.
+      ColorMatrix, ColorConstant, ColorGamma: As estimateColorParameters
+        returns them.
+      Out(ndarray): uint8 image the shape of ``Image`` to write to. May be
+        ``Image`` itself.
+      TileRows(int): Rows per tile.
+      Threads(int): Number of threads to correct tiles on.
+    """
+    if Out is None:
+        Out = np.empty(Image.shape, dtype=np.uint8)
+    if Out.shape != Image.shape or Out.dtype != np.uint8:
+        msg = "Output must be a uint8 image of shape {}".format(Image.shape)
+        LOG.error(msg)
+        raise ValueError(msg)
+    if Image.shape[2] > 3 and Out is not Image:
+        # correctColorVectorised zeroes all but the colour channels
+        Out[:, :, 3:] = 0
+    # Pixels are rows of the tiles, so they are multiplied by the transpose
+    Matrix = np.asarray(ColorMatrix, dtype=np.float32).T.copy()
+    Constant = np.asarray(ColorConstant, dtype=np.float32).reshape(3)
+    Gamma = np.asarray(ColorGamma, dtype=np.float32).reshape(3)
+    Rows, Cols = Image.shape[0:2]
+
+    def correctTile(Row):
+        Tile = Image[Row:Row + TileRows, :, 0:3]
+        Pixels = np.empty((Tile.shape[0] * Cols, 3), dtype=np.float32)
+        Pixels.reshape(Tile.shape)[...] = Tile
+        Temp = np.dot(Pixels, Matrix)
+        Temp += Constant
+        np.maximum(Temp, 0, out=Temp)
+        if np.any(Gamma != 1):
+            Temp *= 1 / 255
+            np.power(Temp, Gamma, out=Temp)
+            Temp *= 255
+        np.minimum(Temp, 255, out=Temp)
+        np.rint(Temp, out=Temp)
+        Out[Row:Row + TileRows, :, 0:3] = Temp.reshape(Tile.shape)
+
+    Tiles = range(0, Rows, TileRows)
+    if Threads is None:
+        Threads = cpu_count()
+    if Threads > 1 and len(Tiles) > 1:
+        _colorThreadPool(Threads).map(correctTile, Tiles)
+    else:
+        for Row in Tiles:
+            correctTile(Row)
+    return Out
+
+
+def correctColorLUT(ColorMatrix, ColorConstant, ColorGamma, Tolerance=0.01):
+    """Lookup table for cv2.LUT that colour corrects uint8 RGB images like
+    correctColorTiled, or None if the correction mixes channels.
+
+    Channels are corrected independently when ``ColorMatrix`` is diagonal,
+    as estimateColorParametersFromWhiteBackground estimates it. Off
+    diagonal terms are ignored when they move no pixel by more than
+    ``Tolerance`` intensity levels.
+    """
+    Matrix = np.asarray(ColorMatrix, dtype=np.float)
+    OffDiagonal = Matrix - np.diag(np.diag(Matrix))
+    if 255 * np.abs(OffDiagonal).sum(axis=1).max() > Tolerance:
+        return None
+    Ramp = np.repeat(np.arange(256, dtype=np.uint8), 3).reshape(1, 256, 3)
+    return correctColorTiled(Ramp, np.diag(np.diag(Matrix)), ColorConstant,
+                             ColorGamma, Threads=1)
+
+
+def undistortMaps(CameraMatrix, DistortCoefs, ImageSize, RotationAngle=0.0,
+                  CacheDir=None):
+    """Maps for cv2.remap that undistort an image of ``ImageSize`` (width,
+    height) and then rotate it like rotateImage, in a single remap.
+
+    The maps are in the fixed point CV_16SC2 form, which takes half the
+    memory of float maps and remaps faster. With ``CacheDir``, they are
+    stored there in a file named after the calibration and read from it
+    instead of being computed again.
+    """
+    Calibration = [np.asarray(x, dtype=np.float64) for x in
+                   [CameraMatrix, DistortCoefs, ImageSize, [RotationAngle]]]
+    CachePath = None
+    if CacheDir is not None:
+        Key = hashlib.sha1(cv2.__version__.encode())
+        for Param in Calibration:
+            Key.update(Param.tobytes())
+        CachePath = os.path.join(
+            CacheDir, "undistort_{}.npz".format(Key.hexdigest()))
+        try:
+            with np.load(CachePath) as Maps:
+                return Maps["Map1"], Maps["Map2"]
+        except (IOError, KeyError, ValueError, zipfile.BadZipfile):
+            pass
+
+    MapX, MapY = cv2.initUndistortRectifyMap(
+        Calibration[0], Calibration[1], None, Calibration[0],
+        tuple(int(x) for x in ImageSize), cv2.CV_32FC1)
+    # The rotated image takes its pixels from the rotated maps
+    if RotationAngle % 90.0 == 0:
+        k = int(RotationAngle // 90.0)
+        MapX = np.ascontiguousarray(np.rot90(MapX, k))
+        MapY = np.ascontiguousarray(np.rot90(MapY, k))
+    else:
+        center = tuple(np.array(MapX.shape[1::-1]) / 2)
+        rot_mat = cv2.getRotationMatrix2D(center, RotationAngle, 1.0)
+        MapX, MapY, Inside = [cv2.warpAffine(Map, rot_mat, Map.shape[1::-1],
+                                             flags=cv2.INTER_LINEAR,
+                                             borderMode=cv2.BORDER_CONSTANT,
+                                             borderValue=0)
+                              for Map in [MapX, MapY,
+                                          np.ones_like(MapX)]]
+        # Pixels rotated in from outside the image, even partly, map well
+        # outside of it, beyond any interpolation. Interpolating their maps
+        # with the border would not.
+        MapX[Inside < 1] = -10
+        MapY[Inside < 1] = -10
+    Map1, Map2 = cv2.convertMaps(MapX, MapY, cv2.CV_16SC2)
+
+    if CachePath is not None:
+        # Written under another name first, as other processes may be
+        # reading the maps
+        TempPath = "{}.{}".format(CachePath, os.getpid())
+        try:
+            with open(TempPath, "wb") as fh:
+                np.savez(fh, Map1=Map1, Map2=Map2)
+            os.rename(TempPath, CachePath)
+        except (IOError, OSError) as e:
+            LOG.warn("Cannot cache undistortion maps in {}: {}".format(
+                CacheDir, e))
+    return Map1, Map2
+
+
 def rotateImage(Image, RotationAngle=0.0):
     if RotationAngle % 90.0 == 0:
         k = RotationAngle // 90.0
@@ -566,6 +739,15 @@ def rotateImage(Image, RotationAngle=0.0):
 
 def matchTemplateLocation(Image, Template, EstimatedLocation,
                           SearchRange=[0.5, 0.5], RangeInImage=True):
+    srchTLCnr, srchBRCnr = searchWindow(Image, Template, EstimatedLocation,
+                                        SearchRange, RangeInImage)
+    return matchTemplateWindow(Image, Template, srchTLCnr, srchBRCnr)
+
+
+def searchWindow(Image, Template, EstimatedLocation, SearchRange=[0.5, 0.5],
+                 RangeInImage=True):
+    """Top-left and bottom-right corners of the window of ``Image`` that
+    matchTemplateLocation searches."""
     if RangeInImage:  # use image size
         Width = Image.shape[1]
         Height = Image.shape[0]
@@ -589,13 +771,13 @@ def matchTemplateLocation(Image, Template, EstimatedLocation,
                  max(EstimatedLocation[1]-CroppedHalfHeight, 0)]
     srchBRCnr = [min(EstimatedLocation[0]+CroppedHalfWidth, Image.shape[1]),
                  min(EstimatedLocation[1]+CroppedHalfHeight, Image.shape[0])]
-    return matchTemplateWindow(Image, Template, srchTLCnr, srchBRCnr)
+    return srchTLCnr, srchBRCnr
 
 
 def matchTemplateWindow(Image, Template, srchTLCnr, srchBRCnr):
     CropedImage = Image[srchTLCnr[1]:srchBRCnr[1], srchTLCnr[0]:srchBRCnr[0]]
-    corrMap = cv2.matchTemplate(CropedImage.astype(np.uint8),
-                                Template.astype(np.uint8),
+    corrMap = cv2.matchTemplate(CropedImage.astype(np.uint8, copy=False),
+                                Template.astype(np.uint8, copy=False),
                                 cv2.TM_CCOEFF_NORMED)
     _, maxVal, _, maxLoc = cv2.minMaxLoc(corrMap)
     # recalculate max position in cropped image space
@@ -607,6 +789,54 @@ def matchTemplateWindow(Image, Template, srchTLCnr, srchBRCnr):
     return matchedLocImage, maxVal, maxLoc, corrMap
 
 
+def matchTemplateWindows(Image, Template, Windows):
+    """matchTemplateWindow for many windows at once.
+
+    Computes one correlation map over the bounding box of all ``Windows``,
+    a list of (srchTLCnr, srchBRCnr), and takes the maximum of each window
+    from it. That only pays when the windows overlap a lot, so unless the
+    bounding box is at most half the area of the windows together, each
+    window is matched on its own.
+
+    Returns a list of (matchedLocImage, maxVal), one per window.
+    """
+    def area(TLCnr, BRCnr):
+        return (BRCnr[0] - TLCnr[0]) * (BRCnr[1] - TLCnr[1])
+
+    # Windows clipped smaller than the template by the image border are
+    # left to matchTemplateWindow, which handles them its own way
+    fits = [w[1][0] - w[0][0] >= Template.shape[1] and
+            w[1][1] - w[0][1] >= Template.shape[0] for w in Windows]
+    inMap = [w for w, fit in zip(Windows, fits) if fit]
+    corrMap = None
+    if len(inMap) > 0:
+        TLCnr = [min(w[0][0] for w in inMap), min(w[0][1] for w in inMap)]
+        BRCnr = [max(w[1][0] for w in inMap), max(w[1][1] for w in inMap)]
+        # Measured break-even is between 1/2 and 2/3 of the window area
+        if 2 * area(TLCnr, BRCnr) <= sum(area(*w) for w in inMap):
+            CropedImage = Image[TLCnr[1]:BRCnr[1], TLCnr[0]:BRCnr[0]]
+            corrMap = cv2.matchTemplate(
+                CropedImage.astype(np.uint8, copy=False),
+                Template.astype(np.uint8, copy=False),
+                cv2.TM_CCOEFF_NORMED)
+    retVal = []
+    for (srchTLCnr, srchBRCnr), fit in zip(Windows, fits):
+        if not fit or corrMap is None:
+            matchedLocImage, maxVal, _, _ = matchTemplateWindow(
+                Image, Template, srchTLCnr, srchBRCnr)
+            retVal.append((matchedLocImage, maxVal))
+            continue
+        # Template positions that lie within this window
+        top, left = srchTLCnr[1] - TLCnr[1], srchTLCnr[0] - TLCnr[0]
+        bottom = srchBRCnr[1] - TLCnr[1] - Template.shape[0] + 1
+        right = srchBRCnr[0] - TLCnr[0] - Template.shape[1] + 1
+        _, maxVal, _, maxLoc = cv2.minMaxLoc(corrMap[top:bottom, left:right])
+        matchedLocImage = (maxLoc[0] + Template.shape[1] // 2 + srchTLCnr[0],
+                           maxLoc[1] + Template.shape[0] // 2 + srchTLCnr[1])
+        retVal.append((matchedLocImage, maxVal))
+    return retVal
+
+
 def createImagePyramid(Image, NoLevels=5):
     for i in range(NoLevels):
         if i == 0:
@@ -617,9 +847,52 @@ def createImagePyramid(Image, NoLevels=5):
     return PyramidImages
 
 
+class OrientationCache(object):
+
+    def __init__(self, ScoreDrop=0.1):
+        """Remembers which way up, 0 or 180 degrees, images match each
+        template pyramid, so matchTemplatePyramid need not match both ways
+        every time. Camera orientation does not change within a timestream,
+        so keep one per stream.
+
+        Args:
+          ScoreDrop(float): Check both orientations again once the score
+            drops by this fraction from the one the decision was made with.
+
+        Attributes:
+          _angles(dict): {id(template pyramid): (template pyramid, angle,
+            score)}. Holding the pyramid keeps its id from being reused.
+        """
+        self.ScoreDrop = ScoreDrop
+        self._angles = {}
+
+    def angle(self, PyramidTemplates):
+        """The remembered angle for ``PyramidTemplates``, or None"""
+        entry = self._angles.get(id(PyramidTemplates))
+        if entry is None or entry[0] is not PyramidTemplates:
+            return None
+        return entry[1]
+
+    def holds(self, PyramidTemplates, Score):
+        """Whether ``Score`` is still good enough to keep the angle"""
+        entry = self._angles[id(PyramidTemplates)]
+        return Score >= entry[2] * (1 - self.ScoreDrop)
+
+    def update(self, PyramidTemplates, Angle, Score):
+        self._angles[id(PyramidTemplates)] = (PyramidTemplates, Angle, Score)
+
+
 def matchTemplatePyramid(PyramidImages, PyramidTemplates, RotationAngle=None,
                          EstimatedLocation=None, SearchRange=None, NoLevels=4,
-                         FinalLevel=1):
+                         FinalLevel=1, Orientations=None):
+    """Matches PyramidTemplates in PyramidImages, from the coarsest level
+    down to FinalLevel. Returns (score, location, angle).
+
+    With RotationAngle None, the image is matched upright and rotated by 180
+    degrees, and the best of both is used. Give an OrientationCache as
+    ``Orientations`` to only match the way found before, until its score
+    drops.
+    """
     for i in range(NoLevels - 1, -1, -1):
         if i == NoLevels - 1:
             if EstimatedLocation is None:
@@ -634,29 +907,56 @@ def matchTemplatePyramid(PyramidImages, PyramidTemplates, RotationAngle=None,
                                 SearchRange[1] // 2 ** i]
             else:
                 SearchRange2 = SearchRange
-            matchedLocImage, maxVal, maxLoc, corrMap = \
-                matchTemplateLocation(PyramidImages[i],
-                                      PyramidTemplates[i],
-                                      maxLocEst,
-                                      SearchRange=SearchRange2)
+            # (matchedLocImage, maxVal, maxLoc, corrMap) of the image upright
+            # and rotated by 180 degrees. Rotated levels are views.
+            upright, rotated = None, None
+            rotImages = None
+            if RotationAngle is None and Orientations is not None:
+                cachedAngle = Orientations.angle(PyramidTemplates)
+                if cachedAngle == 180:
+                    rotImages = [np.rot90(Img, 2) for Img in PyramidImages]
+                    rotated = matchTemplateLocation(
+                        rotImages[i], PyramidTemplates[i], maxLocEst,
+                        SearchRange)
+                    if Orientations.holds(PyramidTemplates, rotated[1]):
+                        RotationAngle = 180
+                elif cachedAngle == 0:
+                    upright = matchTemplateLocation(
+                        PyramidImages[i], PyramidTemplates[i], maxLocEst,
+                        SearchRange=SearchRange2)
+                    if Orientations.holds(PyramidTemplates, upright[1]):
+                        RotationAngle = 0
+                if cachedAngle is not None and RotationAngle is None:
+                    LOG.info('Matching score dropped, checking orientation')
             if RotationAngle is None:
-                pyr_img_rot_uint8 = np.rot90(PyramidImages[i], 2).astype(np.uint8)
-                matchedLocImage180, maxVal180, maxLoc180, corrMap180 = \
-                    matchTemplateLocation(pyr_img_rot_uint8,
-                                          PyramidTemplates[i],
-                                          maxLocEst, SearchRange)
-                if maxVal < 0.3 and maxVal180 < 0.3:
+                if upright is None:
+                    upright = matchTemplateLocation(
+                        PyramidImages[i], PyramidTemplates[i], maxLocEst,
+                        SearchRange=SearchRange2)
+                if rotated is None:
+                    rotImages = [np.rot90(Img, 2) for Img in PyramidImages]
+                    rotated = matchTemplateLocation(
+                        rotImages[i], PyramidTemplates[i], maxLocEst,
+                        SearchRange)
+                if upright[1] < 0.3 and rotated[1] < 0.3:
                     LOG.warn('Low matching score')
-                if maxVal < maxVal180:
-                    PyramidImages = [np.rot90(Img, 2) for Img in PyramidImages]
-                    matchedLocImage, matchedLocImage180 = \
-                        matchedLocImage180, matchedLocImage
-                    maxVal, maxVal180 = maxVal180, maxVal
-                    maxLoc, maxLoc180 = maxLoc180, maxLoc
-                    corrMap, corrMap180 = corrMap180, corrMap
+                if upright[1] < rotated[1]:
                     RotationAngle = 180
                 else:
                     RotationAngle = 0
+                if Orientations is not None:
+                    Orientations.update(PyramidTemplates, RotationAngle,
+                                        max(upright[1], rotated[1]))
+
+            if RotationAngle == 180 and rotated is not None:
+                PyramidImages = rotImages
+                matchedLocImage, maxVal, maxLoc, corrMap = rotated
+            else:
+                if upright is None:
+                    upright = matchTemplateLocation(
+                        PyramidImages[i], PyramidTemplates[i], maxLocEst,
+                        SearchRange=SearchRange2)
+                matchedLocImage, maxVal, maxLoc, corrMap = upright
             # rescale to location in level-0 image
             matchedLocImage0 = (matchedLocImage[0] * 2 ** i,
                                 matchedLocImage[1] * 2 ** i)
@@ -675,3 +975,36 @@ def matchTemplatePyramid(PyramidImages, PyramidTemplates, RotationAngle=None,
             # Skip early to save time
             break
     return maxVal, matchedLocImage0, RotationAngle
+
+
+def matchTemplatePyramidBatch(PyramidImages, PyramidTemplates,
+                              EstimatedLocations, SearchRange, NoLevels=4,
+                              FinalLevel=1):
+    """matchTemplatePyramid, with no rotation, for many locations of the same
+    template at once. Each pyramid level is correlated once, with
+    matchTemplateWindows. Returns (scores, locations), one per location.
+    """
+    for i in range(NoLevels - 1, -1, -1):
+        if i == NoLevels - 1:
+            # scale positions to the pyramid level
+            maxLocEsts = [[Loc[0] // 2 ** i, Loc[1] // 2 ** i]
+                          for Loc in EstimatedLocations]
+            if SearchRange[0] > 1.0 and SearchRange[1] > 1.0:
+                SearchRange2 = [SearchRange[0] // 2 ** i,
+                                SearchRange[1] // 2 ** i]
+            else:
+                SearchRange2 = SearchRange
+        else:
+            maxLocEsts = [(Loc[0] // 2 ** i, Loc[1] // 2 ** i)
+                          for Loc in matchedLocImages0]
+            SearchRange2 = [6, 6]
+        Windows = [searchWindow(PyramidImages[i], PyramidTemplates[i],
+                                Loc, SearchRange2) for Loc in maxLocEsts]
+        matches = matchTemplateWindows(PyramidImages[i], PyramidTemplates[i],
+                                       Windows)
+        # rescale to locations in level-0 image
+        matchedLocImages0 = [(Loc[0] * 2 ** i, Loc[1] * 2 ** i)
+                             for Loc, _ in matches]
+        if i == FinalLevel:
+            break
+    return [maxVal for _, maxVal in matches], matchedLocImages0
@@ -26,18 +26,16 @@
 
 from __future__ import absolute_import, division, print_function
 
-import cPickle
 import cv2
 from itertools import chain
 import logging
 import matplotlib.pyplot as plt
+import multiprocessing
 import numpy as np
 import os
 from scipy import spatial
-import sys
 import time
 import datetime
-import skimage.transform
 
 from timestream import TimeStreamImage, TimeStreamTraverser
 import timestream.manipulate.correct_detect as cd
@@ -45,7 +43,8 @@ import timestream.manipulate.plantSegmenter as tm_ps
 import timestream.manipulate.pot as tm_pot
 from timestream.parse import (
     read_image,
-    RIException
+    RIException,
+    ts_format_date,
 )
 from timestream.manipulate import (
     PCException,
@@ -59,6 +58,7 @@ from timestream.manipulate import (
     PCExImageTooDark,
     PCExCannotFindColorCard,
     PCExCannotFindTray,
+    PCExSegmentation,
     PCExCannotCalcTimestamp,
     PCExCannotFindFeatures,
     PCExPotRectangleDimsOutOfImage,
@@ -139,6 +139,11 @@ class PipeComponent (object):
     def __exec__(self, context, *args):
         raise NotImplementedError()
 
+    def close(self):
+        """Release what the component holds for the run, like processes.
+        Called once the pipeline ends."""
+        pass
+
     @classmethod
     def info(cls, _str=True):
         if _str:
@@ -169,6 +174,17 @@ class PipeComponent (object):
         pass
 
 
+def _trackTemplate(imagePyramid, templatePyramid, prevLocs, searchRange):
+    """Matches the template only within ``searchRange`` pixels of each of
+    ``prevLocs``, where it was found in the previous image, and only at the
+    finest pyramid level full searches go down to. Returns (scores, locs).
+    """
+    return cd.matchTemplatePyramidBatch(
+        imagePyramid, templatePyramid,
+        [[int(x), int(y)] for x, y in prevLocs],
+        SearchRange=[searchRange, searchRange], NoLevels=2, FinalLevel=1)
+
+
 class ImageMarginAdder(PipeComponent):
     actName = "addMargin"
     argNames = {
@@ -212,20 +228,19 @@ class ImageUndistorter (PipeComponent):
                                "coordinates"],
         "distortCoefs": [True, "5x1 matrix for image distortion"],
         "imageSize": [True, "2x1 matrix: [width, height]"],
-        "rotationAngle": [True, "rotation angle for the image"]}
+        "rotationAngle": [True, "rotation angle for the image"],
+        "mapCache": [False, "Directory to cache the undistortion maps in",
+                     None]}
 
     runExpects = [TimeStreamImage]
     runReturns = [TimeStreamImage]
 
     def __init__(self, context, **kwargs):
         super(ImageUndistorter, self).__init__(**kwargs)
-        self.UndistMapX, self.UndistMapY = cv2.initUndistortRectifyMap(
-            np.asarray(self.cameraMatrix),
-            np.asarray(self.distortCoefs),
-            None,
-            np.asarray(self.cameraMatrix),
-            tuple(self.imageSize),
-            cv2.CV_32FC1)
+        # The rotation is part of the maps
+        self.undistMaps = cd.undistortMaps(
+            self.cameraMatrix, self.distortCoefs, self.imageSize,
+            self.rotationAngle, CacheDir=self.mapCache)
 
     def __exec__(self, context, *args):
         tsi = args[0]
@@ -234,20 +249,15 @@ class ImageUndistorter (PipeComponent):
         if self.image is None:
             raise PCExBadImage(tsi.path)
 
-        if self.UndistMapX is not None and self.UndistMapY is not None:
-            self.imageUndistorted = cv2.remap(self.image.astype(np.uint8),
-                                              self.UndistMapX, self.UndistMapY,
-                                              cv2.INTER_CUBIC)
-        else:
-            self.imageUndistorted = self.image
-
-        tsi.pixels = cd.rotateImage(self.imageUndistorted,
-                                    self.rotationAngle)
+        self.imageUndistorted = cv2.remap(
+            self.image.astype(np.uint8, copy=False),
+            self.undistMaps[0], self.undistMaps[1], cv2.INTER_CUBIC)
+        tsi.pixels = self.imageUndistorted
         return [tsi]
 
     def show(self):
         plt.figure()
-        plt.imshow(cd.rotateImage(self.image))
+        plt.imshow(cd.rotateImage(self.image, self.rotationAngle))
         plt.title('Original image')
 
         plt.figure()
@@ -272,7 +282,12 @@ class ColorCardDetector (PipeComponent):
         "backgroundWindow": [False,
             "top-left and botom-right points of background region", []],
         "maxIntensity": [False,
-            "Max intensity when using white background", 255]}
+            "Max intensity when using white background", 255],
+        "paramsTolerance": [False,
+            "Reuse color parameters while card colors change at most this",
+            0],
+        "rotationAngle": [False,
+            "Card rotation, 0 or 180. Found, and remembered, when None", 0]}
 
     runExpects = [TimeStreamImage]
     runReturns = [TimeStreamImage, tuple]
@@ -285,6 +300,74 @@ class ColorCardDetector (PipeComponent):
         if not os.path.exists(self.ccf):
             configFilePath = os.path.dirname(context.ints.data['configFile'])
             self.ccf = os.path.join(configFilePath, self.colorcardFile)
+        # The template is the same for every image
+        self.colorcardImage = None
+        if not self.useWhiteBackground:
+            self.colorcardImage = read_image(self.ccf)[:, :, 0:3]
+            self.ccdPyramid = cd.createImagePyramid(self.colorcardImage)
+        if self.rotationAngle not in [0, 180, None]:
+            raise PCExBadConfig(self.actName, "rotationAngle",
+                                "Must be 0, 180 or None")
+        # Way up the card was found, checked again when its score drops
+        self._orientations = cd.OrientationCache()
+        # Card colors the previous parameters were estimated from
+        self._prevColors = None
+        self._prevParams = None
+        # Recalculated images don't reuse the parameters of previous runs
+        self._reuseStored = not (context.hasSubSecName("recalculate") and
+                                 context.recalculate)
+
+    def _withinTolerance(self, colors):
+        return colors is not None and \
+            np.abs(np.subtract(self.ccdColors, colors)).max() \
+            <= self.paramsTolerance
+
+    def _storedParams(self, context, tsi):
+        """Card colors and color parameters estimated for this image by a
+        previous run, from the image's data or that of the output
+        timestreams, if they were estimated from the same true colors and
+        card colors."""
+        if not self._reuseStored:
+            return None, None
+        trueColors = np.asarray(self.colorcardTrueColors).tolist()
+        stored = [tsi.data]
+        if context.hasSubSecName("outts") and tsi.datetime is not None:
+            key = ts_format_date(tsi.datetime)
+            for name in context.outts.listSubSecNames():
+                stored.append(
+                    context.outts.getVal(name).image_data.get(key, {}))
+        for data in stored:
+            params = data.get("colorParams")
+            if params is not None and \
+                    params.get("trueColors") == trueColors and \
+                    self._withinTolerance(params["colors"]):
+                return params["colors"], (np.array(params["matrix"]),
+                                          np.array(params["constant"]),
+                                          np.array(params["gamma"]))
+        return None, None
+
+    def _colorParams(self, context, tsi):
+        """Estimates the color parameters of the image, unless a previous run
+        did or the card colors are within paramsTolerance of those of the
+        previous estimate. The previous estimate is where the search starts.
+        """
+        colors, params = self._storedParams(context, tsi)
+        if params is None and self._withinTolerance(self._prevColors):
+            colors, params = self._prevColors, self._prevParams
+        if params is None:
+            colors = self.ccdColors
+            params = cd.estimateColorParameters(
+                self.colorcardTrueColors, self.ccdColors, self._prevParams)
+        # Colors and parameters always go together
+        self._prevColors, self._prevParams = colors, params
+        # Stored with the image so that later runs need not estimate them
+        tsi.data["colorParams"] = {
+            "trueColors": np.asarray(self.colorcardTrueColors).tolist(),
+            "colors": np.asarray(colors).tolist(),
+            "matrix": params[0].tolist(),
+            "constant": params[1].tolist(),
+            "gamma": params[2].tolist()}
+        return params
 
     def __exec__(self, context, *args):
         tsi = args[0]
@@ -293,32 +376,32 @@ class ColorCardDetector (PipeComponent):
         if meanIntensity < self.minIntensity:
             raise PCExImageTooDark(tsi.path)
         if not self.useWhiteBackground:
-            self.imagePyramid = cd.createImagePyramid(self.image)
-            ccdImg = read_image(self.ccf)[:, :, 0:3]
-            if ccdImg is None:
-                raise PCExBadImage(self.ccf)
-            self.ccdPyramid = cd.createImagePyramid(ccdImg)
             # create image pyramid for multiscale matching
-            SearchRange = [self.ccdPyramid[0].shape[1] * 1.5,
-                           self.ccdPyramid[0].shape[0] * 1.5]
+            self.imagePyramid = cd.createImagePyramid(self.image)
+            ccdImg = self.colorcardImage
+            SearchRange = [int(self.ccdPyramid[0].shape[1] * 1.5),
+                           int(self.ccdPyramid[0].shape[0] * 1.5)]
             score, loc, angle = cd.matchTemplatePyramid(
                 self.imagePyramid, self.ccdPyramid,
-                0, EstimatedLocation=self.colorcardPosition,
-                SearchRange=SearchRange)
+                self.rotationAngle, EstimatedLocation=self.colorcardPosition,
+                SearchRange=SearchRange, Orientations=self._orientations)
             if score > 0.3:
+                # loc is where the card is upright, in the rotated image
+                image = self.image
+                if angle == 180:
+                    image = np.rot90(self.image, 2)
                 # extract color information
-                self.foundCard = self.image[
+                self.foundCard = image[
                     loc[1] - ccdImg.shape[0] // 2:loc[1] + ccdImg.shape[0] // 2,
                     loc[0] - ccdImg.shape[1] // 2:loc[0] + ccdImg.shape[1] // 2]
                 self.ccdColors, _ = cd.getColorcardColors(self.foundCard,
                                                           GridSize=[6, 4])
-                self.ccdParams = cd.estimateColorParameters(
-                    self.colorcardTrueColors,
-                    self.ccdColors)
-                # Save colourcard image to instance
-                self.colorcardImage = ccdImg
+                self.ccdParams = self._colorParams(context, tsi)
                 # for displaying
                 self.loc = loc
+                if angle == 180:
+                    self.loc = [image.shape[1] - 1 - loc[0],
+                                image.shape[0] - 1 - loc[1]]
             else:
                 raise PCExCannotFindColorCard(tsi.path)
         else:
@@ -360,13 +443,36 @@ class ImageColorCorrector (PipeComponent):
     argNames = {
         "mess": [False, "Correct image color"],
         "minIntensity": [False, "Skip when below this value", 0],
-        "fieldOfView": [False, "Field of view in degrees", None]}
+        "fieldOfView": [False, "Field of view in degrees", None],
+        "threads": [False, "Threads to correct with, one per CPU if None",
+                    None]}
 
     runExpects = [TimeStreamImage, tuple]
     runReturns = [TimeStreamImage]
 
     def __init__(self, context, **kwargs):
         super(ImageColorCorrector, self).__init__(**kwargs)
+        # {(rows, cols): gain}, as streams can mix image sizes
+        self._fovGains = {}
+
+    def _fovGain(self, shape):
+        """float32 (rows, cols, 1) gain that corrects the intensity of each
+        pixel for its angle in the field of view. Computed once per shape.
+        """
+        if shape in self._fovGains:
+            return self._fovGains[shape]
+        rows, cols = shape
+        xp = np.arange(cols) - cols / 2
+        yp = np.arange(rows) - rows / 2
+        W = 2.0*np.tan(self.fieldOfView[0]/2.0/180.0*np.pi)
+        H = 2.0*np.tan(self.fieldOfView[1]/2.0/180.0*np.pi)
+        angleX = np.arctan(W/cols*xp)
+        angleY = np.arctan(H/rows*yp)
+        angles = np.sqrt(angleX[np.newaxis, :]**2 + angleY[:, np.newaxis]**2)
+        # scale intensity with inverse of angle cosine
+        gain = (1 / np.cos(angles)).astype(np.float32)[:, :, np.newaxis]
+        self._fovGains[shape] = gain
+        return gain
 
     def __exec__(self, context, *args):
         tsi, colorcardParam = args
@@ -375,14 +481,16 @@ class ImageColorCorrector (PipeComponent):
         meanIntensity = np.mean(image)
         colorMatrix, colorConstant, colorGamma = colorcardParam
         if colorMatrix is not None and meanIntensity > self.minIntensity:
-            self.imageCorrected = cd.correctColorVectorised(
-                image.astype(np.float),
-                colorMatrix,
-                colorConstant,
-                colorGamma)
-            self.imageCorrected = np.clip(np.round(self.imageCorrected),
-                                          0, 255)
-            self.imageCorrected = self.imageCorrected.astype(np.uint8)
+            lut = None
+            if image.dtype == np.uint8 and image.shape[2:] == (3,):
+                lut = cd.correctColorLUT(colorMatrix, colorConstant,
+                                         colorGamma)
+            if lut is not None:
+                self.imageCorrected = cv2.LUT(image, lut)
+            else:
+                self.imageCorrected = cd.correctColorTiled(
+                    image, colorMatrix, colorConstant, colorGamma,
+                    Threads=self.threads)
         else:
             # FIXME: This should be handled with an exception.
             LOG.warn('Skip color correction')
@@ -391,27 +499,17 @@ class ImageColorCorrector (PipeComponent):
 
         # adjust intensity due to angle in field of view
         if self.fieldOfView is not None:
-            imageSize = self.image.shape[1::-1]
-            xp, yp = np.meshgrid(range(imageSize[0]),
-                                 range(imageSize[1]))
-            xp -= imageSize[0]/2
-            yp -= imageSize[1]/2
-            W = 2.0*np.tan(self.fieldOfView[0]/2.0/180.0*np.pi)
-            H = 2.0*np.tan(self.fieldOfView[1]/2.0/180.0*np.pi)
-            angleX = np.arctan(W/imageSize[0]*xp)
-            angleY = np.arctan(H/imageSize[1]*yp)
-            self.angles = np.sqrt(angleX**2 + angleY**2)
-
-            # scale intensity with inverse of angle cosine
-            temp0 = self.imageCorrected[:, :, 0]/np.cos(self.angles)
-            temp1 = self.imageCorrected[:, :, 1]/np.cos(self.angles)
-            temp2 = self.imageCorrected[:, :, 2]/np.cos(self.angles)
-
-            # clip to range between 0 and 255 before converting to uint8
-            self.imageAdjusted = np.zeros_like(self.imageCorrected)
-            self.imageAdjusted[:, :, 0] = np.clip(np.round(temp0), 0, 255)
-            self.imageAdjusted[:, :, 1] = np.clip(np.round(temp1), 0, 255)
-            self.imageAdjusted[:, :, 2] = np.clip(np.round(temp2), 0, 255)
+            self.fovGain = self._fovGain(self.imageCorrected.shape[0:2])
+            self.imageAdjusted = np.empty_like(self.imageCorrected)
+            self.imageAdjusted[:, :, 3:] = 0
+            # Fuse the scaling, rounding and clipping, a tile at a time
+            for row in range(0, self.imageCorrected.shape[0], 128):
+                tile = np.multiply(self.imageCorrected[row:row + 128, :, 0:3],
+                                   self.fovGain[row:row + 128],
+                                   dtype=np.float32)
+                np.minimum(tile, 255, out=tile)
+                np.rint(tile, out=tile)
+                self.imageAdjusted[row:row + 128, :, 0:3] = tile
 
             tsi.pixels = self.imageAdjusted
         else:
@@ -433,7 +531,7 @@ class ImageColorCorrector (PipeComponent):
             plt.imshow(self.imageAdjusted)
             plt.title('Color- and intensity-corrected image')
             plt.figure()
-            plt.imshow(np.cos(self.angles))
+            plt.imshow(1 / self.fovGain[:, :, 0])
 
         plt.show()
 
@@ -446,21 +544,22 @@ class TrayDetector (PipeComponent):
             "File name pattern for trays such as Trays_%02d.png"],
         "trayNumber": [True, "Number of trays in given image"],
         "trayPositions": [True, "Estimated tray positions"],
-        "settingPath": [True, "Path to setting files"]}
+        "settingPath": [True, "Path to setting files"],
+        "tracking": [False, "Search near the trays of the previous image",
+                     False],
+        "trackingRange": [False, "Search range in pixels when tracking", 16],
+        "trackingScoreDrop": [False,
+            "Search fully when the score drops by this fraction", 0.1]}
 
     runExpects = [TimeStreamImage]
     runReturns = [TimeStreamImage, list, list]
 
     def __init__(self, context, **kwargs):
         super(TrayDetector, self).__init__(**kwargs)
-
-    def __exec__(self, context, *args):
-        tsi = args[0]
-        self.image = tsi.pixels
-        temp = np.zeros_like(self.image)
-        temp[:, :, :] = self.image[:, :, :]
-        temp[:, :, 1] = 0  # suppress green channel
-        self.imagePyramid = cd.createImagePyramid(temp)
+        # {tray index: location} in the previous image and
+        # {tray index: score} of the last full search, for tracking
+        self._prevTrayLocs = {}
+        self._trackScores = {}
         self.trayPyramids = []
         for i in range(self.trayNumber):
             # fixed tray image so that perspective postions of the trays are
@@ -476,20 +575,40 @@ class TrayDetector (PipeComponent):
             trayPyramid = cd.createImagePyramid(trayImage)
             self.trayPyramids.append(trayPyramid)
 
+    def __exec__(self, context, *args):
+        tsi = args[0]
+        self.image = tsi.pixels
+        temp = np.zeros_like(self.image)
+        temp[:, :, :] = self.image[:, :, :]
+        temp[:, :, 1] = 0  # suppress green channel
+        self.imagePyramid = cd.createImagePyramid(temp)
+
         self.trayLocs = []
         for i, trayPyramid in enumerate(self.trayPyramids):
-            SearchRange = [trayPyramid[0].shape[1] // 6,
-                           trayPyramid[0].shape[0] // 6]
-            score, loc, angle = cd.matchTemplatePyramid(
-                self.imagePyramid,
-                trayPyramid,
-                RotationAngle=0,
-                EstimatedLocation=self.trayPositions[i],
-                SearchRange=SearchRange)
-            if score < 0.3:
-                raise PCExCannotFindTray(i, tsi.path)
+            loc = None
+            if self.tracking and i in self._prevTrayLocs:
+                (score, ), (loc, ) = _trackTemplate(
+                    self.imagePyramid, trayPyramid, [self._prevTrayLocs[i]],
+                    self.trackingRange)
+                if score < self._trackScores[i] * (1 - self.trackingScoreDrop):
+                    LOG.info("Lost track of tray {}".format(i))
+                    loc = None
+
+            if loc is None:
+                SearchRange = [trayPyramid[0].shape[1] // 6,
+                               trayPyramid[0].shape[0] // 6]
+                score, loc, angle = cd.matchTemplatePyramid(
+                    self.imagePyramid,
+                    trayPyramid,
+                    RotationAngle=0,
+                    EstimatedLocation=self.trayPositions[i],
+                    SearchRange=SearchRange)
+                if score < 0.3:
+                    raise PCExCannotFindTray(i, tsi.path)
+                self._trackScores[i] = score
 
             self.trayLocs.append(loc)
+        self._prevTrayLocs = dict(enumerate(self.trayLocs))
 
         tsi.pixels = self.image
         return([tsi, self.imagePyramid, self.trayLocs])
@@ -520,17 +639,22 @@ class PotDetector (PipeComponent):
         "potSize": [True, "Estimated pot size"],
         "traySize": [True, "Estimated tray size"],
         "settingPath": [True, "Path to setting files"],
-        "startingPotId": [False, "Starting offset for pot IDs", 1]}
+        "startingPotId": [False, "Starting offset for pot IDs", 1],
+        "tracking": [False, "Search near the pots of the previous image",
+                     False],
+        "trackingRange": [False, "Search range in pixels when tracking", 16],
+        "trackingScoreDrop": [False,
+            "Search fully when the score drops by this fraction", 0.1]}
 
     runExpects = [TimeStreamImage, list, list]
     runReturns = [TimeStreamImage]
 
     def __init__(self, context, **kwargs):
         super(PotDetector, self).__init__(**kwargs)
-
-    def __exec__(self, context, *args):
-        tsi, self.imagePyramid, self.trayLocs = args
-        self.image = tsi.pixels
+        # {tray index: locations} matched in the previous image and
+        # {tray index: scores} of the last full searches, for tracking
+        self._prevPotLocs = {}
+        self._trackScores = {}
         # read pot template image and scale to the pot size
         potFile = os.path.join(
             context.ints.path,
@@ -549,6 +673,10 @@ class PotDetector (PipeComponent):
              potImage.shape[0]))
         self.potPyramid = cd.createImagePyramid(potTemplateImage)
 
+    def __exec__(self, context, *args):
+        tsi, self.imagePyramid, self.trayLocs = args
+        self.image = tsi.pixels
+
         XSteps = int(round(self.traySize[0] / float(self.potSize[0])))
         YSteps = int(round(self.traySize[1] / float(self.potSize[1])))
         StepX = self.traySize[0] // XSteps
@@ -557,7 +685,7 @@ class PotDetector (PipeComponent):
         self.potLocs2 = []
         self.potLocs2_ = []
         potGridSize = [4, 5]
-        for trayLoc in self.trayLocs:
+        for t, trayLoc in enumerate(self.trayLocs):
             if trayLoc is None:
                 self.potLocs2.append(None)
                 continue
@@ -566,45 +694,54 @@ class PotDetector (PipeComponent):
             SearchRange = [self.potPyramid[0].shape[1] // 4,
                            self.potPyramid[0].shape[0] // 4]
             # SearchRange = [32, 32]
-            locX = np.zeros(potGridSize)
-            locY = np.zeros(potGridSize)
-            for k in range(potGridSize[0]):
-                for l in range(potGridSize[1]):
-                    estimateLoc = [StartX + StepX * k, StartY - StepY * l]
-                    score, loc, angle = cd.matchTemplatePyramid(
-                        self.imagePyramid,
-                        self.potPyramid,
-                        RotationAngle=0,
-                        EstimatedLocation=estimateLoc,
-                        NoLevels=3,
-                        SearchRange=SearchRange)
-                    locX[k, l], locY[k, l] = loc
+            # Pots in row-major order of the (k, l) grid
+            K, L = np.mgrid[0:potGridSize[0], 0:potGridSize[1]]
+            estimateLocs = [[StartX + StepX * k, StartY - StepY * l]
+                            for k, l in zip(K.flat, L.flat)]
+            locs = [None] * len(estimateLocs)
+            scores = self._trackScores.setdefault(t, [0.0] * len(locs))
+            prevLocs = self._prevPotLocs.get(t)
+            if self.tracking and prevLocs is not None:
+                trackScores, trackLocs = _trackTemplate(
+                    self.imagePyramid, self.potPyramid, prevLocs,
+                    self.trackingRange)
+                for j, score in enumerate(trackScores):
+                    if score >= scores[j] * (1 - self.trackingScoreDrop):
+                        locs[j] = trackLocs[j]
+            lost = [j for j, loc in enumerate(locs) if loc is None]
+            if len(lost) > 0:
+                # All pots of the tray correlated in one go per level
+                lostScores, lostLocs = cd.matchTemplatePyramidBatch(
+                    self.imagePyramid,
+                    self.potPyramid,
+                    [estimateLocs[j] for j in lost],
+                    NoLevels=3,
+                    SearchRange=SearchRange)
+                for j, score, loc in zip(lost, lostScores, lostLocs):
+                    scores[j] = score
+                    locs[j] = loc
+            self._prevPotLocs[t] = locs
+            locX = np.array([x for x, _ in locs], dtype=np.float)
+            locY = np.array([y for _, y in locs], dtype=np.float)
+            locX = locX.reshape(potGridSize)
+            locY = locY.reshape(potGridSize)
 
             # correct for detection error
-            potLocs = []
-            potLocs_ = []
-            diffXX = locX[1:, :] - locX[:-1, :]
-            diffXY = locX[:, 1:] - locX[:, :-1]
-            diffYX = locY[1:, :] - locY[:-1, :]
-            diffYY = locY[:, 1:] - locY[:, :-1]
-            diffXXMedian = np.median(diffXX)
-            diffXYMedian = np.median(diffXY)
-            diffYXMedian = np.median(diffYX)
-            diffYYMedian = np.median(diffYY)
-            for k in range(potGridSize[0]):
-                for l in range(potGridSize[1]):
-                    locX[k, l] = trayLoc[0] + diffXXMedian * (k - (potGridSize[0] - 1.0) / 2.0) + \
-                        diffXYMedian * (l - (potGridSize[1] - 1.0) / 2.0)
-                    locY[k, l] = trayLoc[1] + diffYXMedian * (k - (potGridSize[0] - 1.0) / 2.0) + \
-                        diffYYMedian * (l - (potGridSize[1] - 1.0) / 2.0)
-                    # this fixes perpective shift
-                    # TODO: need a more elegant solution
-                    locY[k, l] = locY[k, l] + 10
-
-                    potLocs.append([locX[k, l], locY[k, l]])
-                    potLocs_.append(estimateLoc)
-            self.potLocs2.append(potLocs)
-            self.potLocs2_.append(potLocs_)
+            diffXXMedian = np.median(np.diff(locX, axis=0))
+            diffXYMedian = np.median(np.diff(locX, axis=1))
+            diffYXMedian = np.median(np.diff(locY, axis=0))
+            diffYYMedian = np.median(np.diff(locY, axis=1))
+            K = K - (potGridSize[0] - 1.0) / 2.0
+            L = L - (potGridSize[1] - 1.0) / 2.0
+            locX = trayLoc[0] + diffXXMedian * K + diffXYMedian * L
+            locY = trayLoc[1] + diffYXMedian * K + diffYYMedian * L
+            # this fixes perpective shift
+            # TODO: need a more elegant solution
+            locY = locY + 10
+
+            self.potLocs2.append(
+                [list(x) for x in zip(locX.flat, locY.flat)])
+            self.potLocs2_.append(estimateLocs)
 
         # Create a new ImagePotMatrix with newly discovered locations
         ipmPrev = None
@@ -617,7 +754,8 @@ class PotDetector (PipeComponent):
             growM = round(max(self.potSize) / 2)
         else:
             # if no user vals, we try to calculate it.
-            flattened = list(chain.from_iterable(self.potLocs2))
+            flattened = list(chain.from_iterable(
+                [x for x in self.potLocs2 if x is not None]))
             sortDist = np.sort(spatial.distance.pdist(flattened))
             sortDist = sortDist[0:len(flattened)]
             growM = round(np.median(sortDist) / 2)
@@ -627,6 +765,10 @@ class PotDetector (PipeComponent):
         potID = self.startingPotId
         for tray in self.potLocs2:
             trayID = 1
+            if tray is None:
+                # Keep the ids of the pots in the following trays
+                potID += potGridSize[0] * potGridSize[1]
+                continue
             for c in tray:  # c => center
                 m = dict([[x, context.metas.getVal(x)[potID]]
                         for x in context.metas.listSubSecNames()
@@ -719,7 +861,8 @@ class PlantExtractor (PipeComponent):
         "minIntensity": [False, "Skip if intensity below value", 0],
         "meth": [False, "Segmentation Method", "k-means-square"],
         "methargs": [False, "Args: maxIter, epsilon, attempts", {}],
-        "parallel": [False, "Whether to run in parallel", False]}
+        "parallel": [False, "Whether to run in parallel", False],
+        "workers": [False, "Parallel processes, one per CPU if None", None]}
 
     runExpects = [TimeStreamImage]
     runReturns = [TimeStreamImage]
@@ -731,6 +874,7 @@ class PlantExtractor (PipeComponent):
                                 "Invalid method for component")
         # FIXME: Check the arg names. Inform an error in yaml file if error.
         self.segmenter = tm_ps.segmentingMethods[self.meth](**self.methargs)
+        self._segPool = None
 
     def __exec__(self, context, *args):
         tsi = args[0]
@@ -749,50 +893,42 @@ class PlantExtractor (PipeComponent):
         return [tsi]
 
     def segAllPots(self):
-        if not self.parallel:
+        if isinstance(self.segmenter, tm_ps.PotSegmenter_KmeansFrame):
+            # One segmentation for all the pots of the image
+            rects = [(key, iph.rect.asList())
+                     for key, iph in self.ipm.iter_through_pots()]
+            masks = self.segmenter.segmentFrame(self.ipm.image.pixels, rects)
+            for key, iph in self.ipm.iter_through_pots():
+                iph.mask = iph.getSegmented(masks[key])
+            return
+
+        # Pipelines that already run in parallel can't start processes
+        if not self.parallel or multiprocessing.current_process().daemon:
             for key, iph in self.ipm.iter_through_pots():
                 # Property will trigger the segmentation (from where???)
                 _ = iph.mask
             return
 
-        # Parallel from here: We create a child process for each pot and pipe
-        # the pickled result back to the parent.
-        childPids = []
-        for key, iph in self.ipm.iter_through_pots():
-            In, Out = os.pipe()
-            pid = os.fork()
-            if pid != 0:  # In parent
-                os.close(Out)
-                childPids.append([iph, pid, In])
-                continue
+        # Parallel from here: The pool is kept for all the images
+        if self._segPool is None:
+            self._segPool = tm_ps.SegmentingPool(self.segmenter, self.workers)
+        rects = [(key, iph.rect.asList())
+                 for key, iph in self.ipm.iter_through_pots()]
+        for key, msk, err in self._segPool.segment(self.ipm.image.pixels,
+                                                    rects):
+            iph = self.ipm.getPot(key)
+            if err is None:
+                iph.mask = iph.getSegmented(msk)
+            else:
+                # The writer of features records the pot in the audit
+                LOG.error("%s: %s", PCExSegmentation(
+                    key, self.ipm.image.path).message, err)
+                iph.segError = err
 
-            # Child Section
-            try:
-                os.close(In)
-                msk = cPickle.dumps(iph.getSegmented())
-                cOut = os.fdopen(Out, "wb", sys.getsizeof(msk))
-                cOut.write(msk)
-                cOut.close()
-
-            except Exception:
-                os._exit(1)
-
-            finally:
-                os._exit(0)
-            # Child Section
-
-        for iph, pid, In in childPids:
-            pIn = os.fdopen(In, "rb")
-            msk = cPickle.loads(pIn.read())
-            p, status = os.waitpid(pid, 0)
-            pIn.close()
-            if (status is not 1):
-                iph.mask = msk
-            # FIXME: We need to handle the case where there is a seg error
-            # The challange is to put this in the audit file without a
-            # global exception.
-
-        return
+    def close(self):
+        if self._segPool is not None:
+            self._segPool.close()
+            self._segPool = None
 
     def show(self):
         self.ipm.show()
@@ -854,28 +990,120 @@ class ResultingFeatureWriter(PipeComponent):
         self.outputdir = context.outputPrefixPath + self.outname
         self.outputPrefix = context.outputPrefix
 
+        # Parallel runs of the pipeline each write to their own part, which
+        # are merged in timestamp order with mergeParts.
+        self._part = None
+        if context.hasSubSecName("outputPart"):
+            self._part = context.outputPart
+
         if not os.path.exists(self.outputdir):
             os.makedirs(self.outputdir)
 
-        # Output audit file
-        self._auditFile = os.path.join(self.outputdir,
-                                       self.outputPrefix + "-audit." + self.ext)
-
-        # Filenames for every feature.
-        self._featFiles = {}
-        for fName in tm_ps.StatParamCalculator.statParamMethods():
-            full_fname = self.outputPrefix + "-" + fName + "." + self.ext
-            self._featFiles[fName] = os.path.join(self.outputdir, full_fname)
+        # Output audit file and filenames for every feature.
+        self._auditFile, self._featFiles = self._outFiles(self._part)
 
         self._prevCsvIndex = {}
-        if self.overwrite:
+        if self.overwrite or self._part is not None:
             # Remove any conflicting csv
             for fName, fPath in self._featFiles.iteritems():
                 if os.path.exists(fPath):
                     os.remove(fPath)
+            # The audit of a part can only be left over from a failed run
+            if self._part is not None and os.path.exists(self._auditFile):
+                os.remove(self._auditFile)
         else:
             self._initPrevCsvIndex()
 
+    def _outFiles(self, part=None):
+        """Audit file and {featName: csvFile} paths of an output part"""
+        prefix = self.outputPrefix
+        if part is not None:
+            prefix = prefix + "-" + part
+        auditFile = os.path.join(self.outputdir,
+                                 prefix + "-audit." + self.ext)
+        featFiles = {}
+        for fName in tm_ps.StatParamCalculator.statParamMethods():
+            full_fname = prefix + "-" + fName + "." + self.ext
+            featFiles[fName] = os.path.join(self.outputdir, full_fname)
+        return auditFile, featFiles
+
+    def mergeParts(self, parts):
+        """Append the output of the writers of ``parts`` to ours, in order.
+
+        Every part is written by a pipeline processing a contiguous chunk of
+        timestamps. Rows are re-sequenced following the audit file of each
+        part so the result is the same as a single writer processing all the
+        timestamps. Part files are removed once merged.
+
+        Args:
+          parts(list): ``outputPart`` names of the parts, in timestamp order.
+        """
+        for part in parts:
+            auditFile, featFiles = self._outFiles(part)
+            audits = []
+            if os.path.exists(auditFile):
+                fd = open(auditFile, "r")
+                for l in fd:
+                    # Skip the code meanings
+                    if l.startswith(" ") or l.startswith("Code Meanings"):
+                        continue
+                    ts, val = l.rstrip("\n").rsplit(",", 1)
+                    audits.append((ts, val))
+                    self._appendToAudit(ts, val)
+                fd.close()
+                os.remove(auditFile)
+
+            for fName, fPath in self._featFiles.iteritems():
+                headers, rows = self._readPart(featFiles[fName])
+                if not os.path.exists(fPath):
+                    if len(headers) < 1 and not self.overwrite:
+                        res = self._recoverFromPrev(self.tsHName, fName)
+                        if res is not None:
+                            headers = [res]
+                    if len(headers) > 0:
+                        fd = open(fPath, "a")
+                        fd.write("%s" % "".join(headers))
+                        fd.close()
+
+                for ts, val in audits:
+                    if ts == ResultingFeatureWriter.errStr or \
+                            self._isPotAudit(val):
+                        continue
+                    outputline = None
+                    if not self.overwrite:
+                        outputline = self._recoverFromPrev(ts, fName)
+                    if outputline is None:
+                        outputline = rows.get(ts)
+                    if outputline is not None:
+                        fd = open(fPath, "a")
+                        fd.write("%s" % outputline)
+                        fd.close()
+                    elif val != str(PCExCannotFindFeatures.id):
+                        # Part had no headers yet when the error was seen.
+                        self._addErrStr(ts, fPath)
+
+                if os.path.exists(featFiles[fName]):
+                    os.remove(featFiles[fName])
+
+    def _readPart(self, fPath):
+        """Returns the header lines and {timestamp: line} of a part file"""
+        headers = []
+        rows = {}
+        if not os.path.exists(fPath):
+            return headers, rows
+        # Parts always start with the headers, ending in the timestamp one
+        inHeaders = True
+        fd = open(fPath, "r")
+        for l in fd:
+            ts = l.split(",")[0]
+            if inHeaders:
+                headers.append(l)
+                inHeaders = ts != self.tsHName
+            else:
+                rows[ts] = l
+        fd.close()
+        return headers, rows
+
     def __exec__(self, context, *args):
         img = args[0]
         ipm = img.ipm
@@ -916,6 +1144,11 @@ class ResultingFeatureWriter(PipeComponent):
             fd.write("%s" % outputline)
             fd.close()
 
+        # Pots that failed segmentation, before the line of the image
+        for potId in potIds:
+            if ipm.getPot(potId).segError is not None:
+                self._appendToAudit(ts, "%d:%s" % (PCExSegmentation.id,
+                                                   potId))
         self._appendToAudit(ts, str(-1))
         return args
 
@@ -1086,6 +1319,11 @@ class ResultingFeatureWriter(PipeComponent):
 
             fd.close()
 
+    @staticmethod
+    def _isPotAudit(val):
+        """Whether an audit value is that of a pot, as code:potId"""
+        return ":" in val
+
     def _appendToAudit(self, ts, val):
         if not os.path.exists(self._auditFile):
             fd = open(self._auditFile, 'a')
@@ -1112,6 +1350,27 @@ class ResultingImageWriter (PipeComponent):
 
     def __init__(self, context, **kwargs):
         super(ResultingImageWriter, self).__init__(**kwargs)
+        # Pots are painted into this, reused while images keep their shape
+        self._buffer = None
+
+    def _composite(self, pixels):
+        """Copies ``pixels`` into the buffer and paints every pot of
+        self.img into it, in place. Pots are cut from the buffer, so they
+        see the pots painted before them, as when each was painted on a
+        copy of the previous result."""
+        if self._buffer is None or self._buffer.shape != pixels.shape \
+                or self._buffer.dtype != pixels.dtype:
+            self._buffer = np.empty_like(pixels)
+        np.copyto(self._buffer, pixels)
+        self.img.pixels = self._buffer
+        if self.masked:
+            self.img.ipm.render_masked(self._buffer, features=self.addStats)
+        else:
+            for key, iph in self.img.ipm.iter_through_pots():
+                r = iph.rect
+                iph.getImage(features=self.addStats,
+                             out=self._buffer[r[1]:r[3], r[0]:r[2], :])
+        return self._buffer
 
     def __exec__(self, context, *args):
         """
@@ -1119,19 +1378,16 @@ class ResultingImageWriter (PipeComponent):
         Once we have written, we revert self.img.pixels to its original value.
         """
         self.img = args[0]
-        origimg = self.img.pixels.copy()
+        origimg = self.img.pixels
         ts_out = context.getVal("outts." + self.outstream)
         self.img.parent_timestream = ts_out
         self.img.data["processed"] = "yes"
 
-        if self.img.ipm is not None:
-            for key, iph in self.img.ipm.iter_through_pots():
-                self.img.pixels = iph.getImage(
-                    masked=self.masked, features=self.addStats,
-                    inSuper=True)
+        # Without masks or features the pots leave the image as is
+        if self.img.ipm is not None and (self.masked or self.addStats):
+            self._composite(origimg)
 
         ts_out.write_image(self.img)
-        ts_out.write_metadata()
 
         # reset to move forward
         self.img.parent_timestream = None
@@ -1167,15 +1423,23 @@ class ResizeImage (PipeComponent):
             return args
 
         img = args[0]
+        img.pixels = self.resized(img)
+
+        return [img]
+
+    def resized(self, img):
+        """Returns new pixels of ``img`` at ``resolution``.
+
+        Pixels not loaded yet are decoded straight at a reduced size when the
+        image is a JPEG, see ``TimeStreamImage.pixels_at``.
+        """
         if isinstance(self.resolution, tuple):
-            img.pixels = skimage.transform.resize(img.pixels, self.resolution)
+            return img.pixels_at(shape=self.resolution[0:2])
         elif isinstance(self.resolution, float):
-            img.pixels = skimage.transform.rescale(img.pixels, self.resolution)
+            return img.pixels_at(scale=self.resolution)
         else:
             raise PCExBreakInPipeline(self.actName, "Invalid resolution value")
 
-        return [img]
-
 
 class DerandomizeTimeStreams (PipeComponent):
     actName = "derandomize"
@@ -1340,10 +1604,8 @@ class DerandomizeTimeStreams (PipeComponent):
                 tsimgs[pth] = ts.curr()
             else:
                 # Get the closest image to timestamp
-                deltas = [abs(timestamp-t) for t in ts.timestamps]
-                tInd = deltas.index(min(deltas))
-                tsimgs[pth] = ts.getImgByTimeStamp(ts.timestamps[tInd],
-                                                   update_index=True)
+                tsimgs[pth] = ts.getImgByTimeStamp(
+                    ts.timestamp_index.nearest(timestamp), update_index=True)
 
         # mid -> meta ids
         # pth -> TimeStream path
@@ -1387,8 +1649,15 @@ class ResizeAndWriteImage (PipeComponent):
         self.resultingImageWriter = ResultingImageWriter(context, **kwargs)
 
     def __exec__(self, context, *args):
-        res = self.resizeImage(context, *[args[0].clone(copy_pixels=True)])
-        self.resultingImageWriter(context, *res)
+        img = args[0]
+        # The writer leaves pixels untouched, so res shares those of img
+        res = img.clone()
+        if self.resizeImage.resolution is None:
+            res.pixels = img.pixels
+        else:
+            # Resize from img itself so unread JPEGs are decoded small
+            res.pixels = self.resizeImage.resized(img)
+        self.resultingImageWriter(context, res)
         return args
 
     def show(self):
@@ -116,6 +116,11 @@ class ImagePipeline (object):
 
         return (res)
 
+    def close(self):
+        """Close all components, once there is nothing left to process"""
+        for elem in self.pipeline:
+            elem.close()
+
     @classmethod
     def printCompList(cls):
         for clKey, clVal in ImagePipeline.complist.iteritems():
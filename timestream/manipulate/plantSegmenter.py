@@ -31,6 +31,8 @@ from skimage.measure import regionprops
 from skimage.measure import label
 import cv2
 import inspect
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 
 
 class StatParamValue(object):
@@ -145,33 +147,76 @@ class StatParamCalculator(object):
     #       Find a place to put this string so its in the general scope.
     errStr = "NaN"
 
+    def __init__(self):
+        # The mask features were last calculated for, and its intermediates
+        self._mask = None
+        self._shared = {}
+
+    def _sharedValue(self, mask, name, calc):
+        """The intermediate ``name`` of ``mask``. It is shared by all the
+        features of a mask, so ``calc(mask)`` runs once, when a feature
+        first needs it."""
+        if mask is not self._mask:
+            self._mask = mask
+            self._shared = {}
+        if name not in self._shared:
+            self._shared[name] = calc(mask)
+        return self._shared[name]
+
+    def _regionProps(self, mask):
+        """The regionprops of ``mask``, None if it is empty. Labeling,
+        moments and the convex hull are computed lazily by skimage."""
+        def calc(mask):
+            props = regionprops(mask.astype("int8"))
+            return props[0] if len(props) > 0 else None
+        return self._sharedValue(mask, "region", calc)
+
+    def _rowProfile(self, mask):
+        """The green pixels of each row of ``mask`` and their cumulative
+        sum normalised to 1, which is None if ``mask`` is empty."""
+        def calc(mask):
+            rows = mask.sum(axis=1).astype(np.float64)
+            cumSum = np.cumsum(rows)
+            if cumSum[-1] == 0:
+                return rows, None
+            return rows, cumSum/cumSum[-1]
+        return self._sharedValue(mask, "rowProfile", calc)
+
+    @staticmethod
+    def _rowCrossing(cumSum, fraction, start, default, stop=None):
+        """The first row from ``start`` to ``stop`` where the normalised
+        ``cumSum`` reaches ``fraction``, ``default`` if there is none."""
+        stop = len(cumSum) if stop is None else stop
+        row = start + np.searchsorted(cumSum[start:stop], fraction)
+        return int(row) if row < stop else default
+
     def area(self, mask, img=None):
         retVal = 0.0
-        area = regionprops(mask.astype("int8"), ["Area"])
-        if len(area) > 0:
-            retVal = area[0]["Area"]
+        area = self._regionProps(mask)
+        if area is not None:
+            retVal = area["Area"]
 
         return StatParamValue("area", retVal, rMax=float("Inf"))
 
     def perimeter(self, mask, img=None):
         retVal = 0.0
-        perim = regionprops(mask.astype("int8"), ["Perimeter"])
+        perim = self._regionProps(mask)
 
         bmsk = ndimage.binary_erosion(mask, np.ones((3,3)), border_value=0)
         bmsk = mask - bmsk
         xycoords = np.where(bmsk == 1)
-        if len(perim) > 0:
-            retVal = perim[0]["Perimeter"]
+        if perim is not None:
+            retVal = perim["Perimeter"]
 
         return StatParamPerimeter("perimeter", retVal, xycoords)
 
     def roundness(self, mask, img=None):
         # (4 (pi) * AREA) / PERIM^2
         retVal = 0.0
-        roundness = regionprops(mask.astype("int8"), ["Area", "Perimeter"])
-        if len(roundness) > 0:
-            area = roundness[0]["Area"]
-            perim = roundness[0]["Perimeter"]
+        roundness = self._regionProps(mask)
+        if roundness is not None:
+            area = roundness["Area"]
+            perim = roundness["Perimeter"]
             retVal = (4 * np.pi * area) / np.power(perim, 2)
 
         return StatParamValue("roundness", retVal, rMax=float("Inf"))
@@ -179,9 +224,9 @@ class StatParamCalculator(object):
     def compactness(self, mask, img=None):
         # In skimage its called solidity
         retVal = StatParamCalculator.errStr
-        compactness = regionprops(mask.astype("int8"), ["Solidity"])
-        if len(compactness) > 0:
-            retVal = compactness[0]["Solidity"]
+        compactness = self._regionProps(mask)
+        if compactness is not None:
+            retVal = compactness["Solidity"]
 
         return StatParamValue("compactness", retVal, rMax=float("Inf"))
 
@@ -189,9 +234,9 @@ class StatParamCalculator(object):
         # In skimage eccentricity ratio between minor and  major axis length of
         # the ellipse with the same second moment as the region.
         retVal = StatParamCalculator.errStr
-        ecce = regionprops(mask.astype("int8"), ["Eccentricity"])
-        if len(ecce) > 0:
-            retVal = ecce[0]["Eccentricity"]
+        ecce = self._regionProps(mask)
+        if ecce is not None:
+            retVal = ecce["Eccentricity"]
 
         return StatParamValue("eccentricity", retVal)
 
@@ -200,9 +245,9 @@ class StatParamCalculator(object):
         #      the ratio between foci and major axis of the ellipse with the
         #      same second moment as the region. We calc with eccentricity
         retVal = StatParamCalculator.errStr
-        ecce = regionprops(mask.astype("int8"), ["Eccentricity"])
-        if len(ecce) > 0:
-            retVal = 1 - (ecce[0]["Eccentricity"])**2
+        ecce = self._regionProps(mask)
+        if ecce is not None:
+            retVal = 1 - (ecce["Eccentricity"])**2
 
         return StatParamValue("rms", retVal)
 
@@ -226,7 +271,8 @@ class StatParamCalculator(object):
         #        distance transform that are leaves but are not a max.
 
         # 1. Calc the distance transform
-        dt = cv2.distanceTransform(mask.astype("uint8"), cv2.cv.CV_DIST_C, 5)
+        distC = cv2.DIST_C if hasattr(cv2, "DIST_C") else cv2.cv.CV_DIST_C
+        dt = cv2.distanceTransform(mask.astype("uint8"), distC, 5)
 
         # 2. Mark non-max coordinates
         #    Potential maxima where 8-neighbor max <= pixel.
@@ -243,15 +289,20 @@ class StatParamCalculator(object):
 
         # 3. Prune connected components.
         cc, ccNum = label(maximas, return_num=True)
-        sel = np.ones([3, 3]).astype("uint8")
-        for i in range(1, ccNum):
-            ccmsk = (cc == i).astype("float32")
-            ccCoords = np.where(ccmsk == 1)
-            perim = cv2.dilate(ccmsk, sel) - ccmsk
-            perimCoords = np.where(perim == 1)
-            if np.min(dt[ccCoords]) <= np.max(dt[perimCoords]):
-                # No max if connected component has an adjacent max or equal.
-                cc[ccCoords] = 0
+        if ccNum > 1:
+            # Components are 8-connected, so their perimeters are background.
+            # The max of each perimeter is the max over the component of the
+            # background dilated into it.
+            dtBg = np.where(cc == 0, dt, -1).astype("float32")
+            perimMax = ndimage.grey_dilation(dtBg, footprint=np.ones([3, 3]),
+                                             mode="constant", cval=-1)
+            ccIds = np.arange(1, ccNum)
+            ccMin = ndimage.minimum(dt, cc, ccIds)
+            ccMax = ndimage.maximum(perimMax, cc, ccIds)
+            # No max if connected component has an adjacent max or equal.
+            pruned = np.zeros(ccNum + 1, dtype=bool)
+            pruned[ccIds] = np.asarray(ccMin) <= np.asarray(ccMax)
+            cc[pruned[cc]] = 0
 
         # 4. Find leaf centers.
         centers = []
@@ -266,10 +317,10 @@ class StatParamCalculator(object):
         Plant height
         Only used for images taken from the side of a plant.
         '''
-        bbox = regionprops(mask.astype("int8"), ["bbox"])
-        if len(bbox) == 0:
+        bbox = self._regionProps(mask)
+        if bbox is None:
             return StatParamValue("height", 0.0)  # FIXME: is this the best default?
-        min_row, min_col, max_row, max_col = bbox[0]["bbox"]
+        min_row, min_col, max_row, max_col = bbox["bbox"]
         return StatParamValue("height", max_row - min_row,
                               rMax=float("Inf"))
 
@@ -279,27 +330,15 @@ class StatParamCalculator(object):
         integration. This is supposed to provide a more less noisy height
         Only used for images taken from the side of a plant.
         '''
-        GreenPixels = np.zeros(mask.shape[0])
-        for i in range(mask.shape[0]):
-            GreenPixels[i] = np.sum(mask[i, :])
-        GreenPixelsCumSum = np.cumsum(GreenPixels)
-        if GreenPixelsCumSum[-1] != 0:
-            GreenPixelsCumSum = GreenPixelsCumSum/GreenPixelsCumSum[-1]
-        else:
+        GreenPixels, GreenPixelsCumSum = self._rowProfile(mask)
+        if GreenPixelsCumSum is None:
             return StatParamValue("height2", 0.0, rMax=float("Inf"))
 
         # Plant top when reaching 5% of total green pixels
-        PlantTop = 0
-        for i in range(mask.shape[0]):
-            if GreenPixelsCumSum[i] >= 0.05:
-                PlantTop = i
-                break
+        PlantTop = self._rowCrossing(GreenPixelsCumSum, 0.05, 0, 0)
         # Plant bottom when reaching 5% of total green pixels
-        PlantBottom = mask.shape[0]
-        for i in range(mask.shape[0]):
-            if GreenPixelsCumSum[i] >= 0.95:
-                PlantBottom = i
-                break
+        PlantBottom = self._rowCrossing(GreenPixelsCumSum, 0.95, 0,
+                                        mask.shape[0])
 
         return StatParamValue("height2", PlantBottom-PlantTop,
                               rMax=float("Inf"))
@@ -309,34 +348,18 @@ class StatParamCalculator(object):
         Plant wilting is at 50% of green pixel integration.
         Only used for images taken from the side of a plant.
         '''
-        GreenPixels = np.zeros(mask.shape[0])
-        for i in range(mask.shape[0]):
-            GreenPixels[i] = np.sum(mask[i, :])
+        GreenPixels, GreenPixelsCumSum = self._rowProfile(mask)
+        if GreenPixelsCumSum is None:
+            return StatParamValue("wilting", 0.0, rMax=float("Inf"))
 
         # get range of plant height
-        PlantTop = 0
-        for i in range(mask.shape[0]):
-            if GreenPixels[i] != 0:
-                PlantTop = i
-                break
-        PlantBottom = mask.shape[0]
-        for i in range(mask.shape[0]-1, -1, -1):
-            if GreenPixels[i] != 0:
-                PlantBottom = i
-                break
+        GreenRows = np.flatnonzero(GreenPixels)
+        PlantTop = int(GreenRows[0])
+        PlantBottom = int(GreenRows[-1])
 
         # get wilting height
-        GreenPixelsCumSum = np.cumsum(GreenPixels)
-        if GreenPixelsCumSum[-1] != 0:
-            GreenPixelsCumSum = GreenPixelsCumSum/GreenPixelsCumSum[-1]
-        else:
-            return StatParamValue("wilting", 0.0, rMax=float("Inf"))
-
-        WiltedHeight = PlantTop
-        for i in range(PlantTop, PlantBottom):
-            if GreenPixelsCumSum[i] >= 0.5:
-                WiltedHeight = i
-                break
+        WiltedHeight = self._rowCrossing(GreenPixelsCumSum, 0.5, PlantTop,
+                                         PlantTop, PlantBottom)
         Wilting = float(PlantBottom-WiltedHeight)
         return StatParamValue("wilting", Wilting)
 
@@ -347,33 +370,18 @@ class StatParamCalculator(object):
         green pixels. Plant wilting is at 50% of green pixel integration.
         Only used for images taken from the side of a plant.
          '''
-        GreenPixels = np.zeros(mask.shape[0])
-        for i in range(mask.shape[0]):
-            GreenPixels[i] = np.sum(mask[i, :])
-        GreenPixelsCumSum = np.cumsum(GreenPixels)
-        if GreenPixelsCumSum[-1] != 0:
-            GreenPixelsCumSum = GreenPixelsCumSum/GreenPixelsCumSum[-1]
-        else:
+        GreenPixels, GreenPixelsCumSum = self._rowProfile(mask)
+        if GreenPixelsCumSum is None:
             return StatParamValue("wilting", 0.0, rMax=float("Inf"))
 
         # Plant top when reaching 5% of total green pixels
-        PlantTop = 0
-        for i in range(mask.shape[0]):
-            if GreenPixelsCumSum[i] >= 0.05:
-                PlantTop = i
-                break
+        PlantTop = self._rowCrossing(GreenPixelsCumSum, 0.05, 0, 0)
         # Plant bottom when reaching 5% of total green pixels
-        PlantBottom = mask.shape[0]
-        for i in range(mask.shape[0]):
-            if GreenPixelsCumSum[i] >= 0.95:
-                PlantBottom = i
-                break
+        PlantBottom = self._rowCrossing(GreenPixelsCumSum, 0.95, 0,
+                                        mask.shape[0])
         # Plantt wilting height at 50% of total green pixels
-        WiltedHeight = PlantTop
-        for i in range(PlantTop, PlantBottom):
-            if GreenPixelsCumSum[i] >= 0.5:
-                WiltedHeight = i
-                break
+        WiltedHeight = self._rowCrossing(GreenPixelsCumSum, 0.5, PlantTop,
+                                         PlantTop, PlantBottom)
         if PlantBottom-PlantBottom != 0:
             Wilting = float(PlantBottom - WiltedHeight)/float(PlantBottom-PlantTop)
         else:
@@ -420,7 +428,8 @@ class StatParamCalculator(object):
         meths = inspect.getmembers(cls, predicate=inspect.ismethod)
         retVal = []
         for meth in meths:
-            if (not meth[0] in ignore):
+            # Private methods are helpers of the features
+            if (not meth[0] in ignore and not meth[0].startswith("_")):
                 retVal.append(meth[0])
         return (retVal)
 
@@ -720,6 +729,192 @@ class PotSegmenter_KmeansSquare(PotSegmenter):
 
         return (labels.astype(np.float64))
 
+
+class PotSegmenter_KmeansFrame(PotSegmenter_KmeansSquare):
+
+    def __init__(self, maxIter=10, epsilon=1, attempts=20, reuse=True):
+        """PotSegmenter_KmeansFrame: Segmenter by one k-means per frame
+
+        The features and the k-means are calculated once for all the pots of
+        a frame, and every pot mask is sliced out of the frame mask. Pots
+        that overlap are not calculated twice.
+
+        Args:
+          maxIter: maximum num of iterations per attempt
+          epsilon: stopping difference
+          attempts: times we try with different centers
+          reuse: Start from the centers of the previous frame, in a single
+            attempt.
+        """
+        super(PotSegmenter_KmeansFrame, self).__init__(
+            maxIter=maxIter, epsilon=epsilon, attempts=attempts)
+        self.reuse = reuse
+        self._centers = None
+
+    def segmentFrame(self, img, rects):
+        """Segment all the pots of a frame
+
+        Steps:
+        1. Calculate relative features in the box bounding all pots.
+        2. Calculate a k-means (k=2) of the pixels in pots.
+        3. Per pot, remove noise and bring close connected components
+           together.
+        4. Ignore pots with too high a complexity.
+
+        Args:
+          img (np.ndarray): The frame
+          rects (list): (key, [x, y, x`, y`]) of every pot.
+
+        Returns:
+          {key: mask} of every pot.
+        """
+        rects = [(key, list(rect)) for key, rect in rects]
+        if len(rects) < 1:
+            return {}
+        x0 = min(r[0] for k, r in rects)
+        y0 = min(r[1] for k, r in rects)
+        x1 = max(r[2] for k, r in rects)
+        y1 = max(r[3] for k, r in rects)
+
+        fc = FeatureCalculator(img[y0:y1, x0:x1])
+        fts = fc.getFeatures(["LAB_A", "LAB_B", "minervini"])
+
+        # Pixels between pots are not part of the k-means
+        inPots = np.zeros(fts.shape[:2], dtype=bool)
+        for key, r in rects:
+            inPots[r[1] - y0:r[3] - y0, r[0] - x0:r[2] - x0] = True
+        mask = np.zeros(fts.shape[:2], dtype=np.float64)
+        mask[inPots] = self.calcKmeansPixels(fts[inPots])
+
+        retVal = {}
+        se = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+        for key, r in rects:
+            msk = mask[r[1] - y0:r[3] - y0, r[0] - x0:r[2] - x0]
+            msk = cv2.morphologyEx(msk, cv2.MORPH_CLOSE, se)
+
+            # When complexity is large, image is too noisy.
+            if self.calcComplexity(msk) > self.maxComplexity:
+                msk[:] = 0
+            retVal[key] = msk
+
+        return retVal
+
+    def calcKmeansPixels(self, pixels):
+        """Labels of a k-means of pixels, 1 for the smaller cluster
+
+        Args:
+          pixels: 2D structure with a pixel per row and a feature per
+                  column.
+        """
+        pixels = np.float32(pixels)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER,
+                    self.maxIter, self.epsilon)
+        if self.reuse and self._centers is not None:
+            # Start from the clusters of the previous centers
+            dists = [np.sum((pixels - c) ** 2, axis=1) for c in self._centers]
+            labels = np.argmin(dists, axis=0).astype(np.int32)
+            compactness, labels, centers = cv2.kmeans(
+                data=pixels, K=2, bestLabels=labels.reshape(-1, 1),
+                criteria=criteria, attempts=1,
+                flags=cv2.KMEANS_USE_INITIAL_LABELS)
+        else:
+            compactness, labels, centers = cv2.kmeans(
+                data=pixels, K=2, bestLabels=None, criteria=criteria,
+                attempts=self.attempts, flags=cv2.KMEANS_RANDOM_CENTERS)
+
+        labels = labels.ravel()
+        if np.sum(labels == 0) < np.sum(labels == 1):
+            labels = 1 - labels
+            centers = centers[::-1]
+        self._centers = centers
+
+        return labels.astype(np.float64)
+
 # FIXME: Find a better place to put this.
 segmentingMethods = {"k-means-square": PotSegmenter_KmeansSquare,
+                     "k-means-frame": PotSegmenter_KmeansFrame,
                      "method1": PotSegmenter_Method1}
+
+
+# Segmenter and shared frame of the processes of a SegmentingPool
+_poolSegmenter = None
+_poolFrame = None
+
+
+def _initPoolWorker(segmenter, frame):
+    global _poolSegmenter, _poolFrame
+    _poolSegmenter = segmenter
+    _poolFrame = frame
+
+
+def _segmentInPool(args):
+    """Segment the pot at rect of the shared frame. Returns the pot key,
+    its mask as uint8 and the mask dtype, or why the segmentation failed"""
+    key, rect, shape, dtype = args
+    try:
+        frame = np.frombuffer(_poolFrame, dtype, int(np.prod(shape)))
+        frame = frame.reshape(shape)
+        msk, hint = _poolSegmenter.segment(
+            frame[rect[1]:rect[3], rect[0]:rect[2]], {})
+        return key, msk.astype(np.uint8), msk.dtype.str, None
+    except Exception as e:
+        return key, None, None, "%s: %s" % (type(e).__name__, e)
+
+
+class SegmentingPool(object):
+
+    def __init__(self, segmenter, processes=None):
+        """SegmentingPool: Persistent processes that segment the pots of frames
+
+        The processes start with the first frame and are kept for the next
+        ones. They read each frame from shared memory, so only the pot
+        rectangles and the masks, as uint8, are sent between processes.
+
+        Args:
+          segmenter (PotSegmenter): Segments every pot.
+          processes (int): Number of processes. One per CPU when None.
+        """
+        if not isinstance(segmenter, PotSegmenter):
+            raise TypeError("segmenter must be instance of PotSegmenter")
+        self.segmenter = segmenter
+        self.processes = processes
+        self._pool = None
+        self._frame = None
+
+    def segment(self, pixels, rects):
+        """Segment the pots of a frame
+
+        Args:
+          pixels (np.ndarray): The frame.
+          rects (list): (key, [x, y, x`, y`]) of every pot.
+
+        Returns:
+          (key, mask, error) of every pot, in any order. When segmenting a
+          pot fails its mask is None and error says why.
+        """
+        if self._frame is None or len(self._frame) < pixels.nbytes:
+            # The processes inherit the frame, so they start after it
+            self.close()
+            self._frame = RawArray("B", pixels.nbytes)
+            self._pool = multiprocessing.Pool(
+                self.processes, _initPoolWorker,
+                (self.segmenter, self._frame))
+        frame = np.frombuffer(self._frame, pixels.dtype, pixels.size)
+        frame.reshape(pixels.shape)[:] = pixels
+
+        tasks = [(key, list(rect), pixels.shape, pixels.dtype.str)
+                 for key, rect in rects]
+        retVal = []
+        for key, msk, dtype, err in self._pool.imap_unordered(_segmentInPool,
+                                                              tasks):
+            if msk is not None:
+                msk = msk.astype(dtype)
+            retVal.append((key, msk, err))
+        return retVal
+
+    def close(self):
+        """Stop the processes"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
@@ -131,6 +131,8 @@ class ImagePotHandler(object):
           getImage: Return images that is either masked, cropped and/or with
             feature strings
           mask,_mask(ndarray): binary image represenging the mask.
+          segError,_segError(str): Why the segmentation of the pot failed,
+            None if it did not fail.
           features: Return the calculated features
 
         Raises:
@@ -158,6 +160,7 @@ class ImagePotHandler(object):
 
         self._features = {}
         self._mask = None
+        self._segError = None
 
         if metaids is None:
             self._mids = {}
@@ -187,13 +190,29 @@ class ImagePotHandler(object):
 
     @mask.setter
     def mask(self, m):
-        if m is not None:
-            raise ValueError("Can only reset mask to None")
+        if m is not None and (not isinstance(m, np.ndarray) or
+                              m.shape[:2] != (self._rect.height,
+                                              self._rect.width)):
+            raise ValueError("Can only reset mask to None or to a pot mask")
 
         # Resetting mask invalidates calculated features.
         self._features = {}
+        self._segError = None
         self._mask = m
 
+    @property
+    def segError(self):
+        return self._segError
+
+    @segError.setter
+    def segError(self, msg):
+        # A pot that failed segmentation has an empty mask and no features
+        self.mask = None
+        if msg is not None:
+            self._mask = np.zeros([self._rect.height, self._rect.width],
+                                  np.dtype("float64"))
+        self._segError = msg
+
     @property
     def ps(self):
         return self._ps
@@ -237,15 +256,20 @@ class ImagePotHandler(object):
 
         return self._ipm.ipmPrev.getPot(self._id)
 
-    def getSegmented(self):
+    def getSegmented(self, msk=None):
         """Does not change internals of instance
 
             This method is used to parallelize the pot segmentation
             calculation so we should avoid changing the inner struct
             of the instance.
+
+        Args:
+          msk(ndarray): Segmentation of the pot image done elsewhere, as in
+            a pool of processes. The pot is segmented with ps when None.
         """
-        # FIXME: here we loose track of the hints
-        msk, hint = self._ps.segment(self._image, {})
+        if msk is None:
+            # FIXME: here we loose track of the hints
+            msk, hint = self._ps.segment(self._image, {})
 
         # if bad segmentation
         if 1 not in msk and self.iphPrev is not None:
@@ -299,7 +323,7 @@ class ImagePotHandler(object):
     def fc(self):
         return tm_ps.StatParamCalculator()
 
-    def getImage(self, masked=False, features=[], inSuper=False):
+    def getImage(self, masked=False, features=[], inSuper=False, out=None):
         """Returns pot pixels
 
         masked(boolean): If True, we replace background pixels with black
@@ -307,24 +331,28 @@ class ImagePotHandler(object):
           perimeter of the pot image
         inSuper: When True we return the segmentation in the totality of
                  self._ipm.image. When False we return it in the rect.
+        out(ndarray): Where to write the pixels to, shaped like what we
+          return. A copy of the image or rect is returned when None. May hold
+          the pot pixels themselves, which are then changed in place.
         """
-        img = self._image.copy()
+        if inSuper:
+            if out is None:
+                out = self._ipm.image.pixels.copy()
+            elif out is not self._ipm.image.pixels:
+                np.copyto(out, self._ipm.image.pixels)
+            img = out[self._rect[1]:self._rect[3],
+                      self._rect[0]:self._rect[2], :]
+        else:
+            if out is None:
+                out = np.empty_like(self._image)
+            img = out
+        if not np.may_share_memory(img, self._image):
+            np.copyto(img, self._image)
 
         if masked:
             # trigger creation if needed
             msk = self.mask
-
-            height, width, dims = img.shape
-            msk = np.reshape(msk, (height * width, 1), order="F")
-
-            tmpImg = np.zeros((height, width, dims), dtype=img.dtype)
-            tmpImg = np.reshape(tmpImg, (height * width, dims), order="F")
-
-            Ind = np.where(msk)[0]
-            imgR = np.reshape(img, (height * width, dims), order="F")
-            tmpImg[Ind, :] = imgR[Ind,:]
-            tmpImg = np.reshape(tmpImg, (height, width, dims), order="F")
-            img[::] = tmpImg[::]
+            np.copyto(img, 0, where=(msk == 0)[:, :, np.newaxis])
 
         if len(features) > 0:
             # For every calculated feature we try to fit values in image.
@@ -340,14 +368,7 @@ class ImagePotHandler(object):
                     feat.drawParamInImg(img, x=x, y=y, tScale=1.2)
                     y += 30
 
-        if inSuper:
-            superI = self._ipm.image.pixels.copy()
-            superI[self._rect[1]:self._rect[3],
-                   self._rect[0]:self._rect[2], :] = img
-            del img
-            img = superI
-
-        return img
+        return out
 
     def increaseRect(self, leftby=5, topby=5, rightby=5, bottomby=5):
         # Using property to trigger assignment, checks and cleanup
@@ -369,6 +390,12 @@ class ImagePotHandler(object):
         if "all" in feats:
             feats = tm_ps.StatParamCalculator.statParamMethods()
 
+        if self._segError is not None:
+            for featName in feats:
+                self._features[featName] = tm_ps.StatParamValue(
+                    featName, tm_ps.StatParamCalculator.errStr)
+            return
+
         # Use property to trigger creation
         msk = self.mask
         if msk is None:
@@ -531,11 +558,35 @@ class ImagePotMatrix(object):
         for key, pot in self._pots.iteritems():
             yield(key, pot)
 
+    def render_masked(self, out=None, features=[]):
+        """Returns the pixels of the image with the background of every pot
+        replaced with black, rendered into ``out`` if given.
+
+        Pots are masked in place, one after the other, so each is cut from
+        the result so far.
+
+        out(ndarray): Shaped like the image. May be its pixels.
+        features(list): As for ImagePotHandler.getImage
+        """
+        pixels = self.image.pixels
+        if out is None:
+            out = pixels.copy()
+        elif out is not pixels:
+            np.copyto(out, pixels)
+        # Pots cut their pixels from the image
+        self.image.pixels = out
+        try:
+            for key, pot in self._pots.iteritems():
+                r = pot.rect
+                pot.getImage(masked=True, features=features,
+                             out=out[r[1]:r[3], r[0]:r[2], :])
+        finally:
+            self.image.pixels = pixels
+        return out
+
     def show(self):
         """ Show segmented image with the plot squares on top. """
-        sImage = self.image.pixels
-        for key, pot in self._pots.iteritems():
-            sImage = sImage & pot.getImage(masked=True, inSuper=True)
+        sImage = self.render_masked()
 
         plt.figure()
         plt.imshow(sImage.astype(np.uint8))
@@ -556,3 +607,38 @@ class ImagePotMatrix(object):
         self._ipmPrev = None
         for key, pot in self._pots.iteritems():
             pot.strip()
+
+    def potRecords(self):
+        """Pot rectangles, ids, metaids and features as plain records
+
+        This is what ends up in the PotDataStore of the timestream. Masks and
+        segmenters are not kept.
+        """
+        records = []
+        for key, pot in self._pots.iteritems():
+            mids = dict((k, pot.getMetaId(k)) for k in pot.getMetaIdKeys())
+            feats = {}
+            for fKey, feat in pot.getCalcedFeatures().iteritems():
+                rMin, rMax = feat.range
+                feats[fKey] = (feat.name, feat.value, rMin, rMax)
+            records.append({"id": key, "rect": list(pot.rect.asList()),
+                            "metaids": mids, "features": feats})
+        return records
+
+    @classmethod
+    def fromPotRecords(cls, image, imgSize, records):
+        """Rehydrate an ImagePotMatrix from the records of potRecords
+
+        Features come back as plain StatParamValue instances, so drawing
+        extras like leaf centers or perimeter coordinates are lost.
+        """
+        ipm = cls(image, pots=[])
+        for rec in records:
+            r = ImagePotRectangle(rec["rect"], tuple(imgSize))
+            pot = ImagePotHandler(rec["id"], r, ipm, metaids=rec["metaids"])
+            for fKey, (name, val, rMin, rMax) in rec["features"].iteritems():
+                pot._features[fKey] = tm_ps.StatParamValue(name, val,
+                                                           rMin=rMin,
+                                                           rMax=rMax)
+            ipm.addPot(pot)
+        return ipm
@@ -37,10 +37,17 @@ import json
 import logging
 import os
 from os import path
-import skimage.io
 from voluptuous import MultipleInvalid
 from warnings import warn
 
+from timestream.parse.imgio import (
+    dct_reduction,
+    get_image_backend,
+)
+from timestream.parse.index import (
+    ts_index_files,
+    ts_update_index,
+)
 from timestream.parse.validate import (
     validate_timestream_manifest,
     IMAGE_EXT_CONSTANTS,
@@ -110,21 +117,21 @@ def ts_guess_manifest(ts_path):
     return ts_guess_manifest_v1(ts_path)
 
 
-def ts_guess_manifest_v1(ts_path):
+def ts_guess_manifest_v1(ts_path, index=None):
     """Guesses the values of manifest fields in a timestream
+
+    :param str ts_path: Path to the root of a timestream.
+    :param dict index: Up-to-date timestream index, as returned by
+            ``ts_update_index``. The on-disk index is updated if ``None``.
     """
     # This whole thing's one massive fucking kludge. But it seems to work
     # pretty good so, well, whoop.
     retval = {}
-    # get a sorted list of all files
-    all_files = []
-    for root, folders, files in os.walk(ts_path):
-        for folder in folders:
-            if folder.startswith("_"):
-                folders.remove(folder)
-        for fle in files:
-            all_files.append(path.join(root, fle))
-    all_files = sorted(all_files)
+    # get a sorted list of all files from the index, instead of walking the
+    # whole tree every time.
+    if index is None:
+        index = ts_update_index(ts_path)
+    all_files = [path.join(ts_path, x) for x in ts_index_files(index)]
     # find most common extension, and assume this is the ext
     exts = collections.Counter(IMAGE_EXT_CONSTANTS)
     our_exts = map(lambda x: path.splitext(x)[1][1:], all_files)
@@ -367,20 +374,39 @@ class RIException(Exception):
         return "Error reading {}".format(self.path)
 
 
-def read_image(path):
-    """Reads a image in various formats at path ``path`` into an numpy array
-    and returns the array. Returns None on error, logging the error and raising
-    a warning.
+def read_image(path, backend=None, scale=1.0):
+    """Reads a image in various formats at path ``path`` into an numpy array,
+    in RGB(A) order, and returns the array. Raises RIException on error,
+    logging the error.
+
+    The image is decoded by the backend set with
+    ``timestream.parse.imgio.set_image_backend``, or by ``backend`` if given.
+
+    With ``scale`` below 1, JPEGs are decoded at the smallest of 1/2, 1/4 or
+    1/8 of their size that is at least ``scale`` times their size. Other
+    images, and images when no backend can do so, are decoded at full size,
+    so the result has to be resized to exactly ``scale``.
     """
     try:
-        # Read using skimage's io libary. The freeimage plugin is the most
-        # feature rich and works cross platform.
-        return skimage.io.imread(path, plugin="freeimage")
-    except (ValueError, RuntimeError, WindowsError) as exc:
+        reduce = 1
+        if scale < 1:
+            reduce = dct_reduction(path, scale=scale)
+        reader = get_image_backend(path, name=backend, reduce=reduce > 1)
+        return reader.read(path, reduce=reduce)
+    except (ValueError, RuntimeError, IOError, WindowsError) as exc:
         LOG.error(str(exc))
         raise RIException(path)
 
 
+def save_image(path, pixels, backend=None):
+    """Writes ``pixels``, in RGB(A) order, to an image file at ``path``.
+
+    The image is encoded by the backend set with
+    ``timestream.parse.imgio.set_image_backend``, or by ``backend`` if given.
+    """
+    get_image_backend(path, write=True, name=backend).write(path, pixels)
+
+
 def ts_iter_numpy(fname_iter):
     """Take each image filename from ``fname_iter`` and yield the image as a
     numpy array. The image is returned as a tuple of ``(path, array)``.
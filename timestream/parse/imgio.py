@@ -0,0 +1,289 @@
+# Copyright 2014- The Australian National Univesity
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: timestream.parse.imgio
+    :platform: Unix, Windows
+    :synopsis: Pluggable backends to decode and encode image files
+
+Every backend decodes to, and encodes from, numpy arrays with the colour
+channels in RGB(A) order, whatever the library uses internally. The backend
+is chosen per file extension with ``set_image_backend``; by default images
+are read with skimage's freeimage plugin and written with skimage's default
+plugin.
+
+Pillow-SIMD and Pillow built against libjpeg-turbo are drop-in builds of
+PIL, so they are used through the ``pil`` backend when installed.
+
+Backends with ``reduces`` set can decode JPEGs straight to 1/2, 1/4 or 1/8
+of their size, which libjpeg does for a fraction of the cost of a full
+decode.
+"""
+
+from collections import OrderedDict
+import cv2
+import logging
+import numpy as np
+from os import path
+import skimage.io
+import struct
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+LOG = logging.getLogger("timestreamlib")
+
+#: Factors libjpeg can reduce the size of an image by while decoding it
+DCT_REDUCTIONS = [8, 4, 2]
+# Start of frame markers, which hold the size of a JPEG
+_JPEG_SOF = set(range(0xc0, 0xd0)) - set([0xc4, 0xc8, 0xcc])
+# Markers without a length
+_JPEG_STANDALONE = set(range(0xd0, 0xda)) | set([0x01])
+
+
+def _jpeg_header(fpath):
+    """(rows, cols, components) of the JPEG at ``fpath``, or None"""
+    try:
+        with open(fpath, "rb") as fh:
+            if fh.read(2) != b"\xff\xd8":
+                return None
+            while True:
+                byte = fh.read(1)
+                while byte and byte != b"\xff":
+                    byte = fh.read(1)
+                while byte == b"\xff":
+                    byte = fh.read(1)
+                if not byte:
+                    return None
+                marker = ord(byte)
+                if marker in _JPEG_STANDALONE:
+                    continue
+                length = struct.unpack(">H", fh.read(2))[0]
+                if marker in _JPEG_SOF:
+                    _, rows, cols, comps = struct.unpack(">BHHB", fh.read(6))
+                    return rows, cols, comps
+                fh.seek(length - 2, 1)
+    except (IOError, struct.error):
+        return None
+
+
+def image_shape(fpath):
+    """(rows, cols) of the JPEG at ``fpath``, read from its header without
+    decoding it. None if ``fpath`` is not a JPEG."""
+    header = _jpeg_header(fpath)
+    if header is None:
+        return None
+    return header[0:2]
+
+
+def dct_reduction(fpath, scale=None, shape=None):
+    """The largest of ``DCT_REDUCTIONS`` that the JPEG at ``fpath`` can be
+    decoded at while being at least ``scale`` times its size, or at least
+    ``shape`` (rows, cols). 1 if there is none or ``fpath`` is not a JPEG.
+    """
+    if scale is None and shape is None:
+        return 1
+    fshape = image_shape(fpath)
+    if fshape is None:
+        return 1
+    for reduce in DCT_REDUCTIONS:
+        # libjpeg rounds reduced sizes up
+        rshape = [-(-x // reduce) for x in fshape]
+        if scale is not None and 1.0 / reduce < scale:
+            continue
+        if shape is not None and (rshape[0] < shape[0] or
+                                  rshape[1] < shape[1]):
+            continue
+        return reduce
+    return 1
+
+
+class ImageBackend(object):
+    """Decodes and encodes image files. Subclasses set ``name`` and
+    implement ``read`` and ``write``."""
+    name = None
+    #: Whether ``read`` can decode JPEGs at a reduced size
+    reduces = False
+
+    def available(self):
+        """Whether the library behind this backend can be used"""
+        return True
+
+    def read(self, fpath, reduce=1):
+        """Returns the pixels of the image at ``fpath`` in RGB(A) order.
+
+        Backends that set ``reduces`` decode JPEGs at 1/``reduce`` of their
+        size, rounded up. Others ignore ``reduce``.
+        """
+        raise NotImplementedError()
+
+    def write(self, fpath, pixels):
+        """Writes ``pixels``, in RGB(A) order, to ``fpath``"""
+        raise NotImplementedError()
+
+
+class FreeImageBackend(ImageBackend):
+    name = "freeimage"
+
+    def available(self):
+        try:
+            import skimage.io._plugins.freeimage_plugin
+        except (ImportError, RuntimeError, OSError):
+            return False
+        return True
+
+    def read(self, fpath, reduce=1):
+        return skimage.io.imread(fpath, plugin="freeimage")
+
+    def write(self, fpath, pixels):
+        skimage.io.imsave(fpath, pixels, plugin="freeimage")
+
+
+class SkimageBackend(ImageBackend):
+    """skimage.io with whatever plugin it prefers"""
+    name = "skimage"
+
+    def read(self, fpath, reduce=1):
+        return skimage.io.imread(fpath)
+
+    def write(self, fpath, pixels):
+        skimage.io.imsave(fpath, pixels)
+
+
+class OpenCVBackend(ImageBackend):
+    name = "opencv"
+    # Reduced decoding arrived in OpenCV 3.2
+    reduces = hasattr(cv2, "IMREAD_REDUCED_COLOR_2")
+
+    def read(self, fpath, reduce=1):
+        flags = cv2.IMREAD_UNCHANGED
+        if reduce > 1 and self.reduces:
+            header = _jpeg_header(fpath)
+            if header is not None:
+                mode = "GRAYSCALE" if header[2] == 1 else "COLOR"
+                flags = getattr(cv2, "IMREAD_REDUCED_{}_{}".format(
+                    mode, reduce)) | cv2.IMREAD_IGNORE_ORIENTATION
+        pixels = cv2.imread(fpath, flags)
+        if pixels is None:
+            raise ValueError("OpenCV cannot read {}".format(fpath))
+        if pixels.ndim == 3 and pixels.shape[2] == 3:
+            pixels = cv2.cvtColor(pixels, cv2.COLOR_BGR2RGB)
+        elif pixels.ndim == 3 and pixels.shape[2] == 4:
+            pixels = cv2.cvtColor(pixels, cv2.COLOR_BGRA2RGBA)
+        return pixels
+
+    def write(self, fpath, pixels):
+        if pixels.ndim == 3 and pixels.shape[2] == 3:
+            pixels = cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR)
+        elif pixels.ndim == 3 and pixels.shape[2] == 4:
+            pixels = cv2.cvtColor(pixels, cv2.COLOR_RGBA2BGRA)
+        if not cv2.imwrite(fpath, pixels):
+            raise ValueError("OpenCV cannot write {}".format(fpath))
+
+
+class PILBackend(ImageBackend):
+    name = "pil"
+    reduces = True
+    # Modes numpy understands as is
+    _modes = ["L", "RGB", "RGBA", "I;16", "I", "F"]
+
+    def available(self):
+        return Image is not None
+
+    def read(self, fpath, reduce=1):
+        img = Image.open(fpath)
+        if reduce > 1 and img.format == "JPEG":
+            # PIL picks the largest reduction that fits this size into ours
+            img.draft(img.mode, (max(1, img.size[0] // reduce),
+                                 max(1, img.size[1] // reduce)))
+        if img.mode not in self._modes:
+            if "A" in img.mode or "transparency" in img.info:
+                img = img.convert("RGBA")
+            else:
+                img = img.convert("RGB")
+        return np.array(img)
+
+    def write(self, fpath, pixels):
+        Image.fromarray(pixels).save(fpath)
+
+
+_BACKENDS = OrderedDict((x.name, x) for x in [
+    FreeImageBackend(), SkimageBackend(), OpenCVBackend(), PILBackend()])
+
+# {extension: backend name}, None being the fallback for all extensions
+_readers = {None: FreeImageBackend.name}
+_writers = {None: SkimageBackend.name}
+
+
+def image_backends(available=True):
+    """Names of the image backends, only the usable ones if ``available``"""
+    return [name for name, backend in _BACKENDS.iteritems()
+            if not available or backend.available()]
+
+
+def set_image_backend(name, ext=None, read=True, write=True):
+    """Use backend ``name`` to read and/or write images.
+
+    Args:
+      name(str): One of ``image_backends(available=False)``.
+      ext(str): Only for files with this extension, e.g. "jpg". For all
+        files if None.
+      read(bool): Use to read images.
+      write(bool): Use to write images.
+    """
+    if name not in _BACKENDS:
+        msg = "Unknown image backend {}. Use one of {}".format(
+            name, ", ".join(_BACKENDS.keys()))
+        LOG.error(msg)
+        raise ValueError(msg)
+    if ext is not None:
+        ext = ext.lower().lstrip(".")
+    if ext is None and read:
+        _readers.clear()
+    if ext is None and write:
+        _writers.clear()
+    if read:
+        _readers[ext] = name
+    if write:
+        _writers[ext] = name
+
+
+def get_image_backend(fpath, write=False, name=None, reduce=False):
+    """Returns the ImageBackend used to read, or write, ``fpath``.
+
+    Args:
+      fpath(str): Path to the image.
+      write(bool): The backend for writing instead of reading.
+      name(str): Get this backend instead of the configured one.
+      reduce(bool): If the configured backend can't decode at a reduced
+        size, get the first available one that can. They all give the
+        same RGB(A) pixels.
+    """
+    if name is None:
+        backends = _writers if write else _readers
+        ext = path.splitext(fpath)[1].lower().lstrip(".")
+        name = backends.get(ext, backends[None])
+        if reduce and not _BACKENDS.get(name, ImageBackend).reduces:
+            for backend in _BACKENDS.values():
+                if backend.reduces and backend.available():
+                    return backend
+    try:
+        return _BACKENDS[name]
+    except KeyError:
+        msg = "Unknown image backend {}".format(name)
+        LOG.error(msg)
+        raise ValueError(msg)
@@ -0,0 +1,262 @@
+# Copyright 2014- The Australian National Univesity
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: timestream.parse.index
+    :platform: Unix, Windows
+    :synopsis: Persistent on-disk index of the files in a v1 timestream
+
+The index lives in the ``_data`` folder of a timestream and records, for
+every folder below the timestream root, the folder's mtime, its sub-folders
+and the size and mtime of each file within it. When the index is updated,
+only folders whose mtime has changed get listed again; every other folder
+costs a single ``stat``.
+
+``TimestampIndex`` is the in-memory counterpart, a sorted index of the
+timestamps of a timestream for fast lookups.
+"""
+
+from datetime import datetime
+import json
+import logging
+import numpy as np
+import os
+from os import path
+
+from timestream.util import (
+    PARAM_TYPE_ERR,
+)
+
+#: Name of the index file within a timestream's ``_data`` folder
+TS_INDEX_FILE = "ts_index.json"
+#: Version of the on-disk index format
+TS_INDEX_VERSION = 1
+
+LOG = logging.getLogger("timestreamlib")
+
+
+def ts_index_path(ts_path):
+    """Returns the path to the index file of the timestream at ``ts_path``"""
+    return path.join(ts_path, "_data", TS_INDEX_FILE)
+
+
+def ts_read_index(ts_path):
+    """Reads the index of the timestream at ``ts_path``.
+
+    :param str ts_path: Path to the root of a timestream.
+    :returns: The index as a ``dict``, or ``None`` if there is no valid index.
+    """
+    try:
+        with open(ts_index_path(ts_path)) as ifh:
+            index = json.load(ifh)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(index, dict) or \
+            index.get("version") != TS_INDEX_VERSION or \
+            not isinstance(index.get("dirs"), dict):
+        LOG.debug("Ignoring index of {} with unknown format".format(ts_path))
+        return None
+    dirs = {}
+    for reldir, entry in index["dirs"].items():
+        dirs[str(reldir)] = {
+            "mtime": entry["mtime"],
+            "dirs": [str(x) for x in entry["dirs"]],
+            "files": dict((str(k), v) for k, v in entry["files"].items()),
+        }
+    index["dirs"] = dirs
+    return index
+
+
+def ts_write_index(ts_path, index):
+    """Writes ``index`` to the ``_data`` folder of the timestream at
+    ``ts_path``. Failing to write the index is not an error, the index is
+    merely rebuilt next time.
+    """
+    idx_path = ts_index_path(ts_path)
+    tmp_path = idx_path + ".tmp"
+    try:
+        with open(tmp_path, "w") as ofh:
+            json.dump(index, ofh)
+        # Rename so that readers never see a half-written index
+        if os.name == "nt" and path.exists(idx_path):
+            os.remove(idx_path)
+        os.rename(tmp_path, idx_path)
+    except (IOError, OSError):
+        LOG.warn("Couldn't write index for ts {}".format(ts_path))
+
+
+def _index_dir(ts_path, reldir, old_dirs, new_dirs):
+    """Recursively (re)index folder ``reldir``, reusing the entries in
+    ``old_dirs`` for folders that have not changed. Returns the number of
+    folders that had to be listed.
+    """
+    absdir = path.join(ts_path, reldir)
+    try:
+        mtime = os.stat(absdir).st_mtime
+    except OSError:
+        return 0
+    listed = 0
+    entry = old_dirs.get(reldir)
+    if entry is None or entry["mtime"] != mtime:
+        # Folder is new or its contents changed, so list it
+        listed += 1
+        entry = {"mtime": mtime, "dirs": [], "files": {}}
+        try:
+            names = sorted(os.listdir(absdir))
+        except OSError:
+            names = []
+        for name in names:
+            fpath = path.join(absdir, name)
+            try:
+                fstat = os.stat(fpath)
+            except OSError:
+                continue
+            if path.isdir(fpath):
+                # Skip _data and other metadata folders
+                if not name.startswith("_"):
+                    entry["dirs"].append(name)
+            else:
+                entry["files"][name] = [fstat.st_size, fstat.st_mtime]
+    new_dirs[reldir] = entry
+    for name in entry["dirs"]:
+        listed += _index_dir(ts_path, path.join(reldir, name), old_dirs,
+                             new_dirs)
+    return listed
+
+
+def ts_update_index(ts_path, index=None, write=True):
+    """Builds or incrementally updates the index of the timestream at
+    ``ts_path``.
+
+    :param str ts_path: Path to the root of a timestream.
+    :param dict index: Previously read index. Read from disk if ``None``.
+    :param bool write: Write the index back to disk if it changed.
+    :returns: The up-to-date index as a ``dict``.
+    """
+    ts_path = ts_path.rstrip(os.sep)
+    # Make _data before walking, as making it changes the root folder's mtime
+    data_dir = path.dirname(ts_index_path(ts_path))
+    if write and path.isdir(ts_path) and not path.isdir(data_dir):
+        try:
+            os.mkdir(data_dir)
+        except (IOError, OSError):
+            pass
+    if index is None:
+        index = ts_read_index(ts_path)
+    old_dirs = index["dirs"] if index is not None else {}
+    new_dirs = {}
+    listed = _index_dir(ts_path, "", old_dirs, new_dirs)
+    changed = listed > 0 or len(new_dirs) != len(old_dirs)
+    index = {"version": TS_INDEX_VERSION, "dirs": new_dirs}
+    LOG.debug("Indexed {}, listed {} of {} folders".format(
+        ts_path, listed, len(new_dirs)))
+    if write and changed and path.isdir(data_dir):
+        ts_write_index(ts_path, index)
+    return index
+
+
+def ts_index_files(index):
+    """Returns a sorted list of the paths, relative to the timestream root, of
+    all files in ``index``.
+    """
+    files = []
+    for reldir, entry in index["dirs"].items():
+        for name in entry["files"]:
+            files.append(path.join(reldir, name))
+    return sorted(files)
+
+
+class TimestampIndex(object):
+    """Sorted index of timestamps with O(log n) lookups.
+
+    The timestamps are kept as epoch seconds in a NumPy array, so that
+    membership, position and nearest-neighbour queries are binary searches.
+    """
+
+    _EPOCH = datetime(1970, 1, 1)
+
+    def __init__(self, timestamps=[]):
+        self._times = sorted(set(timestamps))
+        self._secs = np.array([self._to_secs(x) for x in self._times],
+                              dtype=np.float64)
+
+    @classmethod
+    def _to_secs(cls, timestamp):
+        if not isinstance(timestamp, datetime):
+            msg = PARAM_TYPE_ERR.format(param="timestamp",
+                                        func="TimestampIndex",
+                                        type="datetime.datetime")
+            LOG.error(msg)
+            raise TypeError(msg)
+        return (timestamp - cls._EPOCH).total_seconds()
+
+    def __len__(self):
+        return len(self._times)
+
+    def __iter__(self):
+        return iter(self._times)
+
+    def __getitem__(self, item):
+        return self._times[item]
+
+    def __contains__(self, timestamp):
+        try:
+            self.index(timestamp)
+        except (ValueError, TypeError):
+            return False
+        return True
+
+    def index(self, timestamp):
+        """Position of ``timestamp``. Raises ValueError if it's not there."""
+        secs = self._to_secs(timestamp)
+        pos = int(np.searchsorted(self._secs, secs, side="left"))
+        if pos == len(self._secs) or self._secs[pos] != secs:
+            raise ValueError("{} is not in index".format(timestamp))
+        return pos
+
+    def floor(self, timestamp):
+        """Latest timestamp at or before ``timestamp``, or None"""
+        pos = int(np.searchsorted(self._secs, self._to_secs(timestamp),
+                                  side="right"))
+        if pos == 0:
+            return None
+        return self._times[pos - 1]
+
+    def ceil(self, timestamp):
+        """Earliest timestamp at or after ``timestamp``, or None"""
+        pos = int(np.searchsorted(self._secs, self._to_secs(timestamp),
+                                  side="left"))
+        if pos == len(self._times):
+            return None
+        return self._times[pos]
+
+    def nearest(self, timestamp):
+        """Closest timestamp to ``timestamp``, the earlier one on a tie. None
+        if the index is empty."""
+        flr = self.floor(timestamp)
+        cel = self.ceil(timestamp)
+        if flr is None or cel is None:
+            return cel if flr is None else flr
+        if cel - timestamp < timestamp - flr:
+            return cel
+        return flr
+
+    def range(self, start, end):
+        """List of timestamps between ``start`` and ``end``, inclusive"""
+        lo = int(np.searchsorted(self._secs, self._to_secs(start),
+                                 side="left"))
+        hi = int(np.searchsorted(self._secs, self._to_secs(end),
+                                 side="right"))
+        return self._times[lo:hi]
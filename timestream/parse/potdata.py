@@ -0,0 +1,243 @@
+# Copyright 2014- The Australian National Univesity
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: timestream.parse.potdata
+    :platform: Unix, Windows
+    :synopsis: Per-timestream store of pot rectangles, ids and features
+
+All pot data of a timestream lives in one SQLite database in the ``_data``
+folder, with one typed table each for images, pots, meta ids and features.
+Rows are keyed by timestamp (formatted with ``TS_DATE_FORMAT``, which sorts
+chronologically) and pot id, so a whole date range is read with a handful of
+queries.
+
+Pot records are plain dicts, independent of the classes in
+``timestream.manipulate.pot``::
+
+    {"id": 1, "rect": [x, y, x', y'], "metaids": {"plant": "Col-0"},
+     "features": {"area": ("area", 1234.0, 0.0, inf)}}
+
+where every feature is a ``(name, value, rMin, rMax)`` tuple.
+"""
+
+import logging
+import numpy as np
+import sqlite3
+
+from timestream.parse import (
+    ts_format_date,
+)
+
+#: Name of the pot data store within a timestream's ``_data`` folder
+POT_DATA_FILE = "pot_data.sqlite"
+
+LOG = logging.getLogger("timestreamlib")
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS images (timestamp TEXT PRIMARY KEY, "
+    "height INTEGER, width INTEGER)",
+    "CREATE TABLE IF NOT EXISTS pots (timestamp TEXT, pot_id INTEGER, "
+    "x1 INTEGER, y1 INTEGER, x2 INTEGER, y2 INTEGER, "
+    "PRIMARY KEY (timestamp, pot_id))",
+    "CREATE TABLE IF NOT EXISTS metaids (timestamp TEXT, pot_id INTEGER, "
+    "key TEXT, value, PRIMARY KEY (timestamp, pot_id, key))",
+    "CREATE TABLE IF NOT EXISTS features (timestamp TEXT, pot_id INTEGER, "
+    "feature TEXT, name TEXT, value REAL, text TEXT, rmin REAL, rmax REAL, "
+    "PRIMARY KEY (timestamp, pot_id, feature))",
+]
+_TABLES = ["images", "pots", "metaids", "features"]
+# Seconds to wait on the lock held by other writers, e.g. pipeline workers
+_LOCK_TIMEOUT = 60.0
+
+
+def _to_str(val):
+    if isinstance(val, unicode):
+        return str(val)
+    return val
+
+
+class PotDataStore(object):
+
+    def __init__(self, db_path):
+        """Store of the pot data of every image in a timestream.
+
+        Args:
+          db_path(str): Path to the SQLite database. Created on first write.
+
+        Attributes:
+          _conn(sqlite3.Connection): Opened lazily, and never pickled.
+        """
+        self._db_path = db_path
+        self._conn = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        return state
+
+    @property
+    def path(self):
+        return self._db_path
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            try:
+                self._conn = sqlite3.connect(self._db_path,
+                                             timeout=_LOCK_TIMEOUT)
+                for stmt in _SCHEMA:
+                    self._conn.execute(stmt)
+                self._conn.commit()
+            except sqlite3.Error as exc:
+                msg = "Cannot open pot data store {}: {}".format(
+                    self._db_path, str(exc))
+                LOG.error(msg)
+                raise RuntimeError(msg)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def write(self, timestamp, imgSize, pots):
+        """Replace the pot data at ``timestamp`` in one transaction.
+
+        Args:
+          timestamp(datetime or str): Timestamp of the image.
+          imgSize(tuple): (height, width) of the image containing the pots.
+          pots(list): List of pot records.
+        """
+        tstr = ts_format_date(timestamp)
+        potRows = []
+        midRows = []
+        featRows = []
+        for pot in pots:
+            rect = [int(x) for x in pot["rect"]]
+            potRows.append([tstr, pot["id"]] + rect)
+            for key, val in pot.get("metaids", {}).iteritems():
+                if isinstance(val, complex):
+                    val = str(val)
+                midRows.append((tstr, pot["id"], key, val))
+            for feat, (name, val, rMin, rMax) in \
+                    pot.get("features", {}).iteritems():
+                # Strings, like StatParamCalculator.errStr, are kept as text
+                if isinstance(val, basestring):
+                    num, text = None, str(val)
+                else:
+                    try:
+                        num, text = float(val), None
+                    except (TypeError, ValueError):
+                        num, text = None, str(val)
+                featRows.append((tstr, pot["id"], feat, name, num, text,
+                                 float(rMin), float(rMax)))
+        with self.conn:
+            for table in _TABLES:
+                self.conn.execute(
+                    "DELETE FROM {} WHERE timestamp = ?".format(table),
+                    (tstr,))
+            self.conn.execute("INSERT INTO images VALUES (?, ?, ?)",
+                              (tstr, int(imgSize[0]), int(imgSize[1])))
+            self.conn.executemany(
+                "INSERT INTO pots VALUES (?, ?, ?, ?, ?, ?)", potRows)
+            self.conn.executemany(
+                "INSERT INTO metaids VALUES (?, ?, ?, ?)", midRows)
+            self.conn.executemany(
+                "INSERT INTO features VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                featRows)
+
+    def timestamps(self, start=None, end=None):
+        """Sorted list of the formatted timestamps that have pot data"""
+        where, args = self._range(start, end)
+        cur = self.conn.execute(
+            "SELECT timestamp FROM images {} ORDER BY timestamp".format(where),
+            args)
+        return [str(x[0]) for x in cur]
+
+    def read(self, timestamp):
+        """Returns ``(imgSize, pots)`` at ``timestamp``, or None"""
+        return self.read_range(timestamp, timestamp).get(
+            ts_format_date(timestamp))
+
+    def read_range(self, start=None, end=None):
+        """Bulk read all pot data between ``start`` and ``end``, inclusive.
+
+        Returns:
+          dict: {timestamp(str): (imgSize, pots)}, with pots in pot id order.
+        """
+        where, args = self._range(start, end)
+        retVal = {}
+        potDicts = {}
+        for tstr, hgt, wdt in self.conn.execute(
+                "SELECT * FROM images {}".format(where), args):
+            retVal[str(tstr)] = ((hgt, wdt), [])
+        for row in self.conn.execute(
+                "SELECT * FROM pots {} ORDER BY timestamp, pot_id".format(
+                    where), args):
+            tstr, potId = str(row[0]), _to_str(row[1])
+            pot = {"id": potId, "rect": list(row[2:6]), "metaids": {},
+                   "features": {}}
+            retVal[tstr][1].append(pot)
+            potDicts[(tstr, potId)] = pot
+        for tstr, potId, key, val in self.conn.execute(
+                "SELECT * FROM metaids {}".format(where), args):
+            pot = potDicts[(str(tstr), _to_str(potId))]
+            pot["metaids"][str(key)] = _to_str(val)
+        for row in self.conn.execute(
+                "SELECT * FROM features {}".format(where), args):
+            tstr, potId, feat, name, num, text, rMin, rMax = row
+            pot = potDicts[(str(tstr), _to_str(potId))]
+            if text is not None:
+                val = str(text)
+            elif num is None:
+                # SQLite stores NaN as NULL
+                val = float("nan")
+            else:
+                val = num
+            pot["features"][str(feat)] = (str(name), val, rMin, rMax)
+        return retVal
+
+    def read_feature(self, feature, start=None, end=None):
+        """Bulk read one feature of all pots between ``start`` and ``end``.
+
+        Returns:
+          tuple: (timestamps, potIds, values) as arrays of equal length, in
+            timestamp and pot id order. Values that are not numbers are NaN.
+        """
+        where, args = self._range(start, end)
+        where = "WHERE feature = ?" + (" AND " + where[6:] if where else "")
+        cur = self.conn.execute(
+            "SELECT timestamp, pot_id, value FROM features {} "
+            "ORDER BY timestamp, pot_id".format(where), [feature] + args)
+        rows = cur.fetchall()
+        tstrs = np.array([str(x[0]) for x in rows])
+        potIds = np.array([x[1] for x in rows])
+        values = np.array([np.nan if x[2] is None else x[2] for x in rows],
+                          dtype=np.float64)
+        return tstrs, potIds, values
+
+    def _range(self, start, end):
+        conds = []
+        args = []
+        if start is not None:
+            conds.append("timestamp >= ?")
+            args.append(ts_format_date(start))
+        if end is not None:
+            conds.append("timestamp <= ?")
+            args.append(ts_format_date(end))
+        if len(conds) == 0:
+            return "", args
+        return "WHERE " + " AND ".join(conds), args
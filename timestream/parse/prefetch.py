@@ -0,0 +1,179 @@
+# Copyright 2014- The Australian National Univesity
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: timestream.parse.prefetch
+    :platform: Unix, Windows
+    :synopsis: Bounded read-ahead of images in background threads
+
+The caller tells an ``ImagePrefetcher`` which images it will need next with
+``schedule`` and collects each one with ``take`` when it gets there. Reading
+and decoding happens in background threads, so it overlaps with whatever the
+caller does with the current image.
+"""
+
+from collections import OrderedDict
+import logging
+import threading
+
+from timestream.parse import (
+    read_image,
+)
+
+LOG = logging.getLogger("timestreamlib")
+
+_PENDING, _READING, _DONE = range(3)
+
+
+class _Entry(object):
+    __slots__ = ["state", "pixels"]
+
+    def __init__(self):
+        self.state = _PENDING
+        self.pixels = None
+
+
+class ImagePrefetcher(object):
+
+    def __init__(self, depth=2, max_mb=None, threads=None):
+        """Reads images ahead of their use in background threads.
+
+        Args:
+          depth(int): Maximum number of images being read or held.
+          max_mb(int): Maximum megabytes of memory held by read images. The
+            size of upcoming images is guessed from the largest one read so
+            far. None for no limit.
+          threads(int): Number of reading threads. Defaults to ``depth``, up
+            to four.
+
+        Attributes:
+          _entries(OrderedDict): {path: _Entry} of the scheduled images, in
+            the order they are needed.
+          _imgBytes(int): Size of the largest image read so far.
+        """
+        if depth < 1:
+            msg = "Prefetch depth must be at least 1"
+            LOG.error(msg)
+            raise ValueError(msg)
+        self.depth = depth
+        self.max_bytes = None
+        if max_mb is not None:
+            self.max_bytes = max_mb * 2 ** 20
+        self._numThreads = threads or min(depth, 4)
+        self._threads = []
+        self._entries = OrderedDict()
+        self._imgBytes = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _fits(self, num):
+        """Whether ``num`` images fit within the memory limit"""
+        if num > self.depth:
+            return False
+        if self.max_bytes is None:
+            return True
+        if self._imgBytes == 0:
+            # Don't know how big images are yet
+            return num <= 1
+        return num * self._imgBytes <= self.max_bytes
+
+    def schedule(self, paths):
+        """Read the images in ``paths``, in order, as far as the depth and
+        memory limits allow. Images scheduled before but not in ``paths`` are
+        dropped. None elements are ignored.
+        """
+        paths = [x for x in paths if x is not None]
+        with self._cond:
+            if self._closed:
+                return
+            entries = OrderedDict()
+            for fpath in paths:
+                entry = self._entries.get(fpath)
+                if entry is None:
+                    if not self._fits(len(entries) + 1):
+                        break
+                    entry = _Entry()
+                entries[fpath] = entry
+            self._entries = entries
+            self._startThreads()
+            self._cond.notify_all()
+
+    def take(self, fpath):
+        """Returns the pixels of the image at ``fpath`` and forgets it.
+
+        Waits until the image is read. Returns None if ``fpath`` was not
+        scheduled or could not be read; the caller reads it itself in that
+        case, and gets any error that comes with it.
+        """
+        with self._cond:
+            entry = self._entries.get(fpath)
+            if entry is None:
+                return None
+            # Entries are read in order, so this one is next in line
+            while entry.state != _DONE and not self._closed:
+                self._cond.wait()
+            self._entries.pop(fpath, None)
+            return entry.pixels
+
+    def clear(self):
+        """Drop all scheduled images"""
+        with self._cond:
+            self._entries = OrderedDict()
+
+    def close(self):
+        """Drop all scheduled images and stop the reading threads"""
+        with self._cond:
+            self._entries = OrderedDict()
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _startThreads(self):
+        # Started on first use, so instances can be made before forking
+        while len(self._threads) < self._numThreads:
+            thread = threading.Thread(target=self._reader)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _reader(self):
+        while True:
+            with self._cond:
+                fpath, entry = None, None
+                while entry is None:
+                    if self._closed:
+                        return
+                    for fpath, entry in self._entries.iteritems():
+                        if entry.state == _PENDING:
+                            break
+                    else:
+                        fpath, entry = None, None
+                        self._cond.wait()
+                entry.state = _READING
+
+            try:
+                pixels = read_image(fpath)
+            except Exception:
+                # Left for the caller to read, and report, itself
+                pixels = None
+
+            with self._cond:
+                entry.pixels = pixels
+                entry.state = _DONE
+                if pixels is not None and pixels.nbytes > self._imgBytes:
+                    self._imgBytes = pixels.nbytes
+                self._cond.notify_all()
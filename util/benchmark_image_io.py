@@ -1,28 +1,120 @@
-import skimage.io as skimgio
-import cv2
+"""Benchmark the image backends of timestream.parse.imgio.
+
+Reports, per backend and image, how many images per second and how many
+megabytes of decoded pixels per second each backend reads and writes.
+Without IMAGEs, we benchmark synthetic JPG, PNG and TIFF images the size of
+what our chamber cameras store. Raw images, like CR2, can't be synthesised
+so pass some in to benchmark them; they are only read, never written.
+
+USAGE:
+    benchmark_image_io.py [-r ROUNDS] [-b BACKENDS] [IMAGE ...]
+    benchmark_image_io.py (-h | --help)
+
+OPTIONS:
+    -h --help     Show this screen.
+    -r ROUNDS     Number of times each image is read and written [default: 5]
+    -b BACKENDS   Coma (,) separated backends to benchmark. Defaults to all
+                  available ones.
+"""
+
+from __future__ import print_function
+
+from docopt import docopt
+import numpy as np
+from os import path
+import shutil
+import tempfile
 import time
-ROUNDS = 1
-
-def load_scikit(img):
-    a = skimgio.imread(img, plugin="freeimage")
-    skimgio.imsave("./scikit.tiff", a, plugin="freeimage")
-    print a.shape, a.dtype
-
-def load_cv(img):
-    a = cv2.imread(img, -2)
-    cv2.imwrite("./cv2.tiff", a)
-    print a.shape, a.dtype
-
-def main(img):
-    start = time.time()
-    for _ in range(ROUNDS):
-        load_scikit(img)
-    print "Scikit image took {:.4f} seconds".format(time.time() - start)
-    start = time.time()
-    for _ in range(ROUNDS):
-        load_cv(img)
-    print "OpenCV took {:.4f} seconds".format(time.time() - start)
+
+from timestream.parse.imgio import (
+    get_image_backend,
+    image_backends,
+)
+
+# (name, (rows, cols)) of the images we store: 18MP from the chamber cameras
+# and the quarter sized ones we derive from them.
+SIZES = [("18MP", (3456, 5184)), ("4.5MP", (1728, 2592))]
+FORMATS = ["jpg", "png", "tif"]
+# Camera raw formats, which no backend writes
+READ_ONLY = [".cr2", ".nef"]
+
+
+def synth_image(shape):
+    """RGB image that compresses roughly like a photo: smooth gradients plus
+    some noise."""
+    rows, cols = shape
+    grad = np.add.outer(np.linspace(0, 160, rows), np.linspace(0, 80, cols))
+    rand = np.random.RandomState(42).randint(0, 32, (rows, cols, 3))
+    return (grad[:, :, np.newaxis] + rand).astype(np.uint8)
+
+
+def synth_images(tmpdir):
+    """Write the synthetic images to ``tmpdir``, returns their paths"""
+    writer = get_image_backend("x.png", name="opencv")
+    fpaths = []
+    for name, shape in SIZES:
+        pixels = synth_image(shape)
+        for ext in FORMATS:
+            fpath = path.join(tmpdir, "{}.{}".format(name, ext))
+            writer.write(fpath, pixels)
+            fpaths.append(fpath)
+    return fpaths
+
+
+def bench(backend, fpath, rounds, tmpdir):
+    """Returns (read secs, write secs, decoded bytes) per image. Secs are
+    None if the backend can't do it."""
+    try:
+        start = time.time()
+        for _ in range(rounds):
+            pixels = backend.read(fpath)
+        readSecs = (time.time() - start) / rounds
+    except Exception:
+        return None, None, 0
+
+    ext = path.splitext(fpath)[1].lower()
+    if ext in READ_ONLY:
+        return readSecs, None, pixels.nbytes
+    outpath = path.join(tmpdir, "out-" + backend.name + ext)
+    try:
+        start = time.time()
+        for _ in range(rounds):
+            backend.write(outpath, pixels)
+        writeSecs = (time.time() - start) / rounds
+    except Exception:
+        writeSecs = None
+    return readSecs, writeSecs, pixels.nbytes
+
+
+def _rates(secs, nbytes):
+    if secs is None:
+        return "{:>8} {:>8}".format("-", "-")
+    return "{:8.2f} {:8.1f}".format(1 / secs, nbytes / secs / 2 ** 20)
+
+
+def main(opts):
+    rounds = int(opts["-r"])
+    backends = image_backends()
+    if opts["-b"]:
+        backends = [x for x in opts["-b"].split(",") if x in backends]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fpaths = opts["IMAGE"] or synth_images(tmpdir)
+        print("{:<10} {:<16} {:>8} {:>8} {:>8} {:>8}".format(
+            "", "", "read", "read", "write", "write"))
+        print("{:<10} {:<16} {:>8} {:>8} {:>8} {:>8}".format(
+            "backend", "image", "img/s", "MB/s", "img/s", "MB/s"))
+        for fpath in fpaths:
+            for name in backends:
+                backend = get_image_backend(fpath, name=name)
+                readSecs, writeSecs, nbytes = bench(backend, fpath, rounds,
+                                                    tmpdir)
+                print("{:<10} {:<16} {} {}".format(
+                    name, path.basename(fpath)[-16:],
+                    _rates(readSecs, nbytes), _rates(writeSecs, nbytes)))
+    finally:
+        shutil.rmtree(tmpdir)
+
 
 if __name__ == "__main__":
-    import sys
-    main(sys.argv[1])
+    main(docopt(__doc__))
@@ -30,4 +30,4 @@ for img in ts.iter_by_timepoints(remove_gaps=False):
         newimg.data["copy"] = "yes"
         ts_out.write_image(newimg)
         print "Done\n"
-
+ts_out.flush()